@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+# Fan-out latency of the mini chat server as the number of users grows. For
+# every user count, a fresh server is started and that many headless bots
+# join its lobby: no input(), no threads, all of them on one selector. A few
+# of them then send timestamped messages at a fixed total rate, and every
+# bot reads what the server broadcasts. The report, per user count:
+#   - the delivery latency percentiles, from the send() of a message to its
+#     recv() by the probes, a sample of the bots that parse every frame (the
+#     others only count bytes, so that 10k bots don't measure the benchmark);
+#   - the deliveries per second, and how long the slowest bot took to get
+#     everything;
+#   - what happened to one deliberately slow reader, that reads --slow-read
+#     bytes per second: its latency, and whether the server disconnected it
+#     (see the server's --max-queue and --slow-policy).
+#
+# The bots and the server share the machine: on few CPUs, the latencies are
+# those of the pair, an upper bound of the server's.
+#
+# Usage: chat-swarm.py [--users 10,100,1000,10000] [--senders N] [--rate R]
+#                      [--duration S] [--size B] [--probes N] [--slow-read B]
+#                      [--json FILE] [-- <server arguments>]
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import resource
+import selectors
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT, "tcp-examples", "app-cs-py")
+CHAT_DIR = os.path.join(ROOT, "chat-apps", "mini-chat-py")
+SERVER = os.path.join(CHAT_DIR, "server.py")
+
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, CHAT_DIR)
+import libframe  # noqa: E402
+import libmetrics  # noqa: E402
+
+HOST = "127.0.0.1"
+# The slow reader's receive buffer, small so that the server's outbox for it
+# fills up rather than the kernel's buffers:
+SLOW_RCVBUF = 4096
+# Sent by the first bot once everyone has joined: the bots skip the join
+# notices up to it, and the benchmark starts once they all got it:
+SYNC = libframe.encode(b"swarm sync")
+# Seconds between the first bot's '/rooms' while waiting for the others to
+# join, and the longest wait for the last messages after sending:
+POLL_INTERVAL = 0.1
+DRAIN_TIMEOUT = 30.0
+
+
+class Bot:
+    def __init__(self, sock, probe):
+        self.sock = sock
+        # Only probes parse frames, the others count bytes:
+        self.reader = libframe.FrameReader() if probe else None
+        self.latency = libmetrics.Histogram()
+        self.received = 0
+        self.delivered = 0
+        self.pending = bytearray()
+        self.disconnected = False
+        # Everything received is skipped until this frame, and the end of
+        # what was skipped kept in case the frame is split between reads:
+        self.marker = SYNC
+        self.skipped = b""
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def start_server(server_args):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, SERVER, str(port), *server_args],
+        cwd=CHAT_DIR,
+        stdout=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10.0
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}.")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return process, port
+        except OSError:
+            time.sleep(0.05)
+    stop_server(process)
+    raise RuntimeError(f"Server not listening on port {port}.")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def connect(port, username, rcvbuf=None):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if rcvbuf is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    sock.settimeout(10)
+    sock.connect((HOST, port))
+    # The username is the first frame, whether the prompt arrived or not:
+    sock.sendall(libframe.encode(username.encode("ascii")))
+    sock.setblocking(False)
+    return sock
+
+
+def receive(bot, nbytes, frame_size):
+    try:
+        data = bot.sock.recv(nbytes)
+    except BlockingIOError:
+        return
+    except OSError:
+        data = b""
+    if not data:
+        bot.disconnected = True
+        return
+    if bot.marker is not None:
+        data = skip(bot, data)
+        if not data:
+            return
+    if bot.reader is None:
+        bot.received += len(data)
+        bot.delivered = bot.received // frame_size
+        return
+    now = time.perf_counter_ns()
+    for payload in bot.reader.feed(data):
+        # Notices start with "_", the benchmark's messages with their
+        # send time:
+        if payload[:1] != b"_":
+            bot.latency.record((now - int(payload.split(b" ", 2)[1])) / 1e9)
+            bot.delivered += 1
+
+
+def skip(bot, data):
+    # Return what follows 'bot.marker' in the stream, b"" if it hasn't
+    # arrived yet:
+    data = bot.skipped + data
+    index = data.find(bot.marker)
+    if index < 0:
+        bot.skipped = data[1 - len(bot.marker) :]
+        return b""
+    data = data[index + len(bot.marker) :]
+    bot.marker = None
+    bot.skipped = b""
+    return data
+
+
+def join(port, users, senders, probes, slow_read, frame_size):
+    """Connect the bots and the slow reader (or None), and return them once
+    they are all past the join notices."""
+    sel = selectors.DefaultSelector()
+    # Probes evenly spread among the bots, the senders always among them:
+    step = max(1, users // probes)
+    bots = []
+    for i in range(users):
+        bot = Bot(connect(port, f"bot{i}"), probe=i < senders or i % step == 0)
+        sel.register(bot.sock, selectors.EVENT_READ, data=bot)
+        bots.append(bot)
+        if i % 100 == 99:
+            # Keep up with the join notices while connecting:
+            for key, _ in sel.select(timeout=0):
+                receive(key.data, 65536, frame_size)
+    slow = None
+    if slow_read:
+        slow = Bot(connect(port, "slowbot", SLOW_RCVBUF), probe=True)
+        sel.register(slow.sock, selectors.EVENT_READ, data=slow)
+    everyone = bots + [slow] if slow is not None else bots
+    # The first bot asks for the rooms until the lobby has everyone, then
+    # the sync is sent after the last join notice:
+    first = bots[0]
+    first.marker = libframe.encode(b"_ROOMS: lobby (%d)" % len(everyone))
+    next_poll = 0.0
+    synced = False
+    while any(bot.marker is not None for bot in everyone):
+        if not synced and first.marker is None:
+            # What followed the answer was notices, skipped again:
+            first.marker = SYNC
+            first.reader = libframe.FrameReader()
+            first.sock.sendall(SYNC)
+            synced = True
+        elif not synced and time.perf_counter() >= next_poll:
+            first.sock.sendall(libframe.encode(b"/rooms"))
+            next_poll = time.perf_counter() + POLL_INTERVAL
+        for key, _ in sel.select(timeout=POLL_INTERVAL):
+            receive(key.data, 65536, frame_size)
+            if key.data.disconnected:
+                raise RuntimeError("A bot was disconnected while joining.")
+    sel.close()
+    return bots, slow
+
+
+def message(sender, size):
+    payload = b"%d %d " % (sender, time.perf_counter_ns())
+    return libframe.encode(payload.ljust(size, b"x"))
+
+
+def flush(bot, stalls):
+    try:
+        del bot.pending[: bot.sock.send(bot.pending)]
+    except BlockingIOError:
+        pass
+    if bot.pending:
+        stalls[0] += 1
+
+
+def swarm(port, users, senders, rate, duration, size, probes, slow_read):
+    """Run one benchmark against the server on 'port' and return its
+    results."""
+    frame_size = libframe.HEADER.size + size
+    setup_start = time.perf_counter()
+    bots, slow = join(port, users, senders, probes, slow_read, frame_size)
+    setup = time.perf_counter() - setup_start
+    sel = selectors.DefaultSelector()
+    for bot in bots:
+        sel.register(bot.sock, selectors.EVENT_READ, data=bot)
+
+    # A fixed total rate, the senders taking turns:
+    interval = 1.0 / rate
+    sent = 0
+    stalls = [0]
+    start = time.perf_counter()
+    send_until = start + duration
+    next_send = start
+    # The slow reader reads a tenth of its bytes every tenth of a second:
+    next_slow_read = start if slow is not None else float("inf")
+    deadline = send_until + DRAIN_TIMEOUT
+    done = None
+    while True:
+        now = time.perf_counter()
+        while now >= next_send and next_send < send_until:
+            sender = bots[sent % senders]
+            sender.pending += message(sent % senders, size)
+            flush(sender, stalls)
+            sent += 1
+            next_send += interval
+        for sender in bots[:senders]:
+            # What the server didn't take yet, e.g. while it was busy:
+            if sender.pending:
+                flush(sender, stalls)
+        if now >= next_slow_read:
+            receive(slow, max(1, slow_read // 10), frame_size)
+            next_slow_read = float("inf") if slow.disconnected else now + 0.1
+        if now >= send_until:
+            if all(bot.delivered >= sent for bot in bots if not bot.disconnected):
+                done = now
+                break
+            if now >= deadline:
+                break
+        if now < send_until:
+            timeout = min(next_send, next_slow_read) - now
+        else:
+            timeout = min(0.1, next_slow_read - now)
+        for key, _ in sel.select(timeout):
+            bot = key.data
+            receive(bot, 65536, frame_size)
+            if bot.disconnected:
+                sel.unregister(bot.sock)
+    end = done or time.perf_counter()
+    sel.close()
+    for bot in bots:
+        bot.sock.close()
+    if slow is not None:
+        slow.sock.close()
+
+    latency = libmetrics.Histogram()
+    for bot in bots:
+        latency.merge(bot.latency)
+    deliveries = sum(bot.delivered for bot in bots)
+    result = {
+        "users": users,
+        "setup_s": setup,
+        "sent": sent,
+        "send_stalls": stalls[0],
+        "deliveries": deliveries,
+        "deliveries_per_s": deliveries / (end - start),
+        "complete": done is not None,
+        "disconnected": sum(bot.disconnected for bot in bots),
+        "last_delivery_s": end - send_until,
+        "latency": latency.snapshot(),
+    }
+    if slow is not None:
+        result["slow_reader"] = {
+            "delivered": slow.delivered,
+            "disconnected": slow.disconnected,
+            "latency": slow.latency.snapshot(),
+        }
+    return result
+
+
+def print_result(result):
+    latency = result["latency"]
+    line = (
+        f"{result['users']:>6} {result['sent']:>6} "
+        f"{result['deliveries_per_s']:>12.0f} "
+        + " ".join(
+            f"{latency[p] * 1e3:>8.2f}" for p in ("p50", "p90", "p99", "p99.9", "max")
+        )
+    )
+    if not result["complete"]:
+        line += " incomplete"
+    slow = result.get("slow_reader")
+    if slow is not None:
+        state = "disconnected" if slow["disconnected"] else "connected"
+        line += (
+            f"  {state}, {slow['delivered']} msgs, "
+            f"p99 {slow['latency']['p99'] * 1e3:.0f} ms"
+        )
+    print(line, flush=True)
+
+
+def main():
+    raise_fd_limit()
+    results = []
+    print(
+        f"{'users':>6} {'sent':>6} {'deliveries/s':>12} "
+        + " ".join(f"{p:>8}" for p in ("p50 ms", "p90 ms", "p99 ms", "p99.9 ms"))
+        + f" {'max ms':>8}  slow reader"
+    )
+    for users in args.users:
+        process, port = start_server(args.server_args)
+        try:
+            result = swarm(
+                port,
+                users,
+                min(args.senders, users),
+                args.rate,
+                args.duration,
+                args.size,
+                args.probes,
+                args.slow_read,
+            )
+        finally:
+            stop_server(process)
+        results.append(result)
+        print_result(result)
+    if args.json:
+        params = {k: v for k, v in vars(args).items() if k != "json"}
+        with open(args.json, "w") as file:
+            json.dump({"params": params, "results": results}, file, indent=2)
+
+
+def user_counts(text):
+    return [int(count) for count in text.split(",")]
+
+
+parser = argparse.ArgumentParser(description="Mini chat fan-out latency benchmark.")
+parser.add_argument(
+    "--users",
+    type=user_counts,
+    default=[10, 100, 1000, 10000],
+    help="comma-separated user counts to run with (default: 10,100,1000,10000)",
+)
+parser.add_argument(
+    "--senders",
+    type=int,
+    default=10,
+    help="bots sending messages (default: %(default)s)",
+)
+parser.add_argument(
+    "--rate",
+    type=float,
+    default=50.0,
+    help="messages per second, all senders together (default: %(default)s)",
+)
+parser.add_argument(
+    "--duration",
+    type=float,
+    default=5.0,
+    help="seconds of sending (default: %(default)s)",
+)
+parser.add_argument(
+    "--size",
+    type=int,
+    default=64,
+    help="bytes of a message, without its frame header (default: %(default)s)",
+)
+parser.add_argument(
+    "--probes",
+    type=int,
+    default=100,
+    help="bots measuring the latency of every message (default: %(default)s)",
+)
+parser.add_argument(
+    "--slow-read",
+    type=int,
+    default=1024,
+    help="bytes per second the slow reader reads, 0 for no slow reader "
+    "(default: %(default)s)",
+)
+parser.add_argument("--json", metavar="FILE", help="also save the results there")
+parser.add_argument(
+    "server_args",
+    nargs="*",
+    default=["--handshake-timeout", "600", "--catch-up", "0"],
+    help="arguments of server.py after the port, after '--' "
+    "(default: %(default)s)",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,609 @@
+#!/usr/bin/env python3
+
+# Benchmark regression suite for the servers of this repository. Every server
+# is started on a free loopback port and driven with the workloads of the
+# matrix below that its protocol supports:
+#   - churn: connections per second, each one opened, used for a single
+#     exchange and closed;
+#   - rps: small-message requests per second over persistent connections;
+#   - large: MB/s of large payloads;
+#   - fanout: chat messages delivered per second to many receivers;
+#   - compression: bytes saved by every response compression, against the
+#     server CPU time it costs.
+#
+# The results are stored as JSON along with the environment they were taken
+# in, and can be compared with a saved baseline. Any metric worse than the
+# baseline by more than the threshold is reported as a regression and makes
+# the exit status 1, unless the difference is within the noise floor of the
+# metric's unit.
+#
+# Usage: server-bench.py [--only PATTERN] [--duration S] [--save FILE]
+#                        [--baseline FILE] [--threshold PERCENT]
+
+import os
+import sys
+import json
+import time
+import socket
+import fnmatch
+import platform
+import argparse
+import datetime
+import tempfile
+import selectors
+import threading
+import subprocess
+import collections
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_DIR = os.path.join(ROOT, "tcp-examples", "app-cs-py")
+LOADGEN = os.path.join(ROOT, "tcp-examples", "tcp-multi-cs-py", "multiconn-client.py")
+CHAT_DIR = os.path.join(ROOT, "chat-apps", "mini-chat-py")
+
+sys.path.insert(0, APP_DIR)
+sys.path.insert(0, CHAT_DIR)
+import libframe  # noqa: E402
+import libheader  # noqa: E402
+import libmetrics  # noqa: E402
+
+HOST = "127.0.0.1"
+
+Server = collections.namedtuple("Server", "name script args workloads")
+
+# Server name -> how to start it ('{port}' is replaced by the port picked)
+# and the workloads it runs, with their parameters. Every workload is a
+# function of this module taking the port and the duration:
+SERVERS = [
+    Server(
+        "tcp-cs-py",
+        "tcp-examples/tcp-cs-py/server.py",
+        ["{port}", "--forever"],
+        # Accepts one connection at a time, with a backlog of 1:
+        {"churn": {"exchange": "welcome", "concurrency": 1}},
+    ),
+    Server(
+        "multiconn-server",
+        "tcp-examples/tcp-multi-cs-py/multiconn-server.py",
+        [HOST, "{port}", "--log-level", "WARNING", "--stats-interval", "0"],
+        {
+            "churn": {"exchange": "echo", "concurrency": 8},
+            "rps": {"protocol": "echo", "connections": 32, "size": "64"},
+            "large": {"protocol": "echo", "connections": 4, "size": "1048576"},
+        },
+    ),
+    Server(
+        "app-server",
+        "tcp-examples/app-cs-py/app-server.py",
+        [HOST, "{port}", "--log-level", "WARNING", "--stats-interval", "0"],
+        {
+            "churn": {"exchange": "app", "concurrency": 8},
+            "rps": {"protocol": "app", "connections": 32, "size": "8"},
+            "large": {"protocol": "app", "connections": 4, "size": "1048576"},
+        },
+    ),
+    Server(
+        "app-server-echo",
+        "tcp-examples/app-cs-py/app-server.py",
+        [
+            HOST,
+            "{port}",
+            "--log-level",
+            "WARNING",
+            "--stats-interval",
+            "0",
+            "--echo-binary",
+            "--compression",
+            "deflate,gzip,lzma",
+        ],
+        {"compression": {"codecs": ["deflate", "gzip", "lzma"], "size": 262144}},
+    ),
+    Server(
+        "mini-chat",
+        "chat-apps/mini-chat-py/server.py",
+        ["{port}"],
+        {
+            "churn": {"exchange": "chat", "concurrency": 8},
+            "fanout": {"receivers": 50, "size": 64},
+        },
+    ),
+]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_listening(port, process, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with {process.returncode}.")
+        try:
+            socket.create_connection((HOST, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Server not listening on port {port} after {timeout}s.")
+
+
+def start_server(server, log):
+    port = free_port()
+    script = os.path.join(ROOT, server.script)
+    args = [arg.format(port=port) for arg in server.args]
+    process = subprocess.Popen(
+        [sys.executable, script, *args],
+        cwd=os.path.dirname(script),
+        stdout=subprocess.DEVNULL,
+        stderr=log,
+    )
+    try:
+        wait_until_listening(port, process)
+    except Exception:
+        stop_server(process)
+        raise
+    return process, port
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def recv_exactly(sock, nbytes):
+    chunks = []
+    while nbytes:
+        chunk = sock.recv(min(nbytes, 65536))
+        if not chunk:
+            raise ConnectionError("Server closed the connection.")
+        chunks.append(chunk)
+        nbytes -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_until(sock, marker):
+    data = b""
+    while not data.endswith(marker):
+        chunk = sock.recv(1024)
+        if not chunk:
+            raise ConnectionError("Server closed the connection.")
+        data += chunk
+    return data
+
+
+def exchange_welcome(sock):
+    while sock.recv(1024):
+        pass
+
+
+def exchange_echo(sock):
+    message = b"x" * 64
+    sock.sendall(message)
+    recv_exactly(sock, len(message))
+
+
+def app_request(action, value):
+    content = libheader.json_encode({"action": action, "value": value}, "utf-8")
+    header = libheader.create_header(
+        content_length=len(content),
+        content_type="text/json",
+        content_encoding="utf-8",
+    )
+    return libheader.encode_json(header) + content
+
+
+APP_REQUEST = app_request("search", "morpheus")
+
+
+def recv_app_response(sock):
+    """Return the header and the (undecoded) body of one response."""
+    protoheader = recv_exactly(sock, libheader.PROTOHEADER.size)
+    version, header_len = libheader.decode_protoheader(protoheader)
+    header_bytes = recv_exactly(sock, header_len)
+    if version is None:
+        header = libheader.decode_json(header_bytes)
+    else:
+        header = libheader.decode_binary(header_bytes)
+    return header, recv_exactly(sock, header["content-length"])
+
+
+def exchange_app(sock):
+    sock.sendall(APP_REQUEST)
+    recv_app_response(sock)
+
+
+def chat_join(sock, username):
+    recv_until(sock, libframe.encode(b"_USERNAME:"))
+    sock.sendall(libframe.encode(username.encode("ascii")))
+
+
+def exchange_chat(sock):
+    chat_join(sock, f"churn{threading.get_ident()}")
+
+
+EXCHANGES = {
+    "welcome": exchange_welcome,
+    "echo": exchange_echo,
+    "app": exchange_app,
+    "chat": exchange_chat,
+}
+
+
+def churn(port, duration, exchange, concurrency):
+    """Open, use and close connections from 'concurrency' threads."""
+    exchange = EXCHANGES[exchange]
+    histogram = libmetrics.Histogram()
+    errors = collections.Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def worker():
+        local = libmetrics.Histogram()
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            try:
+                with socket.create_connection((HOST, port), timeout=5) as sock:
+                    exchange(sock)
+            except OSError as e:
+                with lock:
+                    errors[type(e).__name__] += 1
+                continue
+            local.record(time.perf_counter() - start)
+        with lock:
+            histogram.merge(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    return {
+        "connections_per_s": metric(histogram.count / elapsed, "connections/s"),
+        "p99_ms": metric(histogram.percentile(99) * 1e3, "ms", better="lower"),
+        "errors": metric(sum(errors.values()), "errors", better="lower"),
+    }
+
+
+def run_loadgen(port, duration, protocol, connections, size):
+    with tempfile.NamedTemporaryFile(suffix=".json") as output:
+        subprocess.run(
+            [
+                sys.executable,
+                LOADGEN,
+                HOST,
+                str(port),
+                str(connections),
+                "--protocol",
+                protocol,
+                "--size",
+                size,
+                "--duration",
+                str(duration),
+                "--ramp-up",
+                "0.5",
+                "--json",
+                output.name,
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        return json.load(output)
+
+
+def rps(port, duration, protocol, connections, size):
+    summary = run_loadgen(port, duration, protocol, connections, size)
+    return {
+        "requests_per_s": metric(summary["throughput"], "requests/s"),
+        "p99_ms": metric(summary["latency"]["p99"] * 1e3, "ms", better="lower"),
+        "errors": metric(sum(summary["errors"].values()), "errors", better="lower"),
+    }
+
+
+def large(port, duration, protocol, connections, size):
+    summary = run_loadgen(port, duration, protocol, connections, size)
+    return {
+        "mb_per_s": metric(summary["mb_in_per_s"], "MB/s"),
+        "errors": metric(sum(summary["errors"].values()), "errors", better="lower"),
+    }
+
+
+def fanout(port, duration, receivers, size):
+    """One chat client sends as fast as the server takes its messages, all
+    'receivers' (the sender included) must get every one of them. 'size' is
+    the size of a message, without its frame header."""
+    socks = []
+    for i in range(receivers):
+        sock = socket.create_connection((HOST, port), timeout=5)
+        chat_join(sock, f"fanout{i}")
+        socks.append(sock)
+    sel = selectors.DefaultSelector()
+    # Drop the join notices, then only the benchmark's messages arrive:
+    for sock in socks:
+        sock.setblocking(False)
+        sel.register(sock, selectors.EVENT_READ)
+    quiet_since = time.perf_counter()
+    while time.perf_counter() - quiet_since < 0.2:
+        for key, _ in sel.select(timeout=0.05):
+            key.fileobj.recv(65536)
+            quiet_since = time.perf_counter()
+
+    sender = socks[0]
+    message = libframe.encode(b"x" * size)
+    pending = bytearray()
+    sent_messages = 0
+    received = dict.fromkeys(socks, 0)
+    start = time.perf_counter()
+    send_until = start + duration
+    # Give up on the stragglers a while after the last message was sent:
+    deadline = send_until + max(10.0, duration)
+    sel.modify(sender, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    done = None
+    while time.perf_counter() < deadline:
+        for key, mask in sel.select(timeout=0.1):
+            sock = key.fileobj
+            if mask & selectors.EVENT_READ:
+                received[sock] += len(sock.recv(65536))
+            if mask & selectors.EVENT_WRITE:
+                if time.perf_counter() < send_until:
+                    while len(pending) < 65536:
+                        pending += message
+                        sent_messages += 1
+                if pending:
+                    try:
+                        del pending[: sock.send(pending)]
+                    except BlockingIOError:
+                        pass
+                elif time.perf_counter() >= send_until:
+                    sel.modify(sock, selectors.EVENT_READ)
+        if time.perf_counter() >= send_until and not pending:
+            expected = sent_messages * len(message)
+            if all(count >= expected for count in received.values()):
+                done = time.perf_counter()
+                break
+    sel.close()
+    for sock in socks:
+        sock.close()
+    if done is None:
+        raise RuntimeError("Not every receiver got every message in time.")
+    elapsed = done - start
+    return {
+        "deliveries_per_s": metric(sent_messages * receivers / elapsed, "messages/s"),
+        "mb_per_s": metric(sent_messages * receivers * size / elapsed / 1e6, "MB/s"),
+    }
+
+
+def server_cpu_time(port):
+    with socket.create_connection((HOST, port), timeout=5) as sock:
+        sock.sendall(app_request("stats", ""))
+        _, body = recv_app_response(sock)
+    return libheader.json_decode(body, "utf-8")["result"]["cpu_time"]
+
+
+def sample_payload(size):
+    # JSON records, about as compressible as typical API responses:
+    records = []
+    length = 0
+    while length < size:
+        i = len(records)
+        record = {"id": i, "name": f"user{i}", "score": i * 7919 % 1000, "ok": i % 3}
+        records.append(record)
+        length += len(libheader.json_encode(record, "utf-8")) + 2
+    return libheader.json_encode(records, "utf-8")[:size]
+
+
+def compression(port, duration, codecs, size):
+    """Have 'size' bytes of JSON echoed back uncompressed, then with every
+    compression in 'codecs', each for an equal share of the duration."""
+    payload = sample_payload(size)
+    results = {}
+    for codec in [None, *codecs]:
+        header = libheader.create_header(
+            content_length=len(payload),
+            content_type="binary/custom-client-binary-type",
+            content_encoding="binary",
+        )
+        header["accept-compression"] = [codec] if codec else []
+        request = libheader.encode_json(header) + payload
+        sent = wire_bytes = 0
+        cpu_before = server_cpu_time(port)
+        deadline = time.perf_counter() + duration / (len(codecs) + 1)
+        sock = None
+        try:
+            while time.perf_counter() < deadline:
+                if sock is None:
+                    sock = socket.create_connection((HOST, port), timeout=10)
+                sock.sendall(request)
+                header, body = recv_app_response(sock)
+                if header.get("content-compression") != codec:
+                    raise RuntimeError(f"Asked for {codec}, got {header}.")
+                sent += len(payload)
+                wire_bytes += len(body)
+                # The server's --max-requests was reached:
+                if header.get("connection") == "close":
+                    sock.close()
+                    sock = None
+        finally:
+            if sock is not None:
+                sock.close()
+        cpu = server_cpu_time(port) - cpu_before
+        name = codec or "none"
+        results[f"{name}_ratio"] = metric(sent / wire_bytes, "x")
+        results[f"{name}_cpu_ms_per_mb"] = metric(
+            cpu * 1e3 / (sent / 1e6), "ms/MB", better="lower"
+        )
+    return results
+
+
+WORKLOADS = {
+    "churn": churn,
+    "rps": rps,
+    "large": large,
+    "fanout": fanout,
+    "compression": compression,
+}
+
+
+# Differences up to these, in a metric's unit, are noise whatever their
+# percentage, e.g. a p99 of 0.14 ms turning 0.16 ms. Other units have none:
+NOISE_FLOOR = {"ms": 0.05, "ms/MB": 1.0}
+
+
+def metric(value, unit, better="higher"):
+    return {"value": value, "unit": unit, "better": better}
+
+
+def environment():
+    try:
+        commit = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "hostname": platform.node(),
+    }
+
+
+def run_suite(only, duration):
+    results = {}
+    for server in SERVERS:
+        for name in server.workloads:
+            if not any(fnmatch.fnmatch(f"{server.name}/{name}", p) for p in only):
+                continue
+            key = f"{server.name}/{name}"
+            print(f"{key} ...", flush=True)
+            # A fresh server for every workload, so that one can't skew the
+            # next (e.g. with connections it hasn't cleaned up yet):
+            params = server.workloads[name]
+            with tempfile.TemporaryFile() as log:
+                process = None
+                try:
+                    process, port = start_server(server, log)
+                    metrics = WORKLOADS[name](port, duration, **params)
+                except Exception as e:
+                    log.seek(0)
+                    tail = log.read()[-2000:].decode(errors="replace")
+                    print(f"  failed: {e!r}\n{tail}")
+                    results[key] = {"params": params, "error": repr(e)}
+                    continue
+                finally:
+                    if process is not None:
+                        stop_server(process)
+            results[key] = {"params": params, "metrics": metrics}
+            for metric_name, m in metrics.items():
+                print(f"  {metric_name:>22}: {m['value']:>12.2f} {m['unit']}")
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Print every metric next to its baseline value and return the
+    regressions."""
+    regressions = []
+    print(f"\nCompared with the baseline from {baseline['environment']['timestamp']}:")
+    for key, result in results.items():
+        old = baseline["results"].get(key, {}).get("metrics")
+        if old is None or "metrics" not in result:
+            continue
+        for name, m in result["metrics"].items():
+            if name not in old:
+                continue
+            old_value, value = old[name]["value"], m["value"]
+            if old_value:
+                change = (value - old_value) / old_value * 100
+            else:
+                change = 0.0 if value == old_value else float("inf")
+            if abs(value - old_value) <= NOISE_FLOOR.get(m["unit"], 0.0):
+                worse = False
+            elif m["better"] == "higher":
+                worse = change < -threshold
+            else:
+                worse = change > threshold
+            flag = "  REGRESSION" if worse else ""
+            print(
+                f"  {key + '/' + name:<40} {old_value:>12.2f} -> {value:>12.2f} "
+                f"{m['unit']} ({change:+.1f}%){flag}"
+            )
+            if worse:
+                regressions.append(f"{key}/{name}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server benchmark regression suite.")
+    parser.add_argument(
+        "--only",
+        action="append",
+        metavar="PATTERN",
+        help="run the 'server/workload' entries matching this glob, e.g. "
+        "'app-server/*' (repeatable, default: all)",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=3.0,
+        help="seconds every workload runs (default: 3)",
+    )
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument(
+        "--baseline", metavar="FILE", help="compare with the results saved in FILE"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="percentage by which a metric may be worse than the baseline "
+        "(default: 10)",
+    )
+    parser.add_argument(
+        "--list", action="store_true", help="list the matrix entries and exit"
+    )
+    args = parser.parse_args()
+
+    if args.list:
+        for server in SERVERS:
+            for name, params in server.workloads.items():
+                print(f"{server.name}/{name}: {params}")
+        return
+
+    report = {
+        "environment": environment(),
+        "duration": args.duration,
+        "results": run_suite(args.only or ["*"], args.duration),
+    }
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results saved to {args.save}")
+    failed = [key for key, result in report["results"].items() if "error" in result]
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(report["results"], baseline, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.threshold:g}%")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+    sys.exit(1 if regressions or failed else 0)
+
+
+if __name__ == "__main__":
+    main()
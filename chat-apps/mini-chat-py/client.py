@@ -1,6 +1,8 @@
 import socket
 import threading
 
+import libframe
+
 HOST = "127.0.0.1"
 PORT = 21216
 
@@ -16,12 +18,17 @@ def define_username():
     return username
 
 
-def receive_messages(c_sckt, usr):
+def receive_messages(c_sckt, usr, reader):
     while True:
         try:
-            message_rcvd = c_sckt.recv(1024).decode("ascii")
+            # One frame is one message, the prompt can't arrive glued to chat
+            # text:
+            message_rcvd = reader.recv(c_sckt)
+            if message_rcvd is None:
+                raise ConnectionError
+            message_rcvd = message_rcvd.decode("ascii")
             if message_rcvd == "_USERNAME:":
-                c_sckt.send(usr.encode("ascii"))
+                c_sckt.sendall(libframe.encode(usr.encode("ascii")))
             else:  #
                 print(message_rcvd)
         except:
@@ -34,9 +41,13 @@ def send_messages(c_sckt, username):
     while True:
         user_message = input()
 
-        final_message = "<" + username + ">" + ":: " + user_message
+        # Commands like "/join <room>" go to the server as they are:
+        if user_message.startswith("/"):
+            final_message = user_message
+        else:
+            final_message = "<" + username + ">" + ":: " + user_message
 
-        c_sckt.send(final_message.encode("ascii"))
+        c_sckt.sendall(libframe.encode(final_message.encode("ascii")))
 
 
 def main():
@@ -46,9 +57,12 @@ def main():
     client_socket.connect((HOST, PORT))
 
     print(f"CONNECTED TO SERVER {HOST} : {PORT}")
-    print(client_socket.recv(1024).decode())
+    reader = libframe.FrameReader()
+    print(reader.recv(client_socket).decode())
 
-    threading.Thread(target=receive_messages, args=(client_socket, username)).start()
+    threading.Thread(
+        target=receive_messages, args=(client_socket, username, reader)
+    ).start()
     threading.Thread(target=send_messages, args=(client_socket, username)).start()
 
 
@@ -0,0 +1,136 @@
+import os
+import struct
+import itertools
+import collections
+
+# Every chat message, in either direction, is one frame: its length as a
+# 4-byte big-endian unsigned integer, then that many bytes of ASCII text.
+# Messages can't merge or split on the way, however TCP segments them, and
+# the '_USERNAME:' prompt always arrives on its own:
+HEADER = struct.Struct(">I")
+# Buffers one sendmsg() call takes at most:
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+# Larger frames are refused, a client can't make the server buffer without
+# bounds:
+MAX_FRAME = 64 * 1024
+
+
+def encode(payload, max_frame=MAX_FRAME):
+    if len(payload) > max_frame:
+        raise ValueError(f"Frame of {len(payload)} bytes is too large.")
+    return HEADER.pack(len(payload)) + payload
+
+
+def frame_offsets(buffer, start=0, end=None):
+    """The offsets of the frames in 'buffer[start:end]', which must hold
+    whole frames only, e.g. a run passed on by a server."""
+    end = len(buffer) if end is None else end
+    offsets = []
+    while start < end:
+        offsets.append(start)
+        (length,) = HEADER.unpack_from(buffer, start)
+        start += HEADER.size + length
+    return offsets
+
+
+def send_queued(sock, outbox):
+    """Send the frames queued in the deque 'outbox', as many as the socket
+    takes, and return the number of bytes sent. They all go out with one
+    scatter-gather sendmsg() call (per IOV_MAX frames), without being joined
+    into one buffer first. A frame sent in part is left in 'outbox' as a
+    memoryview of the rest."""
+    total = 0
+    while outbox:
+        buffers = list(itertools.islice(outbox, IOV_MAX))
+        try:
+            sent = sock.sendmsg(buffers)
+        except BlockingIOError:
+            break
+        total += sent
+        if sent == sum(len(buffer) for buffer in buffers):
+            for _ in buffers:
+                outbox.popleft()
+            continue
+        # Partly sent, the socket's send buffer is full:
+        while sent >= len(outbox[0]):
+            sent -= len(outbox.popleft())
+        outbox[0] = memoryview(outbox[0])[sent:]
+        break
+    return total
+
+
+class FrameReader:
+    """Splits received bytes into frames. '.feed()' takes whatever recv()
+    returned and returns the payloads of the frames it completed, '.recv()'
+    reads from a blocking socket until a frame is complete."""
+
+    def __init__(self, max_frame=MAX_FRAME):
+        self.max_frame = max_frame
+        self._buffer = bytearray()
+        self._received = collections.deque()
+
+    def feed(self, data):
+        self._buffer += data
+        frames = []
+        offset = 0
+        for end in self._frame_ends():
+            frames.append(bytes(self._buffer[offset + HEADER.size : end]))
+            offset = end
+        # One deletion for all the frames completed, not one per frame:
+        del self._buffer[:offset]
+        return frames
+
+    def feed_runs(self, data, marker):
+        """For passing frames on as they are: like '.feed()', but return the
+        frames whole, header included, as (marked, frames) pairs. A frame
+        whose payload starts with the byte 'marker' comes on its own, with
+        'marked' True. Consecutive other frames come as one run, a single
+        bytes object holding all of them, however many there are."""
+        self._buffer += data
+        marker = marker[0]
+        runs = []
+        start = offset = 0
+        for end in self._frame_ends():
+            payload = offset + HEADER.size
+            if end > payload and self._buffer[payload] == marker:
+                if start < offset:
+                    runs.append((False, bytes(self._buffer[start:offset])))
+                runs.append((True, bytes(self._buffer[offset:end])))
+                start = end
+            offset = end
+        if start < offset:
+            runs.append((False, bytes(self._buffer[start:offset])))
+        del self._buffer[:offset]
+        return runs
+
+    def _frame_ends(self):
+        # The end offsets of the complete frames in the buffer:
+        offset = 0
+        while len(self._buffer) - offset >= HEADER.size:
+            (length,) = HEADER.unpack_from(self._buffer, offset)
+            if length > self.max_frame:
+                raise ValueError(f"Frame of {length} bytes is too large.")
+            end = offset + HEADER.size + length
+            if end > len(self._buffer):
+                return
+            yield end
+            offset = end
+
+    def recv(self, sock):
+        """Blocking: return the next frame's payload from 'sock', or None once
+        the connection is closed. Frames received along with it are kept for
+        the next calls."""
+        while not self._received:
+            data = sock.recv(4096)
+            if not data:
+                return None
+            self._received.extend(self.feed(data))
+        return self._received.popleft()
+
+
+def split_first(frames):
+    """Split a run of frames: return the payload of the first one, and the
+    frames after it."""
+    (length,) = HEADER.unpack_from(frames)
+    end = HEADER.size + length
+    return frames[HEADER.size : end], frames[end:]
@@ -0,0 +1,240 @@
+import os
+import mmap
+import array
+import struct
+import collections
+
+import libframe
+
+# A segment file starts with the offset its frames end at, written after the
+# frames themselves, so that a message is only part of the log once it is
+# complete. The rest of the file is zeros until frames are appended:
+SEGMENT_HEADER = struct.Struct(">Q")
+# A segment must take any run of frames a server passes on:
+MIN_SEGMENT_SIZE = 4 * libframe.MAX_FRAME
+
+
+class _Segment:
+    def __init__(self, path, size):
+        self.path = path
+        with open(path, "a+b") as file:
+            if os.fstat(file.fileno()).st_size < size:
+                file.truncate(size)
+            size = os.fstat(file.fileno()).st_size
+            # The mapping stays valid once the file is closed:
+            self.mmap = mmap.mmap(file.fileno(), size)
+        (self.end,) = SEGMENT_HEADER.unpack_from(self.mmap)
+        if not SEGMENT_HEADER.size <= self.end <= size:
+            # A new file, or a damaged one that is started over:
+            self.end = SEGMENT_HEADER.size
+        # Where every run of frames appended starts, to find the last
+        # messages without scanning the whole segment. A recovered segment
+        # gets one run per frame:
+        self.runs = array.array(
+            "L", libframe.frame_offsets(self.mmap, SEGMENT_HEADER.size, self.end)
+        )
+
+    def free(self):
+        return len(self.mmap) - self.end
+
+    def append(self, frames):
+        self.runs.append(self.end)
+        end = self.end + len(frames)
+        self.mmap[self.end : end] = frames
+        SEGMENT_HEADER.pack_into(self.mmap, 0, end)
+        self.end = end
+
+
+class RoomLog:
+    """The append-only log of a room's messages, in the directory given. It
+    is split in segment files of 'segment_size' bytes, each mapped into
+    memory, and only the last 'max_segments' are kept: the disk space and
+    the address space it uses are bounded, however much is said in the room.
+    The pages of the mappings are the page cache's, evicted as the system
+    needs memory.
+
+    Frames are appended as they are sent to clients, and '.tail()' returns
+    them as views of the mappings, to be sent without being copied."""
+
+    def __init__(self, directory, segment_size=1024 * 1024, max_segments=8):
+        _check_log_options(segment_size, max_segments)
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(
+            name
+            for name in os.listdir(directory)
+            if name.endswith(".log") and name[:-4].isdigit()
+        )
+        self._next = int(names[-1][:-4]) + 1 if names else 0
+        self.segments = collections.deque(
+            _Segment(os.path.join(directory, name), segment_size) for name in names
+        )
+        if not self.segments:
+            self._rotate()
+        self._trim()
+
+    def append(self, frames):
+        """Append a run of whole frames."""
+        if len(frames) > self.segments[-1].free():
+            if len(frames) > self.segment_size - SEGMENT_HEADER.size:
+                # Larger than any segment, one frame at a time then:
+                for start, end in _frame_spans(frames):
+                    self.append(frames[start:end])
+                return
+            self._rotate()
+        self.segments[-1].append(frames)
+
+    def tail(self, count):
+        """Return the last 'count' frames (fewer if the log holds fewer), as
+        memoryviews of the mappings, oldest first: one per segment."""
+        spans = []
+        for segment in reversed(self.segments):
+            if count <= 0:
+                break
+            start = segment.end
+            for run in reversed(segment.runs):
+                offsets = libframe.frame_offsets(segment.mmap, run, start)
+                if len(offsets) >= count:
+                    start = offsets[len(offsets) - count]
+                    count = 0
+                    break
+                count -= len(offsets)
+                start = run
+            if start < segment.end:
+                spans.append(memoryview(segment.mmap)[start : segment.end])
+        spans.reverse()
+        return spans
+
+    def _rotate(self):
+        path = os.path.join(self.directory, f"{self._next:08d}.log")
+        self._next += 1
+        self.segments.append(_Segment(path, self.segment_size))
+        self._trim()
+
+    def _trim(self):
+        while len(self.segments) > self.max_segments:
+            segment = self.segments.popleft()
+            os.unlink(segment.path)
+            # Not closed: views of it may still wait to be sent. The mapping
+            # goes once the last of them is released.
+
+    def close(self):
+        for segment in self.segments:
+            try:
+                segment.mmap.close()
+            except BufferError:
+                pass
+
+
+def _check_log_options(segment_size=1024 * 1024, max_segments=8):
+    if segment_size < MIN_SEGMENT_SIZE:
+        raise ValueError(f"Segment size {segment_size} is too small.")
+    if max_segments < 1:
+        raise ValueError(f"Max segments {max_segments} is less than 1.")
+
+
+def _frame_spans(frames):
+    offsets = libframe.frame_offsets(frames)
+    return zip(offsets, offsets[1:] + [len(frames)])
+
+
+class History:
+    """What was said in every room, for the users who join it later. The
+    newest runs of frames of a room are kept in memory, within 'ring_bytes'
+    per room, for a cheap catch-up. With a 'directory', every room also has
+    a RoomLog there, for larger backfills.
+
+    Rooms are named by clients, their logs are in directories named after
+    the hex of the room's name, never a path of the client's making."""
+
+    def __init__(
+        self, ring_bytes=64 * 1024, directory=None, max_open_logs=256, **log_options
+    ):
+        self.ring_bytes = ring_bytes
+        self.directory = directory
+        self.max_open_logs = max_open_logs
+        # Checked now, the logs are only opened once rooms have messages:
+        _check_log_options(**log_options)
+        self.log_options = log_options
+        self._rings = {}
+        # The logs opened, least recently used first. Beyond 'max_open_logs'
+        # the oldest is closed, and opened again when needed:
+        self._logs = collections.OrderedDict()
+
+    def record(self, room, frames):
+        ring = self._rings.get(room)
+        if ring is None:
+            ring = self._rings[room] = _Ring()
+        ring.append(frames, self.ring_bytes)
+        log = self._log(room)
+        if log is not None:
+            log.append(frames)
+
+    def recent(self, room, count):
+        """Return up to 'count' of the last frames of 'room', as buffers to
+        be sent in order: from memory if they are all there, else from the
+        log."""
+        ring = self._rings.get(room)
+        if ring is not None:
+            buffers, found = ring.tail(count)
+            if found == count:
+                return buffers
+        log = self._log(room)
+        if log is not None:
+            return log.tail(count)
+        return buffers if ring is not None else []
+
+    def forget(self, room):
+        """Drop the room's memory, e.g. once it has no members left. Its log
+        stays."""
+        self._rings.pop(room, None)
+
+    def _log(self, room):
+        if self.directory is None:
+            return None
+        log = self._logs.get(room)
+        if log is not None:
+            self._logs.move_to_end(room)
+            return log
+        path = os.path.join(self.directory, room.encode("utf-8").hex())
+        log = self._logs[room] = RoomLog(path, **self.log_options)
+        if len(self._logs) > self.max_open_logs:
+            self._logs.popitem(last=False)[1].close()
+        return log
+
+    def close(self):
+        for log in self._logs.values():
+            log.close()
+
+
+class _Ring:
+    # The newest runs of frames, oldest first, dropped from the front once
+    # they hold more than the byte budget (the newest run is always kept):
+    def __init__(self):
+        self.runs = collections.deque()
+        self.size = 0
+
+    def append(self, frames, max_bytes):
+        self.runs.append(frames)
+        self.size += len(frames)
+        while self.size > max_bytes and len(self.runs) > 1:
+            self.size -= len(self.runs.popleft())
+
+    def tail(self, count):
+        buffers = []
+        found = 0
+        if count <= 0:
+            return buffers, found
+        for run in reversed(self.runs):
+            offsets = libframe.frame_offsets(run)
+            if found + len(offsets) >= count:
+                start = offsets[len(offsets) - (count - found)]
+                buffers.append(memoryview(run)[start:])
+                found = count
+                break
+            buffers.append(run)
+            found += len(offsets)
+        buffers.reverse()
+        return buffers, found
@@ -0,0 +1,68 @@
+import socket
+
+import libframe
+
+# Chat server nodes share their rooms through relay.py. Every node keeps one
+# connection to the relay, and both sides exchange libframe frames whose
+# payload is an envelope: a header line "<kind> <room> <node>\n", then the
+# body. '<node>' is the id of the node the envelope comes from, the relay
+# passes envelopes on without rewriting them:
+#   - HELLO: first envelope of a node, room "-", no body;
+#   - JOIN, LEAVE: the user named in the body entered or left the room;
+#   - MSG: the body is a run of chat frames for the room's members.
+# The relay sends a MSG once to every other node with members in its room,
+# and presence changes to every other node.
+HELLO = b"HELLO"
+JOIN = b"JOIN"
+LEAVE = b"LEAVE"
+MSG = b"MSG"
+
+# A MSG carries all the chat frames of one read, more than one chat frame:
+MAX_FRAME = 1024 * 1024
+
+
+def encode(kind, room, node, body=b""):
+    header = b"%s %s %s\n" % (kind, room.encode("ascii"), node.encode("ascii"))
+    return libframe.encode(header + body, MAX_FRAME)
+
+
+def decode(payload):
+    """Return the (kind, room, node, body) of an envelope. ValueError if it
+    is malformed."""
+    header, newline, body = payload.partition(b"\n")
+    kind, room, node = header.decode("ascii").split(" ")
+    if not newline or not room or not node:
+        raise ValueError(f"Malformed envelope {header!r}.")
+    return kind.encode("ascii"), room, node, body
+
+
+def connect(address, timeout=None):
+    """Connect to a relay at 'address': "host:port" for TCP, anything else
+    is the path of a Unix socket."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        sock = socket.create_connection((host, int(port)), timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+def listen(address):
+    """The listening socket of a relay at 'address', see 'connect()'."""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit():
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, int(port)))
+    else:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(address)
+    sock.listen(socket.SOMAXCONN)
+    return sock
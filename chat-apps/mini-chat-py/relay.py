@@ -0,0 +1,223 @@
+import os
+import argparse
+import selectors
+import collections
+
+import librelay
+import libframe
+
+# Usage: relay.py [<host:port> | <unix socket path>]
+# Chat server nodes started with '--relay <address>' share their rooms
+# through this process, see librelay.
+
+sel = selectors.DefaultSelector()
+
+READ_CHUNK = 65536
+
+
+class Node:
+    """A connected chat server node. 'rooms' holds the users of the node by
+    room, as counters since usernames aren't unique."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.node_id = None
+        self.reader = libframe.FrameReader(librelay.MAX_FRAME)
+        self.rooms = collections.defaultdict(collections.Counter)
+        self.outbox = collections.deque()
+        self.queued = 0
+        self.events = selectors.EVENT_READ
+
+
+nodes = set()
+# The nodes with members in each room, the only ones its messages go to:
+subscribers = collections.defaultdict(set)
+
+
+def accept(listen_socket):
+    sock, _ = listen_socket.accept()
+    sock.setblocking(False)
+    node = Node(sock)
+    nodes.add(node)
+    sel.register(sock, node.events, data=node)
+
+
+def remove_node(node):
+    if node.sock is None:
+        return
+    print(f"_NODE {node.node_id} DISCONNECTED")
+    nodes.discard(node)
+    slow.pop(node, None)
+    sel.unregister(node.sock)
+    node.sock.close()
+    node.sock = None
+    # Its users have left, as far as the other nodes are concerned:
+    for room, users in node.rooms.items():
+        subscribers[room].discard(node)
+        if not subscribers[room]:
+            del subscribers[room]
+        for username, count in users.items():
+            leave = librelay.encode(librelay.LEAVE, room, node.node_id, username)
+            for _ in range(count):
+                publish(node, leave)
+
+
+def read(node):
+    try:
+        data = node.sock.recv(READ_CHUNK)
+        if not data:
+            raise ConnectionError
+        payloads = node.reader.feed(data)
+    except BlockingIOError:
+        return
+    except (OSError, ValueError):
+        remove_node(node)
+        return
+    for payload in payloads:
+        try:
+            kind, room, node_id, body = librelay.decode(payload)
+        except ValueError:
+            remove_node(node)
+            return
+        frame = libframe.encode(payload, librelay.MAX_FRAME)
+        handle(node, kind, room, node_id, body, frame)
+        if node.sock is None:
+            return
+
+
+def handle(node, kind, room, node_id, body, frame):
+    if kind == librelay.HELLO:
+        node.node_id = node_id
+        print(f"_NODE {node_id} CONNECTED")
+        # Catch the node up on who is where on the other nodes:
+        for other in nodes:
+            if other is node or other.node_id is None:
+                continue
+            for other_room, users in other.rooms.items():
+                for username, count in users.items():
+                    join = librelay.encode(
+                        librelay.JOIN, other_room, other.node_id, username
+                    )
+                    for _ in range(count):
+                        queue(node, join)
+    elif node.node_id is None:
+        # Anything before the HELLO:
+        remove_node(node)
+    elif kind == librelay.JOIN:
+        node.rooms[room][body] += 1
+        subscribers[room].add(node)
+        publish(node, frame)
+    elif kind == librelay.LEAVE:
+        users = node.rooms.get(room)
+        if users is None or not users[body]:
+            return
+        users[body] -= 1
+        if not +users:
+            del node.rooms[room]
+            subscribers[room].discard(node)
+            if not subscribers[room]:
+                del subscribers[room]
+        publish(node, frame)
+    elif kind == librelay.MSG:
+        # Once per node with members in the room, however many they are:
+        for other in subscribers.get(room, ()):
+            if other is not node:
+                queue(other, frame)
+
+
+def publish(origin, frame):
+    for node in nodes:
+        if node is not origin and node.node_id is not None:
+            queue(node, frame)
+
+
+def queue(node, frame):
+    if node in slow:
+        # Removed once the frames of this iteration are queued:
+        return
+    if node.queued + len(frame) > args.max_queue:
+        # The node fell too far behind, it reconnects and starts over:
+        print(f"_DISCONNECTING SLOW NODE {node.node_id}")
+        slow[node] = None
+        return
+    node.outbox.append(frame)
+    node.queued += len(frame)
+    unflushed[node] = None
+
+
+# Nodes with frames queued during this iteration of the loop, and the ones
+# that fell too far behind:
+unflushed = {}
+slow = {}
+
+
+def flush(node):
+    try:
+        node.queued -= libframe.send_queued(node.sock, node.outbox)
+    except OSError:
+        return False
+    events = selectors.EVENT_READ
+    if node.outbox:
+        events |= selectors.EVENT_WRITE
+    if events != node.events:
+        node.events = events
+        sel.modify(node.sock, events, data=node)
+    return True
+
+
+def flush_unflushed():
+    while unflushed or slow:
+        while slow:
+            remove_node(next(iter(slow)))
+        batch = list(unflushed)
+        unflushed.clear()
+        for node in batch:
+            if node.sock is not None and not flush(node):
+                remove_node(node)
+
+
+def main():
+    if ":" not in args.address and os.path.exists(args.address):
+        # A socket file left behind by a previous run:
+        os.unlink(args.address)
+    listen_socket = librelay.listen(args.address)
+    listen_socket.setblocking(False)
+    sel.register(listen_socket, selectors.EVENT_READ, data=None)
+    print(f"_RELAY RUNNING ON {args.address}")
+    try:
+        while True:
+            for key, mask in sel.select():
+                if key.data is None:
+                    try:
+                        accept(key.fileobj)
+                    except OSError:
+                        pass
+                    continue
+                node = key.data
+                if node.sock is None or node in slow:
+                    continue
+                if mask & selectors.EVENT_WRITE and not flush(node):
+                    remove_node(node)
+                    continue
+                if mask & selectors.EVENT_READ:
+                    read(node)
+            flush_unflushed()
+    except KeyboardInterrupt:
+        print("_RELAY STOPPED")
+    finally:
+        sel.close()
+
+
+parser = argparse.ArgumentParser(description="Mini chat relay.")
+parser.add_argument("address", nargs="?", default="127.0.0.1:21217")
+parser.add_argument(
+    "--max-queue",
+    type=int,
+    default=64 * 1024 * 1024,
+    help="bytes a node may fall behind by before it is disconnected "
+    "(default: %(default)s)",
+)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    main()
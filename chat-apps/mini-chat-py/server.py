@@ -1,68 +1,621 @@
+import time
 import socket
-import threading
+import argparse
+import resource
+import selectors
+import collections
+
+import libframe
+import librelay
+import libhistory
 
 HOST = "127.0.0.1"
-PORT = 21216
 
-client_connections = []
-client_usernames = []
+# One selector loop serves every client, there's no thread per client. The
+# default selector is epoll on Linux, which isn't limited to 1024 sockets:
+sel = selectors.DefaultSelector()
 
+# The room every client is in after picking a username, it's never removed:
+LOBBY = "lobby"
+MAX_ROOM_NAME = 32
+MAX_USERNAME = 32
+# Most messages '/history <count>' sends back:
+MAX_BACKFILL = 1000
 
-def remove_client(client_connection, client_username):
-    client_connections.remove(client_connection)
-    client_connection.close()
-    client_usernames.remove(client_username)
+# Bytes read with one recv() call, as many frames as it holds:
+READ_CHUNK = 65536
+# Connections accepted at most per iteration of the loop, the others wait
+# for the next one:
+ACCEPT_BATCH = 256
+# Seconds between attempts to (re)connect to the relay, and the bytes that
+# may wait for it before the connection is given up as stalled:
+RELAY_RETRY = 5.0
+RELAY_MAX_QUEUE = 64 * 1024 * 1024
 
 
-def broadcast_message(msg):
-    for client in client_connections:
-        client.send(msg)
+class Client:
+    """A connected client. 'username' is None until it answered the
+    '_USERNAME:' prompt, and 'room' is None until then too. Frames for it
+    wait in 'outbox' until its socket takes them, 'queued' counts their
+    bytes."""
 
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.username = None
+        self.room = None
+        self.reader = libframe.FrameReader()
+        self.connected_at = time.monotonic()
+        self.outbox = collections.deque()
+        self.queued = 0
+        self.dropped = 0
+        self.events = selectors.EVENT_READ
 
-def handle_client(c_sckt):
-    while True:
-        try:
-            message_rcvd = c_sckt.recv(1024)
-            if not message_rcvd:
-                break
 
-            broadcast_message(message_rcvd)
-        except:
-            client_username = client_usernames[client_connections.index(c_sckt)]
+class Registry:
+    """The connected clients by socket, and the rooms by name, each the set
+    of its members. A client is in one room at a time, and a message goes to
+    the members of its sender's room only, so the cost of a broadcast grows
+    with the room rather than with all the users. Every change is O(1).
+    'remote' counts the users of the other nodes by room, as "user@node",
+    when the server is federated through a relay.
 
-            remove_client(c_sckt, client_username)
+    Only the selector loop's thread uses it, so there's no lock."""
 
-            broadcast_message(f"_{client_username} has left the chat!".encode("ascii"))
+    def __init__(self):
+        self.clients = {}
+        self.rooms = {LOBBY: set()}
+        self.remote = collections.defaultdict(collections.Counter)
 
-            break
+    def add(self, client):
+        self.clients[client.sock] = client
 
+    def remove(self, client):
+        self.leave(client)
+        del self.clients[client.sock]
 
-def main():
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(10)
+    def join(self, client, room):
+        self.leave(client)
+        self.rooms.setdefault(room, set()).add(client)
+        client.room = room
 
-    print(f"_SERVER RUNNING ON {HOST} : {PORT}")
+    def leave(self, client):
+        if client.room is None:
+            return
+        members = self.rooms[client.room]
+        members.discard(client)
+        # Rooms exist as long as they have members:
+        if not members and client.room != LOBBY:
+            del self.rooms[client.room]
+        client.room = None
 
-    while True:
-        client_socket, client_address = server_socket.accept()
-        print(f"_CONNECTION ESTABLISHED WITH {client_address[0]} : {client_address[1]}")
+    def members(self, room):
+        return self.rooms.get(room, ())
+
+    def names(self, room):
+        """The usernames in 'room', those of other nodes as "user@node"."""
+        names = [member.username for member in self.members(room)]
+        if room in self.remote:
+            names += self.remote[room].elements()
+        return names
+
+    def sizes(self):
+        """(room, number of users) of every room, on any node."""
+        sizes = {room: len(members) for room, members in self.rooms.items()}
+        for room, users in self.remote.items():
+            sizes[room] = sizes.get(room, 0) + users.total()
+        return sizes.items()
+
+    def add_remote(self, room, name):
+        self.remote[room][name] += 1
 
-        client_socket.sendall("_WELCOME TO THE CHAT SERVER!\n".encode("ascii"))
+    def remove_remote(self, room, name):
+        users = self.remote.get(room)
+        if users is None or not users[name]:
+            return
+        users[name] -= 1
+        if not +users:
+            del self.remote[room]
 
-        client_socket.send("_USERNAME:".encode("ascii"))
-        client_username = client_socket.recv(1024).decode("ascii")
 
-        client_connections.append(client_socket)
-        client_usernames.append(client_username)
+class RelayLink:
+    """The connection of a federated server to relay.py, see librelay.
+    Frames for the relay wait in 'outbox' like those for a client."""
+
+    def __init__(self, address, node_id):
+        self.address = address
+        self.node_id = node_id
+        self.sock = None
+        self.reader = None
+        self.outbox = collections.deque()
+        self.queued = 0
+        self.events = selectors.EVENT_READ
+        self.retry_at = 0.0
+
+
+registry = Registry()
+# The clients still in the username handshake by socket, oldest first, so
+# that expired ones are found without scanning all the clients:
+handshakes = collections.OrderedDict()
+# Clients that got frames queued during this iteration of the loop, in
+# order. They are flushed once it's done, each with a single sendmsg() for
+# all the messages of the iteration, instead of one send() per message:
+unflushed = {}
+# Clients that fell too far behind, removed by 'flush_unflushed()' rather
+# than where it was noticed: removing one broadcasts its leaving, which can
+# push more of them over the limit, and removing those right away would nest
+# one call deeper per client:
+slow = {}
+# The RelayLink of a federated server, None for a standalone one:
+relay = None
+# What was said in the rooms, see libhistory.History:
+history = None
+
+
+def accept(server_socket):
+    # Every connection waiting, not one per iteration of the loop: a crowd
+    # connecting at once then joins in a few iterations, and the notices of
+    # its joins go out with a few flushes rather than one each:
+    for _ in range(ACCEPT_BATCH):
+        try:
+            client_socket, client_address = server_socket.accept()
+        except BlockingIOError:
+            return
+        print(f"_CONNECTION ESTABLISHED WITH {client_address[0]} : {client_address[1]}")
+        client_socket.setblocking(False)
+        client = Client(client_socket, client_address)
+        registry.add(client)
+        handshakes[client_socket] = client
+        sel.register(client_socket, client.events, data=client)
+        # The username is asked for without waiting for it, the answer is
+        # handled like any other read:
+        reply(client, "_WELCOME TO THE CHAT SERVER!\n")
+        reply(client, "_USERNAME:")
+
 
+def remove_client(client):
+    if client.sock is None:
+        # Already removed, e.g. a slow consumer that also failed a send:
+        return
+    slow.pop(client, None)
+    room = client.room
+    registry.remove(client)
+    if room is not None:
+        relay_send(librelay.LEAVE, room, client.username.encode("ascii"))
+        forget_if_empty(room)
+    handshakes.pop(client.sock, None)
+    sel.unregister(client.sock)
+    client.sock.close()
+    client.sock = None
+    client.outbox.clear()
+    client.queued = 0
+    if room is not None:
         broadcast_message(
-            f"_USER: {client_username} has joined the chat!".encode("ascii")
+            f"_{client.username} has left the chat!".encode("ascii"), room
         )
 
-        threading.Thread(target=handle_client, args=(client_socket,)).start()
 
+def read(client):
+    try:
+        data = client.sock.recv(READ_CHUNK)
+        # No data received, the client has left (or its connection broke):
+        if not data:
+            raise ConnectionError
+        # Commands come on their own, chat messages as runs of frames:
+        runs = client.reader.feed_runs(data, b"/")
+    except BlockingIOError:
+        return
+    except (OSError, ValueError):
+        # Also for a frame that is too large:
+        remove_client(client)
+        return
+    for marked, frames in runs:
+        if client.sock is None or client in slow:
+            # Removed, or about to be as a slow consumer of a broadcast:
+            return
+        if client.username is None:
+            # The first frame is the username, whatever it starts with:
+            message_rcvd, frames = libframe.split_first(frames)
+            handshake(client, message_rcvd)
+            if not frames or client.sock is None:
+                continue
+        if marked:
+            command(client, frames[libframe.HEADER.size :])
+        else:
+            # The frames are passed on as they were received, one broadcast
+            # for the whole run rather than one per message:
+            broadcast_frames(frames, client.room)
+
+
+def handshake(client, message_rcvd):
+    try:
+        client_username = message_rcvd.decode("ascii")
+    except UnicodeDecodeError:
+        client_username = ""
+    del handshakes[client.sock]
+    if not client_username or len(client_username) > MAX_USERNAME:
+        remove_client(client)
+        return
+    client.username = client_username
+    registry.join(client, LOBBY)
+    relay_send(librelay.JOIN, LOBBY, message_rcvd)
+    catch_up(client, LOBBY, args.catch_up)
+    if client.sock is None:
+        return
+    broadcast_message(
+        f"_USER: {client_username} has joined the chat!".encode("ascii"), LOBBY
+    )
+
+
+def command(client, message_rcvd):
+    # Commands are sent on their own, e.g. "/join games", and answered to
+    # the client that sent them:
+    try:
+        name, *params = message_rcvd.decode("ascii").split()
+    except (UnicodeDecodeError, ValueError):
+        name, params = "/", []
+    if name == "/join" and len(params) == 1 and len(params[0]) <= MAX_ROOM_NAME:
+        change_room(client, params[0])
+    elif name == "/leave" and not params:
+        change_room(client, LOBBY)
+    elif name == "/rooms" and not params:
+        rooms = ", ".join(f"{room} ({size})" for room, size in registry.sizes())
+        reply(client, f"_ROOMS: {rooms}")
+    elif name == "/history" and len(params) == 1 and params[0].isdigit():
+        catch_up(client, client.room, min(int(params[0]), MAX_BACKFILL))
+    elif name == "/who" and not params:
+        reply(client, f"_IN {client.room}: {', '.join(registry.names(client.room))}")
+    else:
+        reply(
+            client,
+            f"_COMMANDS: /join <room> (at most {MAX_ROOM_NAME} characters), "
+            f"/leave, /rooms, /who, /history <count> (at most {MAX_BACKFILL})",
+        )
+
+
+def change_room(client, room):
+    if room == client.room:
+        return
+    previous = client.room
+    registry.join(client, room)
+    forget_if_empty(previous)
+    username = client.username.encode("ascii")
+    relay_send(librelay.LEAVE, previous, username)
+    relay_send(librelay.JOIN, room, username)
+    broadcast_message(
+        f"_{client.username} has left for {room}!".encode("ascii"), previous
+    )
+    catch_up(client, room, args.catch_up)
+    if client.sock is None:
+        return
+    broadcast_message(
+        f"_USER: {client.username} has joined {room}!".encode("ascii"), room
+    )
+
+
+def catch_up(client, room, count):
+    # The last messages of the room, straight from the history's buffers:
+    # memory, or the mapped log for larger backfills:
+    for buffer in history.recent(room, count):
+        if not send(client, buffer):
+            remove_client(client)
+            return
+
+
+def forget_if_empty(room):
+    # Rooms without local members keep their log, not their memory:
+    if room not in registry.rooms:
+        history.forget(room)
+
+
+def reply(client, text):
+    if not send(client, libframe.encode(text.encode("ascii"))):
+        remove_client(client)
+
+
+def send(client, frame):
+    """Queue 'frame' (or a run of frames) for 'client', it's sent by
+    'flush_unflushed()' or on the next write event. Return False if the
+    client fell too far behind and the slow consumer policy is
+    'disconnect': it is in 'slow' then, to be removed."""
+    if client in slow:
+        return False
+    if client.queued + len(frame) > args.max_queue:
+        if args.slow_policy == "disconnect":
+            print(f"_DISCONNECTING SLOW CLIENT {client.addr[0]} : {client.addr[1]}")
+            slow[client] = None
+            return False
+        # 'drop': the client misses this message, but never half of one:
+        client.dropped += 1
+        return True
+    client.outbox.append(frame)
+    client.queued += len(frame)
+    # A client waiting for a write event is flushed by it:
+    if not client.events & selectors.EVENT_WRITE:
+        unflushed[client] = None
+    return True
+
+
+def flush(client):
+    """Send the client's queued frames, as many as its socket takes. Return
+    False if its connection broke."""
+    try:
+        client.queued -= libframe.send_queued(client.sock, client.outbox)
+    except OSError:
+        return False
+    update_events(client)
+    return True
+
+
+def flush_unflushed():
+    # Removing a client that failed broadcasts its leaving, which queues more
+    # frames (and may make more clients slow), so this goes on until there
+    # are none left:
+    while unflushed or slow:
+        while slow:
+            remove_client(next(iter(slow)))
+        batch = list(unflushed)
+        unflushed.clear()
+        for client in batch:
+            if client.sock is not None and not flush(client):
+                if client is relay:
+                    relay_lost()
+                else:
+                    remove_client(client)
+
+
+def update_events(client):
+    # Write events only while frames are waiting, an idle socket is always
+    # writable:
+    events = selectors.EVENT_READ
+    if client.outbox:
+        events |= selectors.EVENT_WRITE
+    if events != client.events:
+        client.events = events
+        sel.modify(client.sock, events, data=client)
+
+
+def broadcast_message(msg, room):
+    broadcast_frames(libframe.encode(msg), room)
+
+
+def broadcast_frames(frames, room):
+    deliver_frames(frames, room)
+    # The other nodes get them once each, through the relay:
+    relay_send(librelay.MSG, room, frames)
+
+
+def deliver_frames(frames, room):
+    # Only to the local members of 'room'. The frames are built once and
+    # shared by every outbox. A stalled reader only grows its own outbox, the
+    # others get them with the next flush. Clients that fall too far behind
+    # are removed by 'flush_unflushed()', which broadcasts their leaving in
+    # turn:
+    if room in registry.rooms:
+        history.record(room, frames)
+    for client in registry.members(room):
+        send(client, frames)
+
+
+def relay_send(kind, room, body):
+    if relay is None or relay.sock is None:
+        return
+    frame = librelay.encode(kind, room, relay.node_id, body)
+    if relay.queued + len(frame) > RELAY_MAX_QUEUE:
+        relay_lost()
+        return
+    relay.outbox.append(frame)
+    relay.queued += len(frame)
+    if not relay.events & selectors.EVENT_WRITE:
+        unflushed[relay] = None
+
+
+def relay_connect(now):
+    if relay.sock is not None or now < relay.retry_at:
+        return
+    relay.retry_at = now + RELAY_RETRY
+    try:
+        sock = librelay.connect(relay.address, timeout=1)
+    except OSError as e:
+        print(f"_RELAY {relay.address} UNREACHABLE: {e}")
+        return
+    print(f"_CONNECTED TO RELAY {relay.address} AS {relay.node_id}")
+    sock.setblocking(False)
+    relay.sock = sock
+    relay.reader = libframe.FrameReader(librelay.MAX_FRAME)
+    relay.events = selectors.EVENT_READ
+    sel.register(sock, relay.events, data=relay)
+    # The relay learns who is where on this node, and replies with the users
+    # of the other nodes:
+    relay_send(librelay.HELLO, "-", b"")
+    for room, members in registry.rooms.items():
+        for member in members:
+            relay_send(librelay.JOIN, room, member.username.encode("ascii"))
+
+
+def relay_lost():
+    if relay.sock is None:
+        return
+    print(f"_LOST RELAY {relay.address}")
+    sel.unregister(relay.sock)
+    relay.sock.close()
+    relay.sock = None
+    relay.outbox.clear()
+    relay.queued = 0
+    # Whoever was on the other nodes is unknown until the relay is back:
+    registry.remote.clear()
+
+
+def relay_read():
+    try:
+        data = relay.sock.recv(READ_CHUNK)
+        if not data:
+            raise ConnectionError
+        payloads = relay.reader.feed(data)
+        envelopes = [librelay.decode(payload) for payload in payloads]
+    except BlockingIOError:
+        return
+    except (OSError, ValueError):
+        relay_lost()
+        return
+    for kind, room, node_id, body in envelopes:
+        if kind == librelay.MSG:
+            # Chat frames of a remote user, for the local members only:
+            deliver_frames(body, room)
+        elif kind == librelay.JOIN:
+            registry.add_remote(room, f"{body.decode('ascii')}@{node_id}")
+        elif kind == librelay.LEAVE:
+            registry.remove_remote(room, f"{body.decode('ascii')}@{node_id}")
+
+
+def expire_handshakes(now):
+    while handshakes:
+        client = next(iter(handshakes.values()))
+        if now - client.connected_at < args.handshake_timeout:
+            break
+        # Never picked a username:
+        remove_client(client)
+
+
+def raise_fd_limit():
+    # Every client is a file descriptor, and the usual soft limit of 1024
+    # would refuse connections long before the loop runs out of steam:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def main():
+    global relay, history
+    raise_fd_limit()
+    history = libhistory.History(
+        args.history_memory,
+        args.history_dir,
+        segment_size=args.segment_size,
+        max_segments=args.max_segments,
+    )
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((HOST, args.port))
+    # Many clients may connect at once, e.g. when a benchmark starts:
+    server_socket.listen(socket.SOMAXCONN)
+    server_socket.setblocking(False)
+    sel.register(server_socket, selectors.EVENT_READ, data=None)
+
+    print(f"_SERVER RUNNING ON {HOST} : {args.port}")
+    if args.relay is not None:
+        relay = RelayLink(args.relay, args.node_id)
+
+    try:
+        while True:
+            for key, mask in sel.select(timeout=1):
+                if key.data is None:
+                    try:
+                        accept(key.fileobj)
+                    except OSError:
+                        # Gone already, or out of file descriptors:
+                        pass
+                    continue
+                client = key.data
+                if client.sock is None:
+                    # Removed earlier in this iteration:
+                    continue
+                if client is relay:
+                    if mask & selectors.EVENT_WRITE and not flush(relay):
+                        relay_lost()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        relay_read()
+                    continue
+                if mask & selectors.EVENT_WRITE and not flush(client):
+                    remove_client(client)
+                    continue
+                if mask & selectors.EVENT_READ and client.sock is not None:
+                    read(client)
+            if relay is not None:
+                relay_connect(time.monotonic())
+            flush_unflushed()
+            expire_handshakes(time.monotonic())
+    except KeyboardInterrupt:
+        print("_SERVER STOPPED")
+    finally:
+        sel.close()
+        history.close()
+
+
+parser = argparse.ArgumentParser(description="Mini chat server.")
+parser.add_argument("port", nargs="?", type=int, default=21216)
+parser.add_argument(
+    "--max-queue",
+    type=int,
+    default=1024 * 1024,
+    help="bytes of messages a client may fall behind by (default: %(default)s)",
+)
+parser.add_argument(
+    "--slow-policy",
+    choices=("disconnect", "drop"),
+    default="disconnect",
+    help="what happens to a client beyond --max-queue: it is disconnected, or "
+    "misses messages until it catches up (default: %(default)s)",
+)
+parser.add_argument(
+    "--handshake-timeout",
+    type=float,
+    default=30.0,
+    help="seconds a client has to pick a username (default: %(default)s)",
+)
+parser.add_argument(
+    "--relay",
+    metavar="ADDRESS",
+    help="federate with the other nodes of relay.py at ADDRESS, host:port or "
+    "the path of a Unix socket",
+)
+parser.add_argument(
+    "--node-id",
+    help="the name of this node for the others (default: host:port)",
+)
+parser.add_argument(
+    "--catch-up",
+    type=int,
+    default=20,
+    help="messages of a room sent to the users joining it (default: %(default)s)",
+)
+parser.add_argument(
+    "--history-memory",
+    type=int,
+    default=64 * 1024,
+    help="bytes of the newest messages kept in memory per room, for the "
+    "catch-up (default: %(default)s)",
+)
+parser.add_argument(
+    "--history-dir",
+    help="keep an append-only log of every room in this directory, for "
+    "'/history' backfills and across restarts",
+)
+parser.add_argument(
+    "--segment-size",
+    type=int,
+    default=1024 * 1024,
+    help="bytes of a log segment file (default: %(default)s)",
+)
+parser.add_argument(
+    "--max-segments",
+    type=int,
+    default=8,
+    help="segments kept per room, older ones are deleted (default: %(default)s)",
+)
 
 # call the main function if this script is being run directly:
 if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.node_id is None:
+        args.node_id = f"{HOST}:{args.port}"
+    elif not args.node_id.isascii() or not args.node_id.isprintable() or (
+        " " in args.node_id
+    ):
+        parser.error("--node-id must be printable ASCII without spaces")
+    if args.segment_size < libhistory.MIN_SEGMENT_SIZE:
+        parser.error(f"--segment-size must be at least {libhistory.MIN_SEGMENT_SIZE}")
+    if args.max_segments < 1:
+        parser.error("--max-segments must be at least 1")
     main()
@@ -1,5 +1,107 @@
+#!/usr/bin/env python3
+
+# Resolves host names with the app-cs-py resolver (libresolver): IPv4 and
+# IPv6 addresses, all the names in parallel, each one looked up once however
+# often it is given.
+#
+# Usage: resolvinghost.py [<hostname> ...] [--port PORT] [--hosts FILE]
+#        resolvinghost.py --check
+
+import os
+import sys
+import time
 import socket
+import argparse
+import tempfile
+
+sys.path.insert(
+    0,
+    os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), "..", "tcp-examples", "app-cs-py"
+    ),
+)
+import libresolver  # noqa: E402
+
+parser = argparse.ArgumentParser(description="Resolve host names.")
+parser.add_argument("hostnames", nargs="*", default=["www.google.com"])
+parser.add_argument("--port", type=int, default=443)
+parser.add_argument(
+    "--hosts",
+    metavar="FILE",
+    help="resolve from this file, in the /etc/hosts format, instead of the "
+    "system's resolver",
+)
+parser.add_argument(
+    "--check",
+    action="store_true",
+    help="check the hosts file resolver against a temporary file, and exit",
+)
+args = parser.parse_args()
+
+
+def check_hosts_file():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "hosts")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write(
+                "# Comment\n"
+                "10.0.0.1 server.test alias.test  # Trailing comment\n"
+                "fd00::1 server.test\n"
+            )
+        hosts_file = libresolver.HostsFile(path)
+        resolver = libresolver.Resolver(getaddrinfo=hosts_file.getaddrinfo)
+
+        def addresses(host, family=socket.AF_UNSPEC):
+            resolver.invalidate()
+            return [sockaddr[0] for *_, sockaddr in resolver.resolve(host, 80, family)]
+
+        checks = [
+            ("name, in file order", addresses("server.test"), ["10.0.0.1", "fd00::1"]),
+            ("alias", addresses("alias.test"), ["10.0.0.1"]),
+            ("any case", addresses("SERVER.test"), ["10.0.0.1", "fd00::1"]),
+            ("IPv6 only", addresses("server.test", socket.AF_INET6), ["fd00::1"]),
+            ("numeric address", addresses("192.0.2.7"), ["192.0.2.7"]),
+        ]
+        try:
+            addresses("missing.test")
+        except socket.gaierror:
+            checks.append(("missing name", "socket.gaierror", "socket.gaierror"))
+        else:
+            checks.append(("missing name", "resolved", "socket.gaierror"))
+        # Rewritten, the file is read again. The new mtime is set explicitly,
+        # a rewrite in the same clock tick might not change it:
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("10.0.0.2 server.test\n")
+        mtime = os.stat(path).st_mtime_ns + 1_000_000_000
+        os.utime(path, ns=(mtime, mtime))
+        checks.append(("file changed", addresses("server.test"), ["10.0.0.2"]))
+        resolver.close()
+    failed = 0
+    for name, got, expected in checks:
+        if got == expected:
+            print(f"ok: {name}")
+        else:
+            failed += 1
+            print(f"FAILED: {name}: {got!r}, expected {expected!r}")
+    return failed
+
+
+if args.check:
+    sys.exit(1 if check_hosts_file() else 0)
 
-hostname = "www.google.com"
-ip_addr = socket.gethostbyname(hostname)
-print(ip_addr)
+if args.hosts:
+    hosts_file = libresolver.HostsFile(args.hosts)
+    resolver = libresolver.Resolver(getaddrinfo=hosts_file.getaddrinfo)
+else:
+    resolver = libresolver.Resolver()
+start = time.perf_counter()
+results = resolver.resolve_many(args.hostnames, args.port)
+elapsed = time.perf_counter() - start
+for hostname, result in results.items():
+    if isinstance(result, OSError):
+        print(f"{hostname}: {result}")
+        continue
+    addresses = dict.fromkeys(sockaddr[0] for *_, sockaddr in result)
+    print(f"{hostname}: {', '.join(addresses)}")
+print(f"{len(results)} name(s) in {elapsed * 1e3:.1f} ms, {resolver.stats()}")
+resolver.close()
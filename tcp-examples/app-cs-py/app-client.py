@@ -1,55 +1,93 @@
 #!/usr/bin/env python3
 
 import sys
-import socket
+import json
+import logging
 import selectors
 import traceback
 
 import libclient
+import libresolver
 
 sel = selectors.DefaultSelector()
 
 
-# Creates a dictionary representing the request:
+# Creates a dictionary representing the request. The "binary" action sends
+# raw bytes, any other action is sent as a JSON request to its handler:
 def create_request(action, value):
-    if action == "search":
-        return dict(
-            type="text/json",
-            encoding="utf-8",
-            content=dict(action=action, value=value),
-        )
-    else:
+    if action == "binary":
         return dict(
             type="binary/custom-client-binary-type",
             encoding="binary",
             content=bytes(action + value, encoding="utf-8"),
         )
+    else:
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=dict(action=action, value=value),
+        )
 
 
-def start_connection(host, port, request):
+def start_connection(host, port, requests):
     addr = (host, port)
     print(f"Starting connection to {addr}")
-    # Create a socket for the server connection:
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Connect to the host's addresses, IPv4 or IPv6, in order until one
+    # accepts: the first one isn't always where the server listens (e.g.
+    # "localhost" resolving to ::1 first for a server on 127.0.0.1):
+    sock = libresolver.create_connection(addr)
     sock.setblocking(False)
-    sock.connect_ex(addr)
     # For the client, set the socket to be monitored for both read and write
     # events, initially:
     events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    # Create a Message object using the 'request' dictionary created by
-    # 'create_request(action, value)':
-    message = libclient.Message(sel, sock, addr, request)
+    # Create a Message object using the 'request' dictionaries created by
+    # 'create_request(action, value)'. They are all pipelined on this one
+    # connection, and answered in order. Large responses may come compressed:
+    message = libclient.Message(
+        sel, sock, addr, *requests, accept_compression=("deflate", "gzip")
+    )
     sel.register(sock, events, data=message)
 
 
-if len(sys.argv) != 5:
-    print(f"Usage: {sys.argv[0]} <host> <port> <action> <value>")
+def run_batch(host, port, path, batch_size):
+    # Bulk mode: one JSON request per line of the file ('-' for stdin), sent
+    # 'batch_size' at a time in batch messages. The response contents are
+    # printed as JSON lines, in the order of the requests:
+    file = sys.stdin if path == "-" else open(path, encoding="utf-8")
+    requests = (json.loads(line) for line in file if line.strip())
+    pool = libclient.connection_pool(host, port, max_size=1)
+    try:
+        for result in libclient.iter_batched(pool, requests, batch_size):
+            sys.stdout.write(json.dumps(result, ensure_ascii=False) + "\n")
+    finally:
+        pool.close()
+        if file is not sys.stdin:
+            file.close()
+
+
+if len(sys.argv) in (5, 6) and sys.argv[3] == "--batch":
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    batch_size = int(sys.argv[5]) if len(sys.argv) == 6 else 100
+    run_batch(sys.argv[1], int(sys.argv[2]), sys.argv[4], batch_size)
+    sys.exit(0)
+
+if len(sys.argv) < 5 or len(sys.argv) % 2 == 0:
+    print(
+        f"Usage: {sys.argv[0]} <host> <port> <action> <value> [<action> <value> ...]\n"
+        f"       {sys.argv[0]} <host> <port> --batch <file|-> [<batch size>]"
+    )
     sys.exit(1)
 
+# Print what libclient does, every send and receive included:
+logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+
 host, port = sys.argv[1], int(sys.argv[2])
-action, value = sys.argv[3], sys.argv[4]
-request = create_request(action, value)
-start_connection(host, port, request)
+# Every extra <action> <value> pair becomes one more request on the connection:
+requests = [
+    create_request(action, value)
+    for action, value in zip(sys.argv[3::2], sys.argv[4::2])
+]
+start_connection(host, port, requests)
 
 try:
     while True:
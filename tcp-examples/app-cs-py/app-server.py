@@ -1,61 +1,410 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
+import time
+import types
+import errno
+import signal
 import socket
+import logging
+import argparse
 import selectors
-import traceback
+import multiprocessing
 
+import libcache
+import libspool
+import libcompress
 import libserver
+import libmetrics
 
-sel = selectors.DefaultSelector()
+logger = logging.getLogger("app-server")
 
 
-def accept_wrapper(sock):
-    conn, addr = sock.accept()  # Should be ready to read
-    print(f"Accepted connection from {addr}")
+def accept_wrapper(sel, sock, stats=None):
+    try:
+        conn, addr = sock.accept()  # Should be ready to read
+    except BlockingIOError:
+        # Workers sharing one inherited listening socket are all woken up for
+        # a new connection, and another worker accepted it first:
+        return
+    logger.info("Accepted connection from %s", addr)
+    libserver.metrics.counters["accepts"] += 1
     conn.setblocking(False)
-    # Once a client connection is accepted, a Message object is created:
-    message = libserver.Message(sel, conn, addr)
+    if stats is not None:
+        stats.accepted[stats.index] += 1
+    # Once a client connection is accepted, a Message object is created. It
+    # serves requests on the connection until the client closes it or one of
+    # the keep-alive limits is hit:
+    message = libserver.Message(
+        sel,
+        conn,
+        addr,
+        idle_timeout=args.idle_timeout,
+        max_requests=args.max_requests,
+    )
     # associate the recently created Message object with a socket which
     # is monitored for events using 'selector.register()':
     sel.register(conn, selectors.EVENT_READ, data=message)
 
 
-if len(sys.argv) != 3:
-    print(f"Usage: {sys.argv[0]} <host> <port>")
-    sys.exit(1)
-
-host, port = sys.argv[1], int(sys.argv[2])
-lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-# Avoid bind() exception: OSError: [Errno 48] Address already in use
-lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-lsock.bind((host, port))
-lsock.listen()
-print(f"Listening on {(host, port)}")
-lsock.setblocking(False)
-sel.register(lsock, selectors.EVENT_READ, data=None)
-
-try:
-    # This event loop catches any errors so that the server can stay up and
-    # continue to run:
-    while True:
-        # when events are ready to be processed on the socket, they're returned
-        # by 'selector.select()':
-        events = sel.select(timeout=None)
-        for key, mask in events:
-            if key.data is None:
-                accept_wrapper(key.fileobj)
-            else:
-                message = key.data
-                try:
-                    message.process_events(mask)
-                except Exception:
-                    print(
-                        f"Main: Error: Exception for {message.addr}:\n"
-                        f"{traceback.format_exc()}"
+def close_idle_connections(sel, now):
+    # Copy the values, closing a connection unregisters it from the map:
+    for key in list(sel.get_map().values()):
+        message = key.data
+        if isinstance(message, libserver.Message) and message.is_idle(now):
+            logger.info("Closing idle connection to %s", message.addr)
+            message.close()
+
+
+def create_listening_socket(host, port, reuse_port=False, listen=True):
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Avoid bind() exception: OSError: [Errno 48] Address already in use
+    lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Let several sockets bind the same address, the kernel then spreads
+        # incoming connections across all of them that are listening:
+        lsock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    lsock.bind((host, port))
+    if listen:
+        lsock.listen()
+        lsock.setblocking(False)
+    return lsock
+
+
+def compression_list(value):
+    codecs = tuple(codec for codec in value.split(",") if codec)
+    unknown = set(codecs) - set(libcompress.CODECS)
+    if unknown:
+        raise argparse.ArgumentTypeError(
+            f"unknown compression(s): {', '.join(sorted(unknown))}"
+        )
+    return codecs
+
+
+def dump_metrics(title):
+    # One JSON line, easy to grep out of the log and to feed to other tools:
+    snapshot = libserver.stats(None)["result"]
+    logger.info("%s: %s", title, json.dumps(snapshot, sort_keys=True))
+
+
+def serve(lsock, stats=None):
+    # Each process runs its own selector, an epoll/kqueue instance must not be
+    # shared across a fork():
+    sel = selectors.DefaultSelector()
+    sel.register(lsock, selectors.EVENT_READ, data=None)
+    # Offloaded request handlers report back through a wake-up socket that is
+    # monitored along with the connections:
+    libserver.registry.attach(sel)
+    next_idle_check = time.monotonic() + 1
+    next_dump = time.monotonic() + args.stats_interval
+    try:
+        # This event loop catches any errors so that the server can stay up and
+        # continue to run:
+        while True:
+            # when events are ready to be processed on the socket, they're
+            # returned by 'selector.select()'. Wake up at least once a second
+            # anyway, to look for idle connections:
+            events = sel.select(timeout=1)
+            for key, mask in events:
+                if key.data is None:
+                    accept_wrapper(sel, key.fileobj, stats)
+                elif key.data is libserver.registry:
+                    try:
+                        libserver.registry.process_completions()
+                    except Exception:
+                        logger.exception("Exception processing handler completions")
+                else:
+                    message = key.data
+                    try:
+                        message.process_events(mask)
+                    except Exception:
+                        logger.exception("Exception for %s", message.addr)
+                        message.close()
+            # Sweep for idle connections at most once a second, not on every
+            # event:
+            now = time.monotonic()
+            if now >= next_idle_check:
+                close_idle_connections(sel, now)
+                next_idle_check = now + 1
+            if args.stats_interval > 0 and now >= next_dump:
+                dump_metrics("Metrics")
+                next_dump = now + args.stats_interval
+            if stats is not None:
+                # Every registered socket but the listening and the wake-up
+                # ones is a client:
+                stats.active[stats.index] = len(sel.get_map()) - 2
+    except KeyboardInterrupt:
+        logger.info("Caught keyboard interrupt, exiting")
+    finally:
+        dump_metrics("Final metrics")
+        libserver.registry.close()
+        sel.close()
+
+
+def raise_keyboard_interrupt(signum, frame):
+    # Only once: a second SIGTERM, e.g. a worker's from both the supervisor
+    # and a kill of the process group, must not interrupt the shutdown:
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def run_workers(host, port, num_workers):
+    # With SO_REUSEPORT every worker gets a listening socket of its own and
+    # the kernel load-balances connections between them. The parent only
+    # binds (without listening) to reserve the port, which also resolves
+    # port 0 to the ephemeral port all workers must share. Without it, the
+    # workers fall back to accepting from one listening socket inherited
+    # across fork():
+    lsock = None
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    if reuse_port:
+        try:
+            reserved = create_listening_socket(host, port, reuse_port, listen=False)
+        except OSError as e:
+            # Only a kernel without the option falls back, other errors (e.g.
+            # the address in use) would be the same without it:
+            if e.errno not in (errno.ENOPROTOOPT, errno.EINVAL):
+                raise
+            logger.warning(
+                "SO_REUSEPORT unavailable (%r), sharing one listening socket", e
+            )
+            reuse_port = False
+    if not reuse_port:
+        lsock = reserved = create_listening_socket(host, port)
+    port = reserved.getsockname()[1]
+    logger.info("Listening on %s with %d workers", (host, port), num_workers)
+
+    # Per-worker counters in shared memory, written by the workers and read
+    # by the parent for its reports:
+    stats = types.SimpleNamespace(
+        index=None,
+        accepted=multiprocessing.RawArray("Q", num_workers),
+        active=multiprocessing.RawArray("Q", num_workers),
+    )
+    workers = {}  # pid -> (worker index, start time)
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            # Worker process. It never returns into the supervisor code:
+            status = 1
+            try:
+                stats.index = index
+                if reuse_port:
+                    sock = create_listening_socket(host, port, reuse_port=True)
+                else:
+                    sock = lsock
+                serve(sock, stats)
+                status = 0
+            except BaseException:
+                logger.exception("Worker %d failed", index)
+            finally:
+                logging.shutdown()
+                sys.stdout.flush()
+                os._exit(status)
+        logger.info("Started worker %d (pid %d)", index, pid)
+        workers[pid] = (index, time.monotonic())
+
+    def report():
+        counts = ", ".join(
+            f"[{index}] {stats.active[index]} active/{stats.accepted[index]} accepted"
+            for index in range(num_workers)
+        )
+        logger.info("Workers: %s", counts)
+
+    for index in range(num_workers):
+        spawn(index)
+
+    next_report = time.monotonic() + args.report_interval
+    try:
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.1)
+            elif pid in workers:
+                index, started = workers.pop(pid)
+                exitcode = os.waitstatus_to_exitcode(status)
+                if exitcode != 0:
+                    logger.warning(
+                        "Worker %d (pid %d) exited with %d", index, pid, exitcode
                     )
-                    message.close()
-except KeyboardInterrupt:
-    print("Caught keyboard interrupt, exiting")
-finally:
-    sel.close()
+                    # Don't spin when a worker crashes right after starting:
+                    if time.monotonic() - started < 1:
+                        time.sleep(1)
+                    stats.active[index] = 0
+                    spawn(index)
+            now = time.monotonic()
+            if now >= next_report:
+                report()
+                next_report = now + args.report_interval
+    except KeyboardInterrupt:
+        logger.info("Caught keyboard interrupt, stopping workers")
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in workers:
+            os.waitpid(pid, 0)
+    finally:
+        report()
+        reserved.close()
+
+
+parser = argparse.ArgumentParser(usage=f"{sys.argv[0]} <host> <port> [options]")
+parser.add_argument("host")
+parser.add_argument("port", type=int)
+parser.add_argument(
+    "--idle-timeout",
+    type=float,
+    default=30.0,
+    help="close connections without traffic for this many seconds (default: 30)",
+)
+parser.add_argument(
+    "--max-requests",
+    type=int,
+    default=1000,
+    help="close a connection after serving this many requests (default: 1000)",
+)
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=0,
+    help="fork this many worker processes, each with its own event loop "
+    "(default: 0, serve from this process)",
+)
+parser.add_argument(
+    "--search-data",
+    metavar="FILE",
+    help="bulk load the search index from a file of 'key<TAB>value' lines",
+)
+parser.add_argument(
+    "--cache-bytes",
+    type=int,
+    default=16 * 1024 * 1024,
+    help="byte budget of the response cache, 0 disables it (default: 16 MiB)",
+)
+parser.add_argument(
+    "--cache-ttl",
+    type=float,
+    default=60.0,
+    help="seconds a cached response stays valid (default: 60)",
+)
+parser.add_argument(
+    "--report-interval",
+    type=float,
+    default=10.0,
+    help="seconds between per-worker connection count reports (default: 10)",
+)
+parser.add_argument(
+    "--body-memory-limit",
+    type=int,
+    default=libserver.BODY_MEMORY_LIMIT,
+    help="request bodies larger than this are spooled to a temporary file as "
+    "they arrive, instead of being buffered in memory (default: 1 MiB)",
+)
+parser.add_argument(
+    "--memory-budget",
+    type=int,
+    default=libserver.memory_budget.limit,
+    help="bytes of request bodies all connections may buffer in memory "
+    "together, per worker; more are spooled to disk (default: 64 MiB)",
+)
+parser.add_argument(
+    "--max-body-size",
+    type=int,
+    help="answer larger request bodies with an error and close the connection "
+    "(default: no limit)",
+)
+parser.add_argument(
+    "--spool-dir",
+    metavar="DIR",
+    help="where spooled request bodies go (default: the system's temp directory)",
+)
+parser.add_argument(
+    "--echo-binary",
+    action="store_true",
+    help="answer binary requests with their whole body instead of its first "
+    "10 bytes, spooled bodies are sent back with sendfile()",
+)
+parser.add_argument(
+    "--compression",
+    type=compression_list,
+    default=libserver.COMPRESSION,
+    metavar="LIST",
+    help="comma-separated compressions offered to clients, out of "
+    f"{', '.join(libcompress.CODECS)}; '' disables compression "
+    "(default: deflate,gzip)",
+)
+parser.add_argument(
+    "--compress-min-size",
+    type=int,
+    default=libserver.COMPRESS_MIN_SIZE,
+    help="send smaller response bodies uncompressed (default: 1024)",
+)
+parser.add_argument(
+    "--compress-offload-size",
+    type=int,
+    default=libserver.COMPRESS_OFFLOAD_SIZE,
+    help="compress response bodies of this size or more on the thread pool "
+    "instead of in the event loop (default: 64 KiB)",
+)
+parser.add_argument(
+    "--stats-interval",
+    type=float,
+    default=60.0,
+    help="seconds between dumps of the metrics to the log, 0 disables them; "
+    "with --workers every worker dumps its own (default: 60)",
+)
+parser.add_argument(
+    "--log-level",
+    default="INFO",
+    choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    help="DEBUG logs every request and send (default: INFO)",
+)
+parser.add_argument(
+    "--log-burst",
+    type=int,
+    default=10,
+    help="log at most this many messages per second from one place in the "
+    "code, the rest are counted and dropped (default: 10)",
+)
+args = parser.parse_args()
+libmetrics.setup_logging(args.log_level, args.log_burst)
+
+if args.cache_bytes > 0:
+    libserver.response_cache = libcache.ResponseCache(args.cache_bytes, args.cache_ttl)
+else:
+    libserver.response_cache = None
+
+libserver.BODY_MEMORY_LIMIT = args.body_memory_limit
+libserver.memory_budget = libspool.MemoryBudget(args.memory_budget)
+libserver.MAX_BODY_SIZE = args.max_body_size
+libserver.SPOOL_DIR = args.spool_dir
+if args.echo_binary:
+    libserver.binary_handler = libserver.echo_body
+libserver.COMPRESSION = args.compression
+libserver.COMPRESS_MIN_SIZE = args.compress_min_size
+libserver.COMPRESS_OFFLOAD_SIZE = args.compress_offload_size
+
+if args.search_data:
+    # Loaded before forking, so that workers start with the index built:
+    start = time.perf_counter()
+    libserver.load_search_index(args.search_data)
+    logger.info(
+        "Loaded %d search keys in %.1fs",
+        len(libserver.search_index),
+        time.perf_counter() - start,
+    )
+
+# Turn SIGTERM into the same clean shutdown as Ctrl-C, in the workers too:
+signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+
+if args.workers > 0:
+    run_workers(args.host, args.port, args.workers)
+else:
+    lsock = create_listening_socket(args.host, args.port)
+    logger.info("Listening on %s", (args.host, args.port))
+    serve(lsock)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+# Sends '--requests' concurrent requests for one <action> <value> from a single
+# coroutine-based process, spread over '--connections' keep-alive connections
+# on which they are pipelined. Works against app-server.py and
+# async-app-server.py alike, to compare the selector and asyncio servers.
+# With '--request-ids' the requests are multiplexed, and answered in the order
+# their handlers finish instead of the order they were sent in.
+
+import sys
+import time
+import asyncio
+import argparse
+
+import libasync
+
+
+# Creates a dictionary representing the request, like app-client.py does:
+def create_request(action, value):
+    if action == "binary":
+        return dict(
+            type="binary/custom-client-binary-type",
+            encoding="binary",
+            content=bytes(action + value, encoding="utf-8"),
+        )
+    else:
+        return dict(
+            type="text/json",
+            encoding="utf-8",
+            content=dict(action=action, value=value),
+        )
+
+
+async def main(args):
+    request = create_request(args.action, args.value)
+    clients = await asyncio.gather(
+        *(
+            libasync.open_connection(
+                args.host, args.port, request_ids=args.request_ids
+            )
+            for _ in range(args.connections)
+        )
+    )
+    start = time.perf_counter()
+    results = await asyncio.gather(
+        *(
+            clients[i % len(clients)].request(request, args.timeout)
+            for i in range(args.requests)
+        ),
+        return_exceptions=True,
+    )
+    elapsed = time.perf_counter() - start
+    for client in clients:
+        client.close()
+
+    errors = [result for result in results if isinstance(result, Exception)]
+    answers = [result for result in results if not isinstance(result, Exception)]
+    if answers:
+        print(f"Got response: {answers[0]!r}")
+    if errors:
+        print(f"Error: {len(errors)} request(s) failed, first one: {errors[0]!r}")
+    print(
+        f"{len(answers)} responses over {len(clients)} connection(s) in "
+        f"{elapsed:.3f}s ({len(answers) / elapsed:.0f} requests/s)"
+    )
+
+
+parser = argparse.ArgumentParser(
+    usage=f"{sys.argv[0]} <host> <port> <action> <value> [options]"
+)
+parser.add_argument("host")
+parser.add_argument("port", type=int)
+parser.add_argument("action")
+parser.add_argument("value")
+parser.add_argument("--requests", type=int, default=1)
+parser.add_argument("--connections", type=int, default=1)
+parser.add_argument(
+    "--request-ids",
+    action="store_true",
+    help="tag requests with ids, so that responses can come out of order",
+)
+parser.add_argument(
+    "--timeout", type=float, help="seconds to wait for each response (default: none)"
+)
+args = parser.parse_args()
+
+try:
+    libasync.run(main(args))
+except KeyboardInterrupt:
+    print("Caught keyboard interrupt, exiting")
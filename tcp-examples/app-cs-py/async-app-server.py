@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+# Serves the same protocol as app-server.py from an asyncio event loop (uvloop
+# when installed), with the actions of libasync.DEFAULT_HANDLERS.
+
+import sys
+import argparse
+
+import libasync
+
+
+async def main(args):
+    server = await libasync.start_server(
+        args.host,
+        args.port,
+        idle_timeout=args.idle_timeout,
+        max_requests=args.max_requests,
+    )
+    addrs = [sock.getsockname() for sock in server.sockets]
+    print(f"Listening on {', '.join(map(str, addrs))}")
+    async with server:
+        await server.serve_forever()
+
+
+parser = argparse.ArgumentParser(usage=f"{sys.argv[0]} <host> <port> [options]")
+parser.add_argument("host")
+parser.add_argument("port", type=int)
+parser.add_argument(
+    "--idle-timeout",
+    type=float,
+    default=30.0,
+    help="close connections without traffic for this many seconds (default: 30)",
+)
+parser.add_argument(
+    "--max-requests",
+    type=int,
+    default=1000,
+    help="close a connection after serving this many requests (default: 1000)",
+)
+args = parser.parse_args()
+
+try:
+    libasync.run(main(args))
+except KeyboardInterrupt:
+    print("Caught keyboard interrupt, exiting")
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+
+# Compares the old "bytes concatenation + slicing" buffering of libserver and
+# libclient with libbuffer.Buffer, by pushing one framed message (2-byte
+# protoheader, JSON header, body) through a socketpair and parsing it on the
+# other end with each strategy.
+#
+# Usage: buffer-bench.py [--sizes 1K,1M,100M] [--repeat N] [--legacy-max SIZE]
+
+import sys
+import json
+import time
+import struct
+import socket
+import argparse
+import threading
+
+from libbuffer import Buffer
+
+UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+
+def format_size(nbytes):
+    for unit in ("G", "M", "K"):
+        if nbytes >= UNITS[unit] and nbytes % UNITS[unit] == 0:
+            return f"{nbytes // UNITS[unit]} {unit}B"
+    return f"{nbytes} B"
+
+
+def create_message(body):
+    jsonheader = {
+        "byteorder": sys.byteorder,
+        "content-type": "binary/custom-client-binary-type",
+        "content-encoding": "binary",
+        "content-length": len(body),
+    }
+    jsonheader_bytes = json.dumps(jsonheader).encode("utf-8")
+    return struct.pack(">H", len(jsonheader_bytes)) + jsonheader_bytes + body
+
+
+# Old behaviour: every recv() result is appended to an immutable bytes object
+# and every parse stage slices the front of it off, every send() re-slices the
+# remaining bytes. Both copy the whole pending buffer each time.
+def legacy_send(sock, message):
+    send_buffer = message
+    while send_buffer:
+        sent = sock.send(send_buffer)
+        send_buffer = send_buffer[sent:]
+
+
+def legacy_recv(sock):
+    recv_buffer = b""
+    jsonheader_len = jsonheader = None
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            raise RuntimeError("Peer closed.")
+        recv_buffer += data
+        if jsonheader_len is None and len(recv_buffer) >= 2:
+            jsonheader_len = struct.unpack(">H", recv_buffer[:2])[0]
+            recv_buffer = recv_buffer[2:]
+        if jsonheader_len is not None and jsonheader is None:
+            if len(recv_buffer) >= jsonheader_len:
+                jsonheader = json.loads(recv_buffer[:jsonheader_len])
+                recv_buffer = recv_buffer[jsonheader_len:]
+        if jsonheader is not None:
+            content_len = jsonheader["content-length"]
+            if len(recv_buffer) >= content_len:
+                return recv_buffer[:content_len]
+
+
+# New behaviour: recv_into() a preallocated buffer, parse through memoryview
+# slices and advance a read cursor.
+def buffer_send(sock, message):
+    send_buffer = Buffer()
+    send_buffer.extend(message)
+    while send_buffer:
+        send_buffer.send(sock)
+
+
+def buffer_recv(sock):
+    recv_buffer = Buffer()
+    jsonheader_len = jsonheader = None
+    while True:
+        if not recv_buffer.recv_into(sock):
+            raise RuntimeError("Peer closed.")
+        if jsonheader_len is None and len(recv_buffer) >= 2:
+            jsonheader_len = struct.unpack(">H", recv_buffer.peek(2))[0]
+            recv_buffer.consume(2)
+        if jsonheader_len is not None and jsonheader is None:
+            if len(recv_buffer) >= jsonheader_len:
+                jsonheader = json.loads(bytes(recv_buffer.peek(jsonheader_len)))
+                recv_buffer.consume(jsonheader_len)
+        if jsonheader is not None:
+            content_len = jsonheader["content-length"]
+            if len(recv_buffer) >= content_len:
+                return bytes(recv_buffer.peek(content_len))
+            recv_buffer.reserve(content_len - len(recv_buffer))
+
+
+STRATEGIES = {
+    "legacy": (legacy_send, legacy_recv),
+    "buffer": (buffer_send, buffer_recv),
+}
+
+
+def run_once(strategy, message, body_len):
+    send, recv = STRATEGIES[strategy]
+    rsock, wsock = socket.socketpair()
+    try:
+        sender = threading.Thread(target=send, args=(wsock, message))
+        start = time.perf_counter()
+        sender.start()
+        body = recv(rsock)
+        elapsed = time.perf_counter() - start
+        sender.join()
+    finally:
+        rsock.close()
+        wsock.close()
+    if len(body) != body_len:
+        raise RuntimeError(f"Expected {body_len} bytes, got {len(body)}.")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Receive/send buffer throughput benchmark."
+    )
+    parser.add_argument("--sizes", default="1K,1M,100M")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument(
+        "--legacy-max",
+        default="8M",
+        help="skip the legacy strategy above this body size, it is quadratic",
+    )
+    args = parser.parse_args()
+    sizes = [parse_size(size) for size in args.sizes.split(",")]
+    legacy_max = parse_size(args.legacy_max)
+
+    print(f"{'body':>10} {'strategy':>10} {'best time':>12} {'throughput':>14}")
+    for size in sizes:
+        message = create_message(b"x" * size)
+        for strategy in STRATEGIES:
+            if strategy == "legacy" and size > legacy_max:
+                print(f"{format_size(size):>10} {strategy:>10} {'skipped':>12}")
+                continue
+            best = min(
+                run_once(strategy, message, size) for _ in range(args.repeat)
+            )
+            throughput = len(message) / best / UNITS["M"]
+            print(
+                f"{format_size(size):>10} {strategy:>10} "
+                f"{best * 1000:>9.3f} ms {throughput:>9.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,458 @@
+import asyncio
+import inspect
+import collections
+
+import libpool
+import libheader
+import libserver
+import libresolver
+from libbuffer import Buffer
+
+# Use uvloop's faster event loop when it is installed:
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+
+def run(main):
+    """Run the coroutine 'main', on uvloop if it is available."""
+    if uvloop is not None:
+        uvloop.install()
+    return asyncio.run(main)
+
+
+def echo_binary(content):
+    return b"First 10 bytes of request: " + content[:10]
+
+
+async def fuzzy(request):
+    # Fuzzy lookups scan many candidates, keep them off the event loop:
+    return await asyncio.to_thread(libserver.fuzzy, request)
+
+
+# Actions served by default, the same lookups libserver.Message answers:
+DEFAULT_HANDLERS = {
+    "search": libserver.search,
+    "prefix": libserver.prefix,
+    "fuzzy": fuzzy,
+}
+
+
+class _MessageProtocol(asyncio.BufferedProtocol):
+    """Same wire format and framing state machine as libserver.Message and
+    libclient.Message, fed by asyncio instead of selector callbacks."""
+
+    def __init__(self):
+        self.transport = None
+        # The event loop writes received bytes straight into this buffer via
+        # 'get_buffer()'/'buffer_updated()', no intermediate bytes objects:
+        self._recv_buffer = Buffer()
+        self._header_version = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def get_buffer(self, sizehint):
+        return self._recv_buffer.get_buffer(max(sizehint, 65536))
+
+    def buffer_updated(self, nbytes):
+        self._recv_buffer.buffer_updated(nbytes)
+        # Several pipelined messages may have arrived at once:
+        while self.transport is not None:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
+
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
+
+            if self.jsonheader is None or not self.process_content():
+                break
+
+    def process_protoheader(self):
+        hdrlen = libheader.PROTOHEADER.size
+        if len(self._recv_buffer) >= hdrlen:
+            self._header_version, self._jsonheader_len = libheader.decode_protoheader(
+                self._recv_buffer.peek(hdrlen)
+            )
+            self._recv_buffer.consume(hdrlen)
+
+    def process_jsonheader(self):
+        hdrlen = self._jsonheader_len
+        if len(self._recv_buffer) >= hdrlen:
+            if self._header_version is None:
+                self.jsonheader = libheader.decode_json(self._recv_buffer.peek(hdrlen))
+            else:
+                self.jsonheader = libheader.decode_binary(
+                    self._recv_buffer.peek(hdrlen)
+                )
+            self._recv_buffer.consume(hdrlen)
+            for reqhdr in (
+                "byteorder",
+                "content-length",
+                "content-type",
+                "content-encoding",
+            ):
+                if reqhdr not in self.jsonheader:
+                    raise ValueError(f"Missing required header '{reqhdr}'.")
+
+    def process_content(self):
+        content_len = self.jsonheader["content-length"]
+        if not len(self._recv_buffer) >= content_len:
+            self._recv_buffer.reserve(content_len - len(self._recv_buffer))
+            return False
+        data = self._recv_buffer.peek(content_len)
+        if self.jsonheader["content-type"] == "text/json":
+            content = libheader.json_decode(data, self.jsonheader["content-encoding"])
+        else:
+            # Binary or unknown content-type
+            content = bytes(data)
+        self._recv_buffer.consume(content_len)
+        jsonheader, header_version = self.jsonheader, self._header_version
+        # Reset the per-message state before handing the message over, the
+        # next one may already be in the buffer:
+        self._header_version = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.message_received(jsonheader, header_version, content)
+        return True
+
+    def message_received(self, jsonheader, header_version, content):
+        raise NotImplementedError
+
+
+def _future_response(future):
+    if future.cancelled() or future.exception() is not None:
+        error = future.exception() or "cancelled"
+        return {"result": f"Error: {error!r}"}
+    return future.result()
+
+
+class ServerProtocol(_MessageProtocol):
+    def __init__(
+        self,
+        handlers=None,
+        binary_handler=echo_binary,
+        idle_timeout=None,
+        max_requests=None,
+    ):
+        super().__init__()
+        self.handlers = DEFAULT_HANDLERS if handlers is None else handlers
+        self.binary_handler = binary_handler
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.requests_received = 0
+        self.responses_sent = 0
+        self._idle_handle = None
+        self._active = False
+        # Responses in request order. An entry holds the request's header
+        # information and either the response or the future of a coroutine
+        # handler still running:
+        self._responses = collections.deque()
+        # Coroutine handlers of multiplexed requests (with a 'request-id'):
+        self._multiplexed = set()
+
+    def connection_made(self, transport):
+        super().connection_made(transport)
+        if self.idle_timeout is not None:
+            self._idle_handle = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._check_idle
+            )
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if self._idle_handle is not None:
+            self._idle_handle.cancel()
+        for *_, response in self._responses:
+            if isinstance(response, asyncio.Future):
+                response.cancel()
+        for future in list(self._multiplexed):
+            future.cancel()
+
+    def pause_writing(self):
+        # The client doesn't read its responses fast enough, stop reading its
+        # requests until the transport's write buffer drained:
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def _check_idle(self):
+        # Re-armed once per period instead of on every message:
+        if self._active or self._responses or self._multiplexed:
+            self._active = False
+            self._idle_handle = asyncio.get_running_loop().call_later(
+                self.idle_timeout, self._check_idle
+            )
+        else:
+            self.transport.close()
+
+    def message_received(self, jsonheader, header_version, content):
+        self._active = True
+        self.requests_received += 1
+        if self.max_requests is not None and (
+            self.requests_received > self.max_requests
+        ):
+            # Pipelined past the limit, this request will never be answered:
+            return
+        if jsonheader["content-type"] == "text/json":
+            action = content.get("action")
+            handler = self.handlers.get(action)
+            if handler is None:
+                response = {"result": f"Error: invalid action '{action}'."}
+            else:
+                # A failing handler is answered like in libserver, not left to
+                # drop the connection:
+                try:
+                    response = handler(content)
+                except Exception as e:
+                    response = {"result": f"Error: action '{action}' failed: {e!r}"}
+        else:
+            response = self.binary_handler(content)
+        if "request-id" in jsonheader:
+            # Multiplexed: answered as soon as the response is ready, ahead of
+            # whatever is still queued:
+            if inspect.isawaitable(response):
+                response = asyncio.ensure_future(response)
+                self._multiplexed.add(response)
+                response.add_done_callback(
+                    lambda future: self._multiplexed_done(jsonheader, future)
+                )
+            else:
+                self._write_response(jsonheader, None, response)
+            return
+        if inspect.isawaitable(response):
+            response = asyncio.ensure_future(response)
+            response.add_done_callback(self._flush)
+        self._responses.append((jsonheader, header_version, response))
+        self._flush()
+
+    def _multiplexed_done(self, jsonheader, future):
+        self._multiplexed.discard(future)
+        if self.transport is not None:
+            self._write_response(jsonheader, None, _future_response(future))
+
+    def _flush(self, future=None):
+        # Write every response at the head of the queue that is ready, so
+        # that pipelined requests are answered in order:
+        while self._responses and self.transport is not None:
+            jsonheader, header_version, response = self._responses[0]
+            if isinstance(response, asyncio.Future):
+                if not response.done():
+                    break
+                response = _future_response(response)
+            self._responses.popleft()
+            self._write_response(jsonheader, header_version, response)
+
+    def _write_response(self, request_header, header_version, response):
+        if request_header["content-type"] == "text/json":
+            content_encoding = "utf-8"
+            content_bytes = libheader.json_encode(response, content_encoding)
+            content_type = "text/json"
+        else:
+            content_encoding = "binary"
+            content_bytes = response
+            content_type = "binary/custom-server-binary-type"
+        jsonheader = libheader.create_header(
+            content_length=len(content_bytes),
+            content_type=content_type,
+            content_encoding=content_encoding,
+        )
+        self.responses_sent += 1
+        last = self.max_requests is not None and (
+            self.responses_sent >= self.max_requests
+        )
+        if last:
+            jsonheader["connection"] = "close"
+        if "request-id" in request_header:
+            jsonheader["request-id"] = request_header["request-id"]
+        # Same header rules as libserver.Message: answer in the format of the
+        # request and acknowledge an advertised binary header version:
+        if header_version is not None and libheader.can_encode_binary(jsonheader):
+            message_hdr = libheader.encode_binary(jsonheader)
+        else:
+            if "header-version" in request_header:
+                jsonheader["header-version"] = min(
+                    request_header["header-version"], libheader.VERSION
+                )
+            message_hdr = libheader.encode_json(jsonheader)
+        # One write() of the header and body avoids concatenating them:
+        self.transport.writelines((message_hdr, content_bytes))
+        if last:
+            self.transport.close()
+
+
+class ClientProtocol(_MessageProtocol):
+    def __init__(self, header_mode="auto", request_ids=False):
+        super().__init__()
+        if header_mode not in ("auto", "json", "binary"):
+            raise ValueError(f"Invalid header mode {header_mode!r}.")
+        self.header_mode = header_mode
+        self.header_version = libheader.VERSION if header_mode == "binary" else None
+        self.closing = False
+        # Futures of the requests sent, answered in order by the server:
+        self._waiters = collections.deque()
+        # With 'request_ids', every request gets an id instead, and the server
+        # answers them in any order. Futures by request id:
+        self.request_ids = request_ids
+        self._next_id = 0
+        self._by_id = {}
+
+    def connection_lost(self, exc):
+        self.transport = None
+        waiters = [*self._waiters, *self._by_id.values()]
+        self._waiters.clear()
+        self._by_id.clear()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_exception(exc or ConnectionError("Peer closed."))
+
+    def message_received(self, jsonheader, header_version, content):
+        if self.header_mode == "auto" and self.header_version is None:
+            self.header_version = jsonheader.get("header-version")
+        if jsonheader.get("connection") == "close":
+            self.closing = True
+        if "request-id" in jsonheader:
+            # None if the request timed out or was cancelled meanwhile:
+            waiter = self._by_id.pop(jsonheader["request-id"], None)
+        else:
+            # None for a response to no request, dropped like a late one:
+            waiter = self._waiters.popleft() if self._waiters else None
+        if waiter is not None and not waiter.done():
+            waiter.set_result(content)
+
+    def _forget_cancelled(self, request_id, waiter):
+        # A request given up on, its late response is dropped:
+        if waiter.cancelled():
+            self._by_id.pop(request_id, None)
+
+    def send_request(self, request):
+        content = request["content"]
+        content_type = request["type"]
+        content_encoding = request["encoding"]
+        if content_type == "text/json":
+            content_bytes = libheader.json_encode(content, content_encoding)
+        else:
+            content_bytes = content
+        jsonheader = libheader.create_header(
+            content_length=len(content_bytes),
+            content_type=content_type,
+            content_encoding=content_encoding,
+        )
+        waiter = asyncio.get_running_loop().create_future()
+        if self.request_ids:
+            request_id = self._next_id
+            self._next_id += 1
+            jsonheader["request-id"] = request_id
+            self._by_id[request_id] = waiter
+            waiter.add_done_callback(
+                lambda waiter: self._forget_cancelled(request_id, waiter)
+            )
+        else:
+            self._waiters.append(waiter)
+        if self.header_version is not None and libheader.can_encode_binary(
+            jsonheader
+        ):
+            message_hdr = libheader.encode_binary(jsonheader)
+        else:
+            if self.header_mode == "auto":
+                jsonheader["header-version"] = libheader.VERSION
+            message_hdr = libheader.encode_json(jsonheader)
+        self.transport.writelines((message_hdr, content_bytes))
+        return waiter
+
+
+class Client:
+    """One keep-alive connection. Concurrent 'request()' calls are pipelined
+    on it, and the server answers them in order. With request ids, a slow
+    request doesn't hold up the responses to the ones sent after it."""
+
+    def __init__(self, transport, protocol):
+        self.transport = transport
+        self.protocol = protocol
+
+    async def request(self, request, timeout=None):
+        """Send a request dictionary (as built by app-client.py) and return
+        the decoded response content. A request that isn't answered within
+        'timeout' seconds raises TimeoutError, and cancelling the calling
+        task gives up on it too; the connection stays usable either way."""
+        if self.protocol.transport is None or self.protocol.closing:
+            raise ConnectionError("Connection is closed.")
+        waiter = self.protocol.send_request(request)
+        if timeout is None:
+            return await waiter
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"No response in {timeout}s.") from None
+
+    def is_alive(self):
+        """Health check for a connection waiting in a pool: the event loop
+        notices a connection closed by the server, and one announced to be
+        closed takes no more requests."""
+        return (
+            self.protocol.transport is not None
+            and not self.protocol.closing
+            and not self.protocol._waiters
+            and not self.protocol._by_id
+        )
+
+    def close(self):
+        self.transport.close()
+
+
+async def open_connection(host, port, header_mode="auto", request_ids=False):
+    loop = asyncio.get_running_loop()
+    # Cached and shared by concurrent connects, then tried in order:
+    error = None
+    for _, _, _, _, sockaddr in await libresolver.resolve_async(host, port):
+        try:
+            transport, protocol = await loop.create_connection(
+                lambda: ClientProtocol(header_mode, request_ids), *sockaddr[:2]
+            )
+        except OSError as e:
+            error = e
+            continue
+        return Client(transport, protocol)
+    if error is None:
+        error = OSError(f"No addresses for {host}")
+    raise error
+
+
+def connection_pool(
+    host, port, min_size=0, max_size=10, idle_timeout=60.0, header_mode="auto"
+):
+    """Pool of 'Client's to one server, see libpool.AsyncConnectionPool:
+
+        async with pool.connection() as client:
+            response = await client.request(request)
+
+    Clients pipeline concurrent requests, but a pooled one serves a single
+    task at a time, like a connection of a blocking pool."""
+    return libpool.AsyncConnectionPool(
+        lambda: open_connection(host, port, header_mode),
+        min_size=min_size,
+        max_size=max_size,
+        idle_timeout=idle_timeout,
+    )
+
+
+async def start_server(
+    host,
+    port,
+    handlers=None,
+    binary_handler=echo_binary,
+    idle_timeout=None,
+    max_requests=None,
+):
+    """Serve the app-cs-py protocol. 'handlers' maps a JSON request's action
+    to a function (or coroutine function) returning the response content."""
+    loop = asyncio.get_running_loop()
+    return await loop.create_server(
+        lambda: ServerProtocol(handlers, binary_handler, idle_timeout, max_requests),
+        host,
+        port,
+    )
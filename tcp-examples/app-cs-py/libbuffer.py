@@ -0,0 +1,107 @@
+class Buffer:
+    """Growable byte buffer with a read cursor, shared by the send and receive
+    paths of libserver.Message and libclient.Message."""
+
+    def __init__(self, size=65536):
+        # Storage, allocated on the first write with 'size' bytes, so that
+        # idle connections cost nothing. Live data sits between the read
+        # cursor ('_start') and the write cursor ('_end'):
+        self._size = size
+        self._buf = bytearray()
+        self._view = memoryview(self._buf)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __bool__(self):
+        return self._end > self._start
+
+    def capacity(self):
+        return len(self._buf)
+
+    def reserve(self, nbytes):
+        """Make sure at least 'nbytes' can be written after the live data."""
+        if len(self._buf) - self._end >= nbytes:
+            return
+        size = self._end - self._start
+        if len(self._buf) - size >= nbytes:
+            # Enough room overall, compact: move only the unread bytes to the
+            # front. A same-length slice assignment never resizes the
+            # bytearray, so it is safe while memoryviews are exported:
+            self._buf[:size] = self._view[self._start : self._end]
+        else:
+            # Grow by doubling so that a large body costs O(n) copies in total.
+            # A new bytearray is allocated (instead of resizing in place),
+            # so views handed out earlier stay valid on the old storage:
+            capacity = max(len(self._buf), self._size)
+            while capacity - size < nbytes:
+                capacity *= 2
+            buf = bytearray(capacity)
+            buf[:size] = self._view[self._start : self._end]
+            self._buf = buf
+            self._view = memoryview(buf)
+        self._start = 0
+        self._end = size
+
+    def get_buffer(self, nbytes=65536):
+        """Return a writable memoryview over at least 'nbytes' free bytes.
+
+        Whoever fills it reports how much was written with
+        '.buffer_updated()', like asyncio.BufferedProtocol does."""
+        self.reserve(nbytes)
+        return self._view[self._end :]
+
+    def buffer_updated(self, nbytes):
+        self._end += nbytes
+
+    def recv_into(self, sock, nbytes=65536):
+        """Read from 'sock' straight into the free tail of the buffer.
+
+        Returns the number of bytes read, 0 when the peer closed the
+        connection. 'BlockingIOError' propagates to the caller."""
+        nread = sock.recv_into(self.get_buffer(nbytes))
+        self.buffer_updated(nread)
+        return nread
+
+    def extend(self, data):
+        nbytes = len(data)
+        self.reserve(nbytes)
+        self._view[self._end : self._end + nbytes] = data
+        self._end += nbytes
+
+    def peek(self, nbytes=None):
+        """Return a memoryview over the next 'nbytes' unread bytes (all of them
+        by default) without consuming them.
+
+        The view is only valid until the buffer is written to again, copy it
+        with bytes() if it has to outlive the current parse step."""
+        if nbytes is None:
+            return self._view[self._start : self._end]
+        return self._view[self._start : min(self._start + nbytes, self._end)]
+
+    def consume(self, nbytes):
+        """Advance the read cursor past 'nbytes' bytes."""
+        self._start += min(nbytes, self._end - self._start)
+        if self._start == self._end:
+            self.clear()
+
+    def send(self, sock):
+        """Send as much unread data as the socket accepts and consume it.
+
+        Returns the number of bytes sent. 'BlockingIOError' propagates to the
+        caller."""
+        sent = sock.send(self._view[self._start : self._end])
+        self.consume(sent)
+        return sent
+
+    def clear(self):
+        # Rewind both cursors for free. Storage grown past the default size
+        # for a large message is dropped, not kept at its high watermark
+        # for the life of the connection (a new bytearray, so views handed
+        # out earlier stay valid):
+        self._start = self._end = 0
+        if len(self._buf) > self._size:
+            self._buf = bytearray()
+            self._view = memoryview(self._buf)
@@ -0,0 +1,77 @@
+import time
+import collections
+
+
+class ResponseCache:
+    """Bounded cache of fully framed response messages.
+
+    Entries are evicted least recently used first once the cache holds more
+    than 'max_bytes' of messages, and expire 'ttl' seconds after they were
+    stored. A hit is ready to be copied to a send buffer as is."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, ttl=60.0, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clock = clock
+        # key -> (message, expiry time), least recently used first:
+        self._entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        message, expires = entry
+        if self._clock() >= expires:
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return message
+
+    def put(self, key, message):
+        if len(message) > self.max_bytes:
+            # Would evict everything else and still not fit:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (message, self._clock() + self.ttl)
+        self.size += len(message)
+        while self.size > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        message, _ = self._entries.pop(key)
+        self.size -= len(message)
+
+    def invalidate(self, action=None):
+        """Drop the entries of one action, or all of them. To be called
+        whenever the data behind the cached responses changes."""
+        if action is None:
+            self._entries.clear()
+            self.size = 0
+            return
+        for key in [key for key in self._entries if key[0] == action]:
+            self._remove(key)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
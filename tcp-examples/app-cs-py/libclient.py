@@ -1,22 +1,75 @@
-import sys
-import selectors
+import re
 import json
-import io
-import struct
+import time
+import codecs
+import socket
+import logging
+import selectors
+import collections
+
+import libpool
+import libheader
+import libresolver
+import libcompress
+from libbuffer import Buffer
+
+logger = logging.getLogger("libclient")
 
 
 class Message:
-    def __init__(self, selector, sock, addr, request):
+    def __init__(
+        self,
+        selector,
+        sock,
+        addr,
+        *requests,
+        keep_alive=False,
+        header_mode="auto",
+        stream=False,
+        max_response_size=None,
+        accept_compression=None,
+    ):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self.request = request
-        self._recv_buffer = b""
-        self._send_buffer = b""
-        self._request_queued = False
+        # Requests that weren't written to the send buffer yet, and requests
+        # already sent that are waiting for their response. The server answers
+        # in order, so responses are matched to requests by position:
+        self._pending = collections.deque(requests)
+        self._inflight = collections.deque()
+        # Keep the connection open once every response has arrived, so that
+        # more requests can be sent on it later with '.add_request()':
+        self.keep_alive = keep_alive
+        # Header format of the requests: 'json' for plain JSON headers,
+        # 'binary' for servers known to support binary headers, or 'auto' to
+        # advertise binary header support in JSON headers and switch to binary
+        # ones once the server acknowledged a version:
+        if header_mode not in ("auto", "json", "binary"):
+            raise ValueError(f"Invalid header mode {header_mode!r}.")
+        self.header_mode = header_mode
+        self.header_version = libheader.VERSION if header_mode == "binary" else None
+        # Stream mode hands response bodies to '._process_response_chunk()'
+        # piece by piece as they arrive, instead of buffering them whole. The
+        # responses collected are then the headers:
+        self.stream = stream
+        self.chunks = collections.deque()
+        self._body_remaining = None
+        # Larger responses are refused (in both modes), None for no limit:
+        self.max_response_size = max_response_size
+        # Compressions the server may use for its responses, most preferred
+        # first, see 'libcompress.CODECS'. Offered in JSON headers, and the
+        # server keeps its choice for the connection:
+        self.accept_compression = accept_compression
+        self._compression_offered = False
+        self._decompressor = None
+        self._body_decoded = 0
+        self._header_version = None
+        self._recv_buffer = Buffer()
+        self._send_buffer = Buffer()
         self._jsonheader_len = None
         self.jsonheader = None
         self.response = None
+        self.responses = []
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -33,50 +86,54 @@ class Message:
     def _read(self):
         try:
             # Should be ready to read
-            data = self.sock.recv(4096)
+            nread = self._recv_buffer.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
-            else:
+            if not nread:
                 raise RuntimeError("Peer closed.")
 
     def _write(self):
         # If there’s data in the send buffer, call 'socket.send()':
         if self._send_buffer:
-            print(f"Sending {self._send_buffer!r} to {self.addr}")
+            logger.debug("Sending %d bytes to %s", len(self._send_buffer), self.addr)
             try:
-                # Should be ready to write.
-                sent = self.sock.send(self._send_buffer)  # num. of bytes sent
+                # Should be ready to write. Already sent bytes are removed from
+                # the send buffer by advancing its read cursor:
+                self._send_buffer.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
                 pass  # Skip over the exception
-            else:
-                # Remove already sent bytes from the send buffer:
-                self._send_buffer = self._send_buffer[sent:]
 
     def _json_encode(self, obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+        return libheader.json_encode(obj, encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding=encoding, newline="")
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
+        return libheader.json_decode(json_bytes, encoding)
 
     def _create_message(self, *, content_bytes, content_type, content_encoding):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        jsonheader = libheader.create_header(
+            content_length=len(content_bytes),
+            content_type=content_type,
+            content_encoding=content_encoding,
+        )
+        # The compression offer needs a JSON header, once:
+        offer = self.accept_compression and not self._compression_offered
+        if (
+            self.header_version is not None
+            and not offer
+            and libheader.can_encode_binary(jsonheader)
+        ):
+            message_hdr = libheader.encode_binary(jsonheader)
+        else:
+            if self.header_mode == "auto":
+                jsonheader["header-version"] = libheader.VERSION
+            if self.accept_compression:
+                jsonheader["accept-compression"] = list(self.accept_compression)
+                self._compression_offered = True
+            message_hdr = libheader.encode_json(jsonheader)
+        return message_hdr + content_bytes
 
     def _process_response_json_content(self):
         content = self.response
@@ -87,6 +144,10 @@ class Message:
         content = self.response
         print(f"Got response: {content!r}")
 
+    def _process_response_chunk(self, chunk):
+        # Stream mode: keep the chunk for whoever consumes 'self.chunks'.
+        self.chunks.append(chunk)
+
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
             self.read()
@@ -96,51 +157,91 @@ class Message:
     def read(self):
         self._read()
 
-        if self._jsonheader_len is None:
-            self.process_protoheader()
+        # Several pipelined responses may have arrived in one read, so keep
+        # parsing until the buffer doesn't hold a complete response anymore:
+        while self.sock is not None:
+            if self._jsonheader_len is None:
+                self.process_protoheader()
 
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
+
+            if self.jsonheader:
+                if self.response is None:
+                    self.process_response()
 
-        if self.jsonheader:
             if self.response is None:
-                self.process_response()
+                break
+            self._finish_response()
 
     def write(self):
-        # If a request hasn’t been queued, call ".queue_request()":
-        if not self._request_queued:
+        # If there are requests that haven't been queued, call ".queue_request()":
+        if self._pending:
             self.queue_request()
 
         self._write()
 
-        if self._request_queued:
-            if not self._send_buffer:
-                # Set selector to listen for read events, we're done writing.
-                self._set_selector_events_mask("r")
+        if not self._send_buffer:
+            # Set selector to listen for read events, we're done writing.
+            self._set_selector_events_mask("r")
+
+    def add_request(self, request):
+        """Send one more request on this (keep-alive) connection."""
+        self._pending.append(request)
+        self._set_selector_events_mask("rw")
+
+    def _finish_response(self):
+        self._inflight.popleft()
+        self.responses.append(self.response)
+        server_closing = self.jsonheader.get("connection") == "close"
+        # Reset the per-message state for the next response on the connection:
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.response = None
+        self._body_remaining = None
+        self._decompressor = None
+        self._body_decoded = 0
+        if server_closing and (self._inflight or self._pending):
+            unanswered = len(self._inflight) + len(self._pending)
+            logger.error(
+                "%s closes the connection, %d request(s) left unanswered",
+                self.addr,
+                unanswered,
+            )
+        if server_closing or not (self._inflight or self._pending or self.keep_alive):
+            # Close when every response has been processed:
+            self.close()
 
     def close(self):
-        print(f"Closing connection to {self.addr}")
+        logger.info("Closing connection to %s", self.addr)
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
-            print(f"Error: selector.unregister() exception for " f"{self.addr}: {e!r}")
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
 
         try:
             self.sock.close()
         except OSError as e:
-            print(f"Error: socket.close() exception for {self.addr}: {e!r}")
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
-    # Create the request and write it to the send buffer. Also, set the state variable '_request_queued' so that it’s only called once:
+    # Create the pending requests and write them all to the send buffer, so
+    # that they are pipelined to the server without waiting for responses:
     def queue_request(self):
-        # The request dictionary is passed as an argument to the class when
-        # a Message object is created.
-        content = self.request["content"]
-        content_type = self.request["type"]
-        content_encoding = self.request["encoding"]
+        while self._pending:
+            request = self._pending.popleft()
+            self._send_buffer.extend(self._create_request_message(request))
+            self._inflight.append(request)
+
+    def _create_request_message(self, request):
+        # The request dictionaries are passed as arguments to the class when
+        # a Message object is created, or later to '.add_request()'.
+        content = request["content"]
+        content_type = request["type"]
+        content_encoding = request["encoding"]
         if content_type == "text/json":
             req = {
                 "content_bytes": self._json_encode(content, content_encoding),
@@ -153,23 +254,30 @@ class Message:
                 "content_type": content_type,
                 "content_encoding": content_encoding,
             }
-        message = self._create_message(**req)
-        self._send_buffer += message
-        # Set the state variable 'self._request_queued' so that '.queue_request()'
-        # isn’t called again:
-        self._request_queued = True
+        return self._create_message(**req)
 
     def process_protoheader(self):
-        hdrlen = 2
+        hdrlen = libheader.PROTOHEADER.size
         if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(">H", self._recv_buffer[:hdrlen])[0]
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._header_version, self._jsonheader_len = libheader.decode_protoheader(
+                self._recv_buffer.peek(hdrlen)
+            )
+            self._recv_buffer.consume(hdrlen)
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         if len(self._recv_buffer) >= hdrlen:
-            self.jsonheader = self._json_decode(self._recv_buffer[:hdrlen], "utf-8")
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            if self._header_version is None:
+                self.jsonheader = libheader.decode_json(self._recv_buffer.peek(hdrlen))
+            else:
+                self.jsonheader = libheader.decode_binary(
+                    self._recv_buffer.peek(hdrlen)
+                )
+            self._recv_buffer.consume(hdrlen)
+            # The server acknowledged binary header support, use binary headers
+            # for the requests queued from now on:
+            if self.header_mode == "auto" and self.header_version is None:
+                self.header_version = self.jsonheader.get("header-version")
             for reqhdr in (
                 "byteorder",
                 "content-length",
@@ -178,25 +286,330 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
+            content_len = self.jsonheader["content-length"]
+            limit = self.max_response_size
+            if limit is not None and content_len > limit:
+                raise ValueError(
+                    f"Response of {content_len} bytes exceeds the limit of "
+                    f"{limit} bytes."
+                )
 
     def process_response(self):
+        if self.stream:
+            self._stream_response()
+            return
         content_len = self.jsonheader["content-length"]
         if not len(self._recv_buffer) >= content_len:
+            self._recv_buffer.reserve(content_len - len(self._recv_buffer))
             return
-        data = self._recv_buffer[:content_len]
-        self._recv_buffer = self._recv_buffer[content_len:]
+        data = bytes(self._recv_buffer.peek(content_len))
+        self._recv_buffer.consume(content_len)
+        compression = self.jsonheader.get("content-compression")
+        if compression is not None:
+            data = libcompress.decompress(data, compression, self.max_response_size)
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
             self.response = self._json_decode(data, encoding)
-            print(f"Received response {self.response!r} from {self.addr}")
+            logger.debug("Received response %r from %s", self.response, self.addr)
             self._process_response_json_content()
         else:
             # Binary or unknown content-type
             self.response = data
-            print(
-                f"Received {self.jsonheader['content-type']} "
-                f"response from {self.addr}"
+            logger.debug(
+                "Received %s response from %s",
+                self.jsonheader["content-type"],
+                self.addr,
             )
             self._process_response_binary_content()
-        # Close when response has been processed
+
+    def _stream_response(self):
+        if self._body_remaining is None:
+            self._body_remaining = self.jsonheader["content-length"]
+            compression = self.jsonheader.get("content-compression")
+            if compression is not None:
+                self._decompressor = libcompress.decompressor(compression)
+        # Pass on whatever part of the body has arrived, the receive buffer
+        # never holds more than one read's worth of it:
+        nbytes = min(len(self._recv_buffer), self._body_remaining)
+        if nbytes:
+            chunk = bytes(self._recv_buffer.peek(nbytes))
+            self._recv_buffer.consume(nbytes)
+            self._body_remaining -= nbytes
+            if self._decompressor is not None:
+                chunk = self._decompressor.decompress(chunk)
+                # The limit applies to the decompressed body too:
+                self._body_decoded += len(chunk)
+                limit = self.max_response_size
+                if limit is not None and self._body_decoded > limit:
+                    raise ValueError(
+                        f"Response decompresses to more than the limit of "
+                        f"{limit} bytes."
+                    )
+            if chunk:
+                self._process_response_chunk(chunk)
+        if not self._body_remaining:
+            if self._decompressor is not None and not self._decompressor.eof:
+                raise ValueError("Truncated compressed response.")
+            self.response = self.jsonheader
+
+
+class _QuietMessage(Message):
+    # The responses are returned to the caller, not printed:
+    def _process_response_json_content(self):
+        pass
+
+    def _process_response_binary_content(self):
+        pass
+
+
+class Connection:
+    """A blocking keep-alive connection, '.request()' sends a request and
+    waits for its response. What 'connection_pool()' pools. 'options' are
+    passed on to Message (header_mode, accept_compression, ...)."""
+
+    def __init__(self, host, port, connect_timeout=None, **options):
+        self.addr = (host, port)
+        self.selector = selectors.DefaultSelector()
+        sock = libresolver.create_connection(self.addr, connect_timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.message = _QuietMessage(
+            self.selector, sock, self.addr, keep_alive=True, **options
+        )
+        self.selector.register(sock, selectors.EVENT_READ, data=self.message)
+
+    def request(self, request, timeout=None):
+        """Send a request dictionary (as built by app-client.py) and return
+        the decoded response content. On a timeout the connection is closed,
+        a late response would otherwise be taken for the next one's."""
+        message = self.message
+        if message.sock is None:
+            raise ConnectionError(f"Connection to {self.addr} is closed.")
+        message.add_request(request)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not message.responses:
+            if message.sock is None:
+                raise ConnectionError(f"{self.addr} closed the connection.")
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.close()
+                    raise TimeoutError(f"No response from {self.addr} in {timeout}s.")
+            for key, mask in self.selector.select(remaining):
+                message.process_events(mask)
+        return message.responses.pop()
+
+    def is_alive(self):
+        """Health check for a connection waiting in a pool, without a round
+        trip: it must still be open, have nothing in flight, and the server
+        must neither have closed it (e.g. after its idle timeout) nor sent
+        anything unasked."""
+        message = self.message
+        if message.sock is None or message._inflight or message._pending:
+            return False
+        try:
+            message.sock.recv(1, socket.MSG_PEEK)
+        except BlockingIOError:
+            # Nothing to read, as it should be:
+            return True
+        except OSError:
+            return False
+        # EOF or unexpected bytes:
+        return False
+
+    def close(self):
+        if self.message.sock is not None:
+            self.message.close()
+        self.selector.close()
+
+
+def connection_pool(host, port, min_size=0, max_size=10, idle_timeout=60.0, **options):
+    """Pool of 'Connection's to one server, see libpool.ConnectionPool. The
+    'options' are passed on to every Connection:
+
+        pool = connection_pool(host, port, max_size=4)
+        with pool.connection() as conn:
+            response = conn.request(request)
+
+    libpool.PoolRegistry(connection_pool) keeps one pool per server."""
+    return libpool.ConnectionPool(
+        lambda: Connection(host, port, **options),
+        min_size=min_size,
+        max_size=max_size,
+        idle_timeout=idle_timeout,
+    )
+
+
+def batch_request(requests):
+    """Pack request contents (dictionaries with an 'action', like
+    {"action": "search", "value": "ring"}) into one 'batch' request."""
+    return dict(
+        type="text/json",
+        encoding="utf-8",
+        content=dict(action="batch", requests=list(requests)),
+    )
+
+
+def iter_batched(pool, requests, batch_size=100, timeout=None):
+    """Send the request contents of the iterable 'requests' through 'pool',
+    'batch_size' per batch message, and yield their response contents in
+    order as each batch is answered. 'requests' is consumed lazily, a file of
+    JSON lines streams through in constant memory.
+
+    A batch whose connection was closed under it (e.g. at the server's
+    max-requests) is sent again once on a new connection, so the requests
+    must be safe to repeat, as lookups are."""
+    batch = []
+    for request in requests:
+        batch.append(request)
+        if len(batch) == batch_size:
+            yield from _send_batch(pool, batch, timeout)
+            batch = []
+    if batch:
+        yield from _send_batch(pool, batch, timeout)
+
+
+def _send_batch(pool, batch, timeout):
+    request = batch_request(batch)
+    for attempt in range(2):
+        try:
+            with pool.connection() as conn:
+                response = conn.request(request, timeout)
+            break
+        except ConnectionError:
+            if attempt:
+                raise
+    results = response.get("result")
+    if not isinstance(results, list) or len(results) != len(batch):
+        raise ValueError(f"Invalid batch response: {results!r}")
+    return results
+
+
+class ResponseStream:
+    """Send one request and iterate over the body of its response, chunk by
+    chunk as it arrives, with memory use independent of the body size:
+
+        with ResponseStream(host, port, request) as stream:
+            for chunk in stream:
+                ...
+
+    'header' holds the response header once the first chunk (or the end of
+    an empty body) was seen."""
+
+    def __init__(
+        self,
+        host,
+        port,
+        request,
+        max_response_size=None,
+        header_mode="auto",
+        accept_compression=None,
+    ):
+        self.addr = (host, port)
+        self.selector = selectors.DefaultSelector()
+        sock = libresolver.create_connection(self.addr)
+        sock.setblocking(False)
+        self.message = Message(
+            self.selector,
+            sock,
+            self.addr,
+            request,
+            header_mode=header_mode,
+            stream=True,
+            max_response_size=max_response_size,
+            accept_compression=accept_compression,
+        )
+        self.selector.register(
+            sock, selectors.EVENT_READ | selectors.EVENT_WRITE, data=self.message
+        )
+
+    @property
+    def header(self):
+        if self.message.responses:
+            return self.message.responses[0]
+        return self.message.jsonheader
+
+    def __iter__(self):
+        message = self.message
+        while True:
+            while message.chunks:
+                yield message.chunks.popleft()
+            if message.responses:
+                return
+            if message.sock is None:
+                raise ConnectionError(f"{self.addr} closed before the response ended.")
+            for key, mask in self.selector.select():
+                message.process_events(mask)
+
+    def json_items(self, key="result"):
+        """Iterate over the elements of the array in a JSON response, see
+        'iter_json_items()'."""
+        chunks = iter(self)
+        first = next(chunks, b"")
+        encoding = self.header["content-encoding"]
+        yield from iter_json_items(_chain(first, chunks), key, encoding)
+
+    def close(self):
+        if self.message.sock is not None:
+            self.message.close()
+        self.selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
         self.close()
+
+
+def _chain(first, rest):
+    yield first
+    yield from rest
+
+
+def iter_json_items(chunks, key="result", encoding="utf-8"):
+    """Decode the JSON array that is the value of 'key' incrementally from an
+    iterable of byte chunks, yielding every element as soon as it is complete.
+    Only the element being decoded is held in memory, not the whole array.
+
+    A document without such an array, like an error response, raises
+    ValueError once it ended."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder(encoding)()
+    array_start = re.compile(r'"%s"\s*:\s*\[' % re.escape(key))
+    buf = ""
+    in_array = False
+    for chunk in chunks:
+        # Multi-byte characters split across chunks are completed by the next:
+        buf += text_decoder.decode(chunk)
+        if not in_array:
+            match = array_start.search(buf)
+            if match is None:
+                continue
+            buf = buf[match.end() :]
+            in_array = True
+        pos = 0
+        while True:
+            # Skip to the next element:
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos == len(buf):
+                break
+            if buf[pos] == "]":
+                return
+            try:
+                item, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Incomplete, wait for more data:
+                break
+            if end == len(buf):
+                # A number at the end of the buffer may go on in the next
+                # chunk, an element is only done once ',' or ']' follows:
+                break
+            yield item
+            pos = end
+        buf = buf[pos:]
+    buf += text_decoder.decode(b"", final=True)
+    if not in_array:
+        raise ValueError(f"No {key!r} array in the response: {buf[:200]!r}")
+    raise ValueError("The response ended inside the array.")
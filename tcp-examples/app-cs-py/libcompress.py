@@ -0,0 +1,57 @@
+import lzma
+import zlib
+
+# Compressions a message body can be sent with, named like the HTTP content
+# codings ('deflate' is the zlib format). lzma compresses best but is by far
+# the slowest, it suits archival payloads rather than interactive traffic:
+CODECS = ("deflate", "gzip", "lzma")
+_WBITS = {"deflate": zlib.MAX_WBITS, "gzip": 16 + zlib.MAX_WBITS}
+
+ZLIB_LEVEL = 6
+LZMA_PRESET = 6
+
+
+def negotiate(offered, enabled):
+    """Pick the compression for a connection: the first one in the client's
+    list of 'offered' compressions (most preferred first) that is 'enabled'.
+    None if there's no match, or 'offered' isn't a list."""
+    if not isinstance(offered, list):
+        return None
+    for codec in offered:
+        if codec in enabled and codec in CODECS:
+            return codec
+    return None
+
+
+def compress(data, codec):
+    if codec == "lzma":
+        return lzma.compress(data, preset=LZMA_PRESET)
+    compressor = zlib.compressobj(ZLIB_LEVEL, zlib.DEFLATED, _WBITS[codec])
+    return compressor.compress(data) + compressor.flush()
+
+
+def decompressor(codec):
+    """Return an object whose '.decompress()' takes a compressed body piece
+    by piece, for bodies that are consumed as they arrive."""
+    if codec == "lzma":
+        return lzma.LZMADecompressor()
+    if codec in _WBITS:
+        return zlib.decompressobj(_WBITS[codec])
+    raise ValueError(f"Unknown compression {codec!r}.")
+
+
+def decompress(data, codec, max_size=None):
+    """Decompress a whole body. A body that would decompress to more than
+    'max_size' bytes raises ValueError before it is fully inflated."""
+    decoder = decompressor(codec)
+    if max_size is None:
+        content = decoder.decompress(data)
+    else:
+        content = decoder.decompress(data, max_size + 1)
+        if len(content) > max_size:
+            raise ValueError(
+                f"Body decompresses to more than the limit of {max_size} bytes."
+            )
+    if not decoder.eof:
+        raise ValueError(f"Truncated {codec} body.")
+    return content
@@ -0,0 +1,219 @@
+import signal
+import socket
+import logging
+import selectors
+import threading
+import collections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger("libhandlers")
+
+# Where a handler runs:
+#   - inline: called directly in the selector loop, only for handlers that
+#     never block;
+#   - thread: on a thread pool, for handlers that wait on I/O;
+#   - process: on a process pool, for CPU-bound handlers. Handlers and
+#     requests must be picklable (module-level functions, plain data).
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+MODES = (INLINE, THREAD, PROCESS)
+
+Handler = collections.namedtuple("Handler", "func mode max_concurrency cacheable")
+
+
+def _init_pool_process():
+    # Forked from a server that may turn SIGTERM into a KeyboardInterrupt: a
+    # pool process just exits on it, without a traceback:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+class HandlerRegistry:
+    """Maps request actions to handlers and runs them without stalling the
+    selector loop.
+
+    Completions of offloaded handlers are queued by the executor threads and
+    signalled through a wake-up socket registered with the selector, so the
+    callbacks always run in the loop's thread."""
+
+    def __init__(self, max_threads=None, max_processes=None):
+        self._handlers = {}
+        self.max_threads = max_threads
+        self.max_processes = max_processes
+        self._thread_pool = None
+        self._process_pool = None
+        # Per-action number of handlers running, and dispatches waiting for
+        # one of them to finish because of the action's concurrency limit:
+        self._running = collections.Counter()
+        self._waiting = collections.defaultdict(collections.deque)
+        self._completed = collections.deque()
+        self._lock = threading.Lock()
+        self.selector = None
+        self._wakeup_r = self._wakeup_w = None
+        self._wakeup_pending = False
+
+    def register(
+        self, action, func, mode=INLINE, max_concurrency=None, cacheable=False
+    ):
+        """'cacheable' handlers return the same response for the same request
+        until their data changes, so that responses can be cached."""
+        if mode not in MODES:
+            raise ValueError(f"Invalid handler mode {mode!r}.")
+        self._handlers[action] = Handler(func, mode, max_concurrency, cacheable)
+
+    def handler(self, action, mode=INLINE, max_concurrency=None, cacheable=False):
+        """Decorator form of '.register()'."""
+
+        def decorator(func):
+            self.register(action, func, mode, max_concurrency, cacheable)
+            return func
+
+        return decorator
+
+    def __contains__(self, action):
+        return action in self._handlers
+
+    def is_cacheable(self, action):
+        handler = self._handlers.get(action)
+        return handler is not None and handler.cacheable
+
+    def attach(self, selector):
+        """Register the wake-up socket with the selector of the calling
+        process. Must be called after a fork(), not before."""
+        self.selector = selector
+        self._wakeup_r, self._wakeup_w = socket.socketpair()
+        self._wakeup_r.setblocking(False)
+        self._wakeup_w.setblocking(False)
+        selector.register(self._wakeup_r, selectors.EVENT_READ, data=self)
+
+    def dispatch(self, action, request, callback):
+        """Run the handler of 'action' for 'request'. 'callback' is called
+        with a concurrent.futures.Future holding the handler's result, right
+        away for inline handlers, or later from '.process_completions()'."""
+        handler = self._handlers[action]
+        if handler.mode == INLINE:
+            callback(self._run_inline(handler.func, request))
+            return
+        if (
+            handler.max_concurrency is not None
+            and self._running[action] >= handler.max_concurrency
+        ):
+            self._waiting[action].append((request, callback))
+            return
+        self._submit(action, handler, request, callback)
+
+    def run_in_thread(self, func, arg, callback):
+        """Run 'func(arg)' on the thread pool, for work of the selector loop
+        that isn't a handler (e.g. compressing a large response). 'callback'
+        gets the future like for '.dispatch()'."""
+        self._submit(None, Handler(func, THREAD, None, False), arg, callback)
+
+    def _run_inline(self, func, request):
+        future = concurrent.futures.Future()
+        try:
+            future.set_result(func(request))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _submit(self, action, handler, request, callback):
+        if self.selector is None:
+            raise RuntimeError("attach() the registry to a selector first.")
+        try:
+            future = self._executor(handler.mode).submit(handler.func, request)
+        except Exception as e:
+            # E.g. a process of the pool died. A broken pool refuses all work
+            # for good, the next dispatch creates a new one. This request
+            # fails, without taking a slot of the concurrency limit:
+            if isinstance(e, BrokenProcessPool):
+                self._process_pool.shutdown(wait=False, cancel_futures=True)
+                self._process_pool = None
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+            callback(future)
+            return
+        self._running[action] += 1
+        future.add_done_callback(
+            lambda future: self._complete(action, callback, future)
+        )
+
+    def _submit_waiting(self, action):
+        # Dispatches held back by the concurrency limit take the free slots:
+        waiting = self._waiting.get(action)
+        while waiting:
+            handler = self._handlers[action]
+            if self._running[action] >= handler.max_concurrency:
+                return
+            request, callback = waiting.popleft()
+            try:
+                self._submit(action, handler, request, callback)
+            except Exception:
+                logger.exception("Dispatching %r failed", action)
+
+    def _executor(self, mode):
+        # Pools are created on first use, so that a forking server creates
+        # them in each worker instead of sharing the parent's:
+        if mode == THREAD:
+            if self._thread_pool is None:
+                self._thread_pool = concurrent.futures.ThreadPoolExecutor(
+                    self.max_threads, thread_name_prefix="handler"
+                )
+            return self._thread_pool
+        if self._process_pool is None:
+            self._process_pool = concurrent.futures.ProcessPoolExecutor(
+                self.max_processes, initializer=_init_pool_process
+            )
+        return self._process_pool
+
+    def _complete(self, action, callback, future):
+        # Runs in an executor thread: only queue the completion and wake up the
+        # selector loop. One wake-up byte is enough for any number of
+        # completions queued before the loop drains them:
+        with self._lock:
+            self._completed.append((action, callback, future))
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        try:
+            self._wakeup_w.send(b"\0")
+        except (BlockingIOError, OSError):
+            pass
+
+    def process_completions(self):
+        """Run the callbacks of finished handlers. Called by the selector loop
+        when the wake-up socket is readable."""
+        try:
+            while self._wakeup_r.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            self._wakeup_pending = False
+            completed, self._completed = self._completed, collections.deque()
+        # Each completion on its own, one that fails must not lose the others
+        # or their slots:
+        for action, callback, future in completed:
+            self._running[action] -= 1
+            self._submit_waiting(action)
+            try:
+                callback(future)
+            except Exception:
+                logger.exception("Completion callback of %r failed", action)
+
+    def close(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False, cancel_futures=True)
+        if self._process_pool is not None:
+            # Waited for: a forking server's worker leaves with os._exit(),
+            # which would skip the pool's own cleanup at exit and leave its
+            # processes behind:
+            self._process_pool.shutdown(wait=True, cancel_futures=True)
+        if self.selector is not None:
+            try:
+                self.selector.unregister(self._wakeup_r)
+            except (KeyError, ValueError):
+                pass
+            self._wakeup_r.close()
+            self._wakeup_w.close()
+            self.selector = None
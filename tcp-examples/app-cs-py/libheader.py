@@ -0,0 +1,147 @@
+import sys
+import json
+import struct
+
+# Every message starts with a 2-byte protoheader. Originally it always holds
+# the big-endian length of the JSON header that follows. A binary header is
+# announced instead by a magic byte followed by the header version. A JSON
+# header would have to be at least 0xFF00 bytes long for its length to start
+# with the magic byte, which never happens, so both can share one connection:
+MAGIC = 0xFF
+VERSION = 1
+PROTOHEADER = struct.Struct(">H")
+MAGIC_PROTOHEADER = struct.Struct(">BB")
+
+# Version 1 binary header: flags, content-type code, content-encoding code and
+# content-length, in network byte order:
+BINARY_HEADER = struct.Struct(">BBBQ")
+BINARY_HEADER_LEN = {1: BINARY_HEADER.size}
+
+FLAG_LITTLE_ENDIAN = 0x01
+FLAG_CONNECTION_CLOSE = 0x02
+# Two bits of the flags hold the index of the body's compression in
+# COMPRESSIONS, 0 for an uncompressed body:
+FLAG_COMPRESSION_SHIFT = 2
+FLAG_COMPRESSION_MASK = 0x0C
+
+# The enumerated values a binary header can carry. A message with any other
+# content type or encoding is sent with a JSON header:
+CONTENT_TYPES = (
+    "text/json",
+    "binary/custom-client-binary-type",
+    "binary/custom-server-binary-type",
+)
+CONTENT_ENCODINGS = ("utf-8", "binary")
+COMPRESSIONS = (None, "deflate", "gzip", "lzma")
+_CONTENT_TYPE_CODES = {value: code for code, value in enumerate(CONTENT_TYPES)}
+_CONTENT_ENCODING_CODES = {
+    value: code for code, value in enumerate(CONTENT_ENCODINGS)
+}
+_COMPRESSION_CODES = {value: code for code, value in enumerate(COMPRESSIONS)}
+
+
+def can_encode_binary(header):
+    # Request ids only fit in JSON headers:
+    return (
+        "request-id" not in header
+        and header["content-type"] in _CONTENT_TYPE_CODES
+        and header["content-encoding"] in _CONTENT_ENCODING_CODES
+        and header.get("content-compression") in _COMPRESSION_CODES
+    )
+
+
+def encode_json(header):
+    """Return the protoheader and JSON header for 'header'."""
+    header_bytes = json_encode(header, "utf-8")
+    return PROTOHEADER.pack(len(header_bytes)) + header_bytes
+
+
+def encode_binary(header):
+    """Return the protoheader and binary header for 'header'."""
+    flags = 0
+    if header["byteorder"] == "little":
+        flags |= FLAG_LITTLE_ENDIAN
+    if header.get("connection") == "close":
+        flags |= FLAG_CONNECTION_CLOSE
+    compression = _COMPRESSION_CODES[header.get("content-compression")]
+    flags |= compression << FLAG_COMPRESSION_SHIFT
+    return MAGIC_PROTOHEADER.pack(MAGIC, VERSION) + BINARY_HEADER.pack(
+        flags,
+        _CONTENT_TYPE_CODES[header["content-type"]],
+        _CONTENT_ENCODING_CODES[header["content-encoding"]],
+        header["content-length"],
+    )
+
+
+def reframe(message, fields):
+    """Return a copy of the framed 'message', which has a JSON header, with
+    the header 'fields' replaced, e.g. a cached response with the request id
+    of the request it now answers."""
+    view = memoryview(message)
+    header_len = PROTOHEADER.unpack(view[: PROTOHEADER.size])[0]
+    header_end = PROTOHEADER.size + header_len
+    header = decode_json(view[PROTOHEADER.size : header_end])
+    header.update(fields)
+    return encode_json(header) + view[header_end:]
+
+
+def decode_protoheader(data):
+    """Return (header version, header length) for a 2-byte protoheader.
+
+    The version is None for a JSON header."""
+    if data[0] != MAGIC:
+        return None, PROTOHEADER.unpack(data)[0]
+    version = data[1]
+    if version not in BINARY_HEADER_LEN:
+        raise ValueError(f"Unsupported binary header version {version}.")
+    return version, BINARY_HEADER_LEN[version]
+
+
+def decode_json(data):
+    return json_decode(data, "utf-8")
+
+
+def json_encode(obj, encoding):
+    return json.dumps(obj, ensure_ascii=False).encode(encoding)
+
+
+def json_decode(json_bytes, encoding):
+    return json.loads(bytes(json_bytes).decode(encoding))
+
+
+def decode_binary(data):
+    """Decode a binary header into the same dictionary a JSON header gives."""
+    flags, content_type, content_encoding, content_length = BINARY_HEADER.unpack(
+        data
+    )
+    try:
+        header = {
+            "byteorder": "little" if flags & FLAG_LITTLE_ENDIAN else "big",
+            "content-type": CONTENT_TYPES[content_type],
+            "content-encoding": CONTENT_ENCODINGS[content_encoding],
+            "content-length": content_length,
+        }
+    except IndexError:
+        raise ValueError("Unknown content type or encoding in binary header.")
+    if flags & FLAG_CONNECTION_CLOSE:
+        header["connection"] = "close"
+    compression = (flags & FLAG_COMPRESSION_MASK) >> FLAG_COMPRESSION_SHIFT
+    if compression:
+        header["content-compression"] = COMPRESSIONS[compression]
+    return header
+
+
+def create_header(
+    *, content_length, content_type, content_encoding, content_compression=None
+):
+    # 'content-encoding' stays the encoding of the uncompressed body, a
+    # compressed body additionally has 'content-compression':
+    header = {
+        "byteorder": sys.byteorder,
+        "content-type": content_type,
+        "content-encoding": content_encoding,
+        "content-length": content_length,
+    }
+    if content_compression is not None:
+        header["content-compression"] = content_compression
+    return header
@@ -0,0 +1,166 @@
+import time
+import bisect
+import logging
+import collections
+
+
+class Histogram:
+    """Log-linear histogram of durations in seconds.
+
+    Every power of two between 'lowest' and 'highest' is split into
+    'sub_buckets' linear buckets, so recording a value is one binary search
+    and percentiles are accurate to within 1/sub_buckets of the value."""
+
+    def __init__(self, lowest=1e-6, highest=1e3, sub_buckets=8):
+        bounds = []
+        base = lowest
+        while base < highest:
+            bounds.extend(base * (1 + i / sub_buckets) for i in range(sub_buckets))
+            base *= 2
+        self._bounds = bounds
+        # One more bucket for values past the last bound:
+        self._counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = float("inf")
+        self.max = 0.0
+
+    def record(self, value):
+        self._counts[bisect.bisect_right(self._bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, count in enumerate(other._counts):
+            self._counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for i, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank and count:
+                # Report the upper bound of the bucket, clamped to what was
+                # actually recorded:
+                upper = self._bounds[i] if i < len(self._bounds) else self.max
+                return min(max(upper, self.min), self.max)
+        return self.max
+
+    def snapshot(self, percentiles=(50, 90, 99, 99.9)):
+        snapshot = {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "min": self.min if self.count else 0.0,
+            "max": self.max,
+        }
+        for percent in percentiles:
+            snapshot[f"p{percent:g}"] = self.percentile(percent)
+        return snapshot
+
+    def to_dict(self):
+        """Raw state, e.g. to send it to another process for '.merge()'."""
+        return {
+            "counts": self._counts,
+            "count": self.count,
+            "total": self.total,
+            "min": self.min,
+            "max": self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, state):
+        histogram = cls()
+        histogram._counts = list(state["counts"])
+        histogram.count = state["count"]
+        histogram.total = state["total"]
+        histogram.min = state["min"]
+        histogram.max = state["max"]
+        return histogram
+
+
+class Metrics:
+    """Counters, gauges and histograms of one process. Updating a metric is
+    a dictionary operation, cheap enough for every request."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.counters = collections.Counter()
+        self.gauges = collections.Counter()
+        self.histograms = {}
+        self._last_counters = {}
+        self._last_snapshot = self.started
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def snapshot(self):
+        """Return every metric as plain data. The per-second rates of the
+        counters cover the time since the previous snapshot."""
+        now = time.monotonic()
+        elapsed = max(now - self._last_snapshot, 1e-9)
+        rates = {
+            name: (value - self._last_counters.get(name, 0)) / elapsed
+            for name, value in self.counters.items()
+        }
+        self._last_counters = dict(self.counters)
+        self._last_snapshot = now
+        return {
+            "uptime": now - self.started,
+            "counters": dict(self.counters),
+            "rates": rates,
+            "gauges": dict(self.gauges),
+            "histograms": {
+                name: histogram.snapshot()
+                for name, histogram in self.histograms.items()
+            },
+        }
+
+
+class RateLimitFilter(logging.Filter):
+    """Lets at most 'burst' records per call site through every 'interval'
+    seconds. The first record let through afterwards says how many were
+    dropped."""
+
+    def __init__(self, burst=10, interval=1.0):
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        # (path, line) -> [window start, records passed, records dropped]:
+        self._sites = {}
+
+    def filter(self, record):
+        now = time.monotonic()
+        site = self._sites.get((record.pathname, record.lineno))
+        if site is None:
+            site = self._sites[(record.pathname, record.lineno)] = [now, 0, 0]
+        if now - site[0] >= self.interval:
+            if site[2]:
+                record.msg = f"{record.msg} [{site[2]} similar messages suppressed]"
+            site[:] = [now, 0, 0]
+        if site[1] < self.burst:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+def setup_logging(level="INFO", burst=10, interval=1.0):
+    logging.basicConfig(
+        level=level,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RateLimitFilter(burst, interval))
@@ -0,0 +1,348 @@
+import time
+import asyncio
+import threading
+import contextlib
+import collections
+
+
+class PoolTimeout(TimeoutError):
+    """No connection of the pool became available in time."""
+
+
+def is_alive(conn):
+    """The default health check: the connection's own '.is_alive()'."""
+    return conn.is_alive()
+
+
+class _Pool:
+    """Bookkeeping shared by the blocking and the asyncio pool.
+
+    'connect' opens a new connection. Connections checked in are kept for
+    reuse until they were idle for 'idle_timeout' seconds, but the pool never
+    shrinks below 'min_size' that way. At most 'max_size' connections are
+    open at once, checked out or not; checkouts beyond that wait for a
+    connection to be checked in. 'health_check(conn)' is called on every
+    checkout and checkin, connections failing it are closed and replaced."""
+
+    def __init__(
+        self,
+        connect,
+        min_size=0,
+        max_size=10,
+        idle_timeout=60.0,
+        health_check=is_alive,
+        clock=time.monotonic,
+    ):
+        if not 0 <= min_size <= max_size or max_size < 1:
+            raise ValueError(f"Invalid pool size {min_size}..{max_size}.")
+        self._connect = connect
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._health_check = health_check
+        self._clock = clock
+        # (connection, time it was checked in), most recently used last:
+        self._idle = collections.deque()
+        # Connections open or being opened, checked out or idle:
+        self.size = 0
+        self.closed = False
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.failed_checks = 0
+        self.waits = 0
+
+    def _take_idle(self):
+        # The most recently used connection is handed out first, so that
+        # under light load the rest go idle long enough to be evicted:
+        while self._idle:
+            conn, _ = self._idle.pop()
+            if self._check(conn):
+                self.reused += 1
+                return conn
+            self._discard(conn)
+        return None
+
+    def _check(self, conn):
+        try:
+            healthy = self._health_check(conn)
+        except Exception:
+            healthy = False
+        if not healthy:
+            self.failed_checks += 1
+        return healthy
+
+    def _put_idle(self, conn, discard):
+        """Check a connection in, return False if it was closed instead."""
+        if discard or self.closed or not self._check(conn):
+            self._discard(conn)
+            return False
+        self._idle.append((conn, self._clock()))
+        return True
+
+    def _discard(self, conn):
+        self.size -= 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _evict_idle(self):
+        if self.idle_timeout is None:
+            return
+        now = self._clock()
+        while (
+            self._idle
+            and self.size > self.min_size
+            and now - self._idle[0][1] > self.idle_timeout
+        ):
+            conn, _ = self._idle.popleft()
+            self.evicted += 1
+            self._discard(conn)
+
+    def _close_idle(self):
+        self.closed = True
+        while self._idle:
+            conn, _ = self._idle.popleft()
+            self._discard(conn)
+
+    def stats(self):
+        return {
+            "size": self.size,
+            "idle": len(self._idle),
+            "created": self.created,
+            "reused": self.reused,
+            "evicted": self.evicted,
+            "failed_checks": self.failed_checks,
+            "waits": self.waits,
+        }
+
+
+class ConnectionPool(_Pool):
+    """Pool of blocking connections, safe to share between threads. See
+    libclient.connection_pool()."""
+
+    def __init__(self, connect, **options):
+        super().__init__(connect, **options)
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Check out a connection, waiting up to 'timeout' seconds (None for
+        no limit) if all 'max_size' connections are in use."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        waited = False
+        with self._cond:
+            while True:
+                if self.closed:
+                    raise RuntimeError("Pool is closed.")
+                self._evict_idle()
+                conn = self._take_idle()
+                if conn is not None:
+                    return conn
+                if self.size < self.max_size:
+                    # Reserve the slot, the connection is opened unlocked:
+                    self.size += 1
+                    break
+                if not waited:
+                    self.waits += 1
+                    waited = True
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise PoolTimeout(f"No connection available after {timeout}s.")
+                self._cond.wait(remaining)
+        try:
+            conn = self._connect()
+        except BaseException:
+            with self._cond:
+                self.size -= 1
+                self._cond.notify()
+            raise
+        with self._cond:
+            self.created += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        """Check a connection back in. 'discard' closes it instead, e.g.
+        after an error left it in an unknown state."""
+        with self._cond:
+            self._put_idle(conn, discard)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """Check out a connection for the 'with' block. It is discarded if the
+        block raises, since a request may have been left half done."""
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def fill(self):
+        """Evict the connections idle for too long and open new ones up to
+        'min_size'. Checkouts do the former anyway, a client that wants its
+        minimum of warm connections calls this periodically."""
+        while True:
+            with self._cond:
+                self._evict_idle()
+                if self.closed or self.size >= self.min_size:
+                    return
+                self.size += 1
+            try:
+                conn = self._connect()
+            except BaseException:
+                with self._cond:
+                    self.size -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self.created += 1
+                self._put_idle(conn, discard=False)
+                self._cond.notify()
+
+    def close(self):
+        """Close the idle connections, checked out ones are closed when they
+        are released."""
+        with self._cond:
+            self._close_idle()
+            self._cond.notify_all()
+
+
+class AsyncConnectionPool(_Pool):
+    """Pool of asyncio connections, used from one event loop. 'connect' is a
+    coroutine function. See libasync.connection_pool()."""
+
+    def __init__(self, connect, **options):
+        super().__init__(connect, **options)
+        # Futures of the checkouts waiting for a connection, oldest first.
+        # They get a connection, or None when a slot was freed instead:
+        self._waiters = collections.deque()
+
+    async def acquire(self, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        waited = False
+        while True:
+            if self.closed:
+                raise RuntimeError("Pool is closed.")
+            self._evict_idle()
+            conn = self._take_idle()
+            if conn is not None:
+                return conn
+            if self.size < self.max_size:
+                return await self._open()
+            if not waited:
+                self.waits += 1
+                waited = True
+            waiter = loop.create_future()
+            self._waiters.append(waiter)
+            remaining = None if deadline is None else deadline - loop.time()
+            try:
+                conn = await asyncio.wait_for(waiter, remaining)
+            except BaseException as e:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                elif (
+                    waiter.done()
+                    and not waiter.cancelled()
+                    and waiter.exception() is None
+                ):
+                    # Handed a connection (or a free slot) just as the wait
+                    # was given up, pass it on:
+                    self._pass_on(waiter.result())
+                if isinstance(e, asyncio.TimeoutError):
+                    raise PoolTimeout(f"No connection available after {timeout}s.")
+                raise
+            if conn is not None:
+                self.reused += 1
+                return conn
+
+    async def _open(self):
+        self.size += 1
+        try:
+            conn = await self._connect()
+        except BaseException:
+            self.size -= 1
+            self._wake_waiter(None)
+            raise
+        self.created += 1
+        return conn
+
+    def release(self, conn, discard=False):
+        if discard or self.closed or not self._check(conn):
+            self._discard(conn)
+            # The slot is free, a waiter can open a connection of its own:
+            self._wake_waiter(None)
+            return
+        # Hand the connection straight to the oldest waiter, if there is one:
+        if not self._wake_waiter(conn):
+            self._idle.append((conn, self._clock()))
+
+    def _pass_on(self, conn):
+        if conn is None:
+            self._wake_waiter(None)
+        else:
+            self.release(conn)
+
+    def _wake_waiter(self, conn):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(conn)
+                return True
+        return False
+
+    @contextlib.asynccontextmanager
+    async def connection(self, timeout=None):
+        conn = await self.acquire(timeout)
+        try:
+            yield conn
+        except BaseException:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    async def fill(self):
+        self._evict_idle()
+        while self.size < self.min_size:
+            self.release(await self._open())
+
+    def close(self):
+        self._close_idle()
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(RuntimeError("Pool is closed."))
+
+
+class PoolRegistry:
+    """One pool per (host, port), created on first use with
+    'new_pool(host, port, **options)', e.g. libclient.connection_pool."""
+
+    def __init__(self, new_pool, **options):
+        self._new_pool = new_pool
+        self._options = options
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get(self, host, port):
+        with self._lock:
+            pool = self._pools.get((host, port))
+            if pool is None:
+                pool = self._pools[(host, port)] = self._new_pool(
+                    host, port, **self._options
+                )
+            return pool
+
+    def stats(self):
+        return {
+            f"{host}:{port}": pool.stats() for (host, port), pool in self._pools.items()
+        }
+
+    def close(self):
+        with self._lock:
+            for pool in self._pools.values():
+                pool.close()
+            self._pools.clear()
@@ -0,0 +1,261 @@
+import os
+import time
+import socket
+import asyncio
+import threading
+import collections
+import concurrent.futures
+
+# getaddrinfo() doesn't tell how long the records it returns are valid for,
+# answers are kept for fixed times instead. Failures (unknown names) are
+# kept for a shorter time, so that a name that appears is soon found:
+TTL = 60.0
+NEGATIVE_TTL = 5.0
+
+
+class Resolver:
+    """Resolves host names with getaddrinfo(), IPv4 and IPv6 alike, into
+    the (family, type, proto, canonname, sockaddr) tuples of TCP addresses.
+
+    Answers are cached for 'ttl' seconds, and getaddrinfo() errors for
+    'negative_ttl' seconds, least recently used first evicted beyond
+    'max_entries'. Concurrent lookups of the same name, from any thread or
+    event loop, share a single getaddrinfo() call. Bulk and asyncio lookups
+    run on a pool of 'max_workers' threads. 'getaddrinfo' can be replaced,
+    e.g. with a HostsFile's."""
+
+    def __init__(
+        self,
+        ttl=TTL,
+        negative_ttl=NEGATIVE_TTL,
+        max_entries=1024,
+        max_workers=8,
+        getaddrinfo=socket.getaddrinfo,
+        clock=time.monotonic,
+    ):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.max_workers = max_workers
+        self._getaddrinfo = getaddrinfo
+        self._clock = clock
+        # (host, port, family) -> (addresses or exception, expiry time), least
+        # recently used first:
+        self._entries = collections.OrderedDict()
+        # Futures of the lookups running, by key:
+        self._running = {}
+        self._lock = threading.Lock()
+        self._thread_pool = None
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.expirations = 0
+        self.evictions = 0
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC, timeout=None):
+        """Return the addresses of 'host', in getaddrinfo()'s order of
+        preference. socket.gaierror if it can't be resolved. A lookup that
+        isn't cached or running already runs in the calling thread."""
+        future, owner = self._lookup((host, port, family))
+        if owner:
+            self._run(future, (host, port, family))
+        return future.result(timeout)
+
+    def resolve_many(self, hosts, port, family=socket.AF_UNSPEC):
+        """Resolve all of 'hosts' in parallel on the thread pool. Return a
+        dict mapping every host to its addresses, or to the exception its
+        lookup raised."""
+        futures = {host: self._submit((host, port, family)) for host in hosts}
+        results = {}
+        for host, future in futures.items():
+            try:
+                results[host] = future.result()
+            except OSError as e:
+                results[host] = e
+        return results
+
+    async def resolve_async(self, host, port, family=socket.AF_UNSPEC):
+        """'.resolve()' for coroutines, the lookup runs on the thread pool."""
+        return await asyncio.wrap_future(self._submit((host, port, family)))
+
+    def create_connection(self, address, timeout=None):
+        """Like socket.create_connection(), with the addresses of this
+        resolver: try them in order until one connects."""
+        host, port = address
+        error = None
+        for family, type, proto, _, sockaddr in self.resolve(host, port):
+            sock = socket.socket(family, type, proto)
+            try:
+                sock.settimeout(timeout)
+                sock.connect(sockaddr)
+                return sock
+            except OSError as e:
+                sock.close()
+                error = e
+        if error is None:
+            error = OSError(f"No addresses for {host}")
+        raise error
+
+    def _lookup(self, key):
+        # Return a future for the answer, and whether the caller has to run
+        # the lookup to complete it:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                result, expires = entry
+                if self._clock() < expires:
+                    self._entries.move_to_end(key)
+                    future = concurrent.futures.Future()
+                    if isinstance(result, Exception):
+                        self.negative_hits += 1
+                        # A new one, the cached one doesn't collect the
+                        # tracebacks of every raise:
+                        future.set_exception(type(result)(*result.args))
+                    else:
+                        self.hits += 1
+                        future.set_result(result)
+                    return future, False
+                del self._entries[key]
+                self.expirations += 1
+            future = self._running.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return future, False
+            self.misses += 1
+            future = self._running[key] = concurrent.futures.Future()
+            return future, True
+
+    def _submit(self, key):
+        future, owner = self._lookup(key)
+        if owner:
+            self._executor().submit(self._run, future, key)
+        return future
+
+    def _run(self, future, key):
+        host, port, family = key
+        try:
+            result = self._getaddrinfo(host, port, family, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            # The name doesn't resolve, remembered for a while:
+            self._complete(key, e, self.negative_ttl)
+            future.set_exception(e)
+        except BaseException as e:
+            # Anything else isn't the name's fault, nothing to remember:
+            with self._lock:
+                del self._running[key]
+            future.set_exception(e)
+            if not isinstance(e, Exception):
+                # E.g. KeyboardInterrupt, in the thread that resolves inline:
+                raise
+        else:
+            self._complete(key, result, self.ttl)
+            future.set_result(result)
+
+    def _complete(self, key, result, ttl):
+        with self._lock:
+            del self._running[key]
+            self._entries[key] = (result, self._clock() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _executor(self):
+        with self._lock:
+            if self._thread_pool is None:
+                self._thread_pool = concurrent.futures.ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix="resolver"
+                )
+            return self._thread_pool
+
+    def invalidate(self, host=None):
+        """Forget the answers for 'host', or all of them."""
+        with self._lock:
+            if host is None:
+                self._entries.clear()
+                return
+            for key in [key for key in self._entries if key[0] == host]:
+                del self._entries[key]
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "expirations": self.expirations,
+            "evictions": self.evictions,
+        }
+
+    def close(self):
+        if self._thread_pool is not None:
+            self._thread_pool.shutdown(wait=False)
+
+
+class HostsFile:
+    """A getaddrinfo() answering from a file in the /etc/hosts format,
+    "<address> <name> [<alias> ...]" per line, instead of the system's
+    resolver: for tests, or to point clients at other servers without
+    touching the system's configuration. The file is read again when it
+    changes. Numeric addresses are resolved as usual, other names missing
+    from the file raise socket.gaierror."""
+
+    def __init__(self, path):
+        self.path = path
+        self._mtime = None
+        self._names = {}
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        try:
+            return socket.getaddrinfo(
+                host, port, family, type, proto, flags | socket.AI_NUMERICHOST
+            )
+        except socket.gaierror:
+            pass
+        result = []
+        for address in self._addresses(host):
+            # Numeric, this resolves it without a lookup. Addresses of
+            # another family than the one asked for are skipped:
+            try:
+                infos = socket.getaddrinfo(
+                    address, port, family, type, proto, socket.AI_NUMERICHOST
+                )
+            except socket.gaierror:
+                continue
+            for info in infos:
+                if info not in result:
+                    result.append(info)
+        if not result:
+            raise socket.gaierror(socket.EAI_NONAME, f"{host} isn't in {self.path}")
+        return result
+
+    def _addresses(self, host):
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self._mtime:
+            names = collections.defaultdict(list)
+            with open(self.path, encoding="utf-8") as file:
+                for line in file:
+                    fields = line.partition("#")[0].split()
+                    for name in fields[1:]:
+                        names[name.lower()].append(fields[0])
+            self._names = names
+            self._mtime = mtime
+        return self._names.get(host.lower(), ())
+
+
+# The resolver shared by the clients of a process:
+default_resolver = Resolver()
+
+
+def resolve(host, port, family=socket.AF_UNSPEC, timeout=None):
+    return default_resolver.resolve(host, port, family, timeout)
+
+
+async def resolve_async(host, port, family=socket.AF_UNSPEC):
+    return await default_resolver.resolve_async(host, port, family)
+
+
+def create_connection(address, timeout=None):
+    return default_resolver.create_connection(address, timeout)
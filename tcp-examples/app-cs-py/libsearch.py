@@ -0,0 +1,197 @@
+import array
+import bisect
+import collections
+
+
+class PrefixIndex:
+    """Sorted array of keys, a prefix lookup is one binary search followed
+    by a scan of the matching run."""
+
+    def __init__(self, keys=()):
+        self._keys = sorted(keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, key):
+        index = bisect.bisect_left(self._keys, key)
+        if index == len(self._keys) or self._keys[index] != key:
+            self._keys.insert(index, key)
+
+    def remove(self, key):
+        index = bisect.bisect_left(self._keys, key)
+        if index < len(self._keys) and self._keys[index] == key:
+            del self._keys[index]
+
+    def prefix(self, prefix, limit=10):
+        results = []
+        index = bisect.bisect_left(self._keys, prefix)
+        while index < len(self._keys) and len(results) < limit:
+            key = self._keys[index]
+            if not key.startswith(prefix):
+                break
+            results.append(key)
+            index += 1
+        return results
+
+
+def levenshtein(a, b, max_distance):
+    """Edit distance between 'a' and 'b', or None once it is known to exceed
+    'max_distance'. Only the diagonal band of width 2 * max_distance + 1 of
+    the distance matrix is computed, cells outside of it can't be on a path
+    within the limit."""
+    if abs(len(a) - len(b)) > max_distance:
+        return None
+    if a == b:
+        return 0
+    if len(a) > len(b):
+        a, b = b, a
+    too_far = max_distance + 1
+    previous = list(range(len(a) + 1))
+    for i, cb in enumerate(b, 1):
+        current = [too_far] * (len(a) + 1)
+        current[0] = i if i <= max_distance else too_far
+        best = current[0]
+        lo, hi = max(1, i - max_distance), min(len(a), i + max_distance)
+        for j in range(lo, hi + 1):
+            cost = previous[j - 1] + (a[j - 1] != cb)
+            if previous[j] + 1 < cost:
+                cost = previous[j] + 1
+            if current[j - 1] + 1 < cost:
+                cost = current[j - 1] + 1
+            current[j] = cost
+            if cost < best:
+                best = cost
+        # Every path to the end goes through this row:
+        if best > max_distance:
+            return None
+        previous = current
+    distance = previous[-1]
+    return distance if distance <= max_distance else None
+
+
+class TrigramIndex:
+    """Typo-tolerant lookups through an inverted index of padded trigrams.
+
+    A key within edit distance k of the query shares at least
+    'max(len(query trigrams), len(key trigrams)) - 3 * k' trigrams with it
+    (each edit destroys at most 3), so only keys passing that count filter
+    are verified with a real edit distance. The distance allowed for short
+    queries is capped so that a match shares at least one trigram with the
+    query, otherwise every key would be a candidate."""
+
+    N = 3
+
+    def __init__(self, keys=()):
+        self._keys = []
+        self._ids = {}
+        # Number of distinct trigrams of every key, for the count filter:
+        self._trigram_counts = array.array("B")
+        # Trigram -> array of key ids, far more compact than lists of ints:
+        self._postings = collections.defaultdict(lambda: array.array("I"))
+        for key in keys:
+            self.add(key)
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _trigrams(self, key):
+        padded = f"\0\0{key}\0\0"
+        return {padded[i : i + self.N] for i in range(len(padded) - self.N + 1)}
+
+    def add(self, key):
+        if key in self._ids:
+            return
+        key_id = len(self._keys)
+        self._keys.append(key)
+        self._ids[key] = key_id
+        trigrams = self._trigrams(key)
+        self._trigram_counts.append(min(len(trigrams), 255))
+        for trigram in trigrams:
+            self._postings[trigram].append(key_id)
+
+    def remove(self, key):
+        # Leave a tombstone, rewriting the postings isn't worth it:
+        key_id = self._ids.pop(key, None)
+        if key_id is not None:
+            self._keys[key_id] = None
+
+    def fuzzy(self, query, max_distance=2, limit=10):
+        """Return up to 'limit' (key, distance) pairs, closest first."""
+        trigrams = self._trigrams(query)
+        max_distance = min(max_distance, (len(trigrams) - 1) // self.N)
+        min_shared = len(trigrams) - self.N * max_distance
+        counts = collections.Counter()
+        for trigram in trigrams:
+            postings = self._postings.get(trigram)
+            if postings:
+                counts.update(postings)
+        matches = []
+        slack = self.N * max_distance
+        query_len = len(query)
+        trigram_counts = self._trigram_counts
+        for key_id, shared in counts.items():
+            if shared < min_shared or shared < trigram_counts[key_id] - slack:
+                continue
+            key = self._keys[key_id]
+            if key is None or abs(len(key) - query_len) > max_distance:
+                continue
+            distance = levenshtein(query, key, max_distance)
+            if distance is not None:
+                matches.append((distance, key))
+        matches.sort()
+        return [(key, distance) for distance, key in matches[:limit]]
+
+
+class SearchIndex:
+    """Key/value store behind the 'search', 'prefix' and 'fuzzy' actions."""
+
+    def __init__(self, items=None):
+        self._values = dict(items or {})
+        self._prefix_index = PrefixIndex(self._values)
+        self._fuzzy_index = TrigramIndex(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    @classmethod
+    def load(cls, path):
+        """Bulk load a file of 'key<TAB>value' lines. The indexes are built
+        once over all keys, which is much faster than adding keys one by
+        one."""
+        items = {}
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                key, sep, value = line.rstrip("\n").partition("\t")
+                if key:
+                    items[key] = value
+        return cls(items)
+
+    def add(self, key, value):
+        if key not in self._values:
+            self._prefix_index.add(key)
+            self._fuzzy_index.add(key)
+        self._values[key] = value
+
+    def remove(self, key):
+        if self._values.pop(key, None) is not None:
+            self._prefix_index.remove(key)
+            self._fuzzy_index.remove(key)
+
+    def keys(self):
+        return self._values.keys()
+
+    def get(self, key):
+        return self._values.get(key)
+
+    def prefix(self, prefix, limit=10):
+        return [
+            {"key": key, "value": self._values[key]}
+            for key in self._prefix_index.prefix(prefix, limit)
+        ]
+
+    def fuzzy(self, query, max_distance=2, limit=10):
+        return [
+            {"key": key, "distance": distance, "value": self._values[key]}
+            for key, distance in self._fuzzy_index.fuzzy(query, max_distance, limit)
+        ]
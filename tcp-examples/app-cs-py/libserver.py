@@ -1,8 +1,24 @@
-import sys
+import os
+import time
+import types
+import logging
 import selectors
-import json
-import io
-import struct
+import collections
+import concurrent.futures
+
+import libcache
+import libheader
+import libcompress
+import libspool
+import libsearch
+import libmetrics
+import libhandlers
+from libbuffer import Buffer
+
+logger = logging.getLogger("libserver")
+
+# Counters, gauges and latency histograms of this process, see 'stats()':
+metrics = libmetrics.Metrics()
 
 request_search = {
     "morpheus": "Follow the white rabbit. \U0001f430",
@@ -11,17 +27,204 @@ request_search = {
 }
 
 
+# The index behind the lookup actions, replaced by 'load_search_index()':
+search_index = libsearch.SearchIndex(request_search)
+
+# Upper bounds for what clients may ask of the prefix and fuzzy lookups:
+MAX_RESULTS = 100
+MAX_DISTANCE = 3
+# Upper bound of count-primes, its sieve takes a byte per number:
+MAX_PRIMES_BELOW = 100_000_000
+
+
+def load_search_index(path):
+    global search_index
+    search_index = libsearch.SearchIndex.load(path)
+    # Cached lookups were answered from the previous data:
+    if response_cache is not None:
+        response_cache.invalidate()
+
+
+# Handlers take the decoded JSON request and return the response content:
+def search(request):
+    query = request.get("value")
+    answer = search_index.get(query) or f"No match for '{query}'."
+    return {"result": answer}
+
+
+def prefix(request):
+    limit = min(int(request.get("limit", 10)), MAX_RESULTS)
+    return {"result": search_index.prefix(request.get("value"), limit)}
+
+
+def fuzzy(request):
+    limit = min(int(request.get("limit", 10)), MAX_RESULTS)
+    max_distance = min(int(request.get("max-distance", 2)), MAX_DISTANCE)
+    return {"result": search_index.fuzzy(request.get("value"), max_distance, limit)}
+
+
+def slow_search(request):
+    # Stands in for a lookup in a slow backend, it blocks for a second:
+    time.sleep(1)
+    return search(request)
+
+
+def count_primes(request):
+    # CPU-bound: counts the primes below 'value' with a sieve.
+    limit = request.get("value")
+    # Clients send strings. Long ones aren't even converted, int() refuses
+    # more than a few thousand digits anyway:
+    if isinstance(limit, str) and limit.isascii() and limit.isdigit():
+        limit = int(limit) if len(limit) <= 20 else None
+    if type(limit) is not int or not 0 <= limit <= MAX_PRIMES_BELOW:
+        error = f"Error: 'value' must be an integer from 0 to {MAX_PRIMES_BELOW}."
+        return {"result": error}
+    if limit < 3:
+        return {"result": 0}
+    sieve = bytearray([1]) * limit
+    sieve[0] = sieve[1] = 0
+    for i in range(2, int(limit**0.5) + 1):
+        if sieve[i]:
+            sieve[i * i :: i] = bytes(len(range(i * i, limit, i)))
+    return {"result": sum(sieve)}
+
+
+def stats(request):
+    # The metrics of the process that answers, one worker's with --workers:
+    snapshot = metrics.snapshot()
+    snapshot["pid"] = os.getpid()
+    # CPU seconds of all the threads of the process, e.g. to weigh the cost of
+    # compression against the bytes it saves:
+    snapshot["cpu_time"] = time.process_time()
+    if response_cache is not None:
+        snapshot["cache"] = response_cache.stats()
+    return {"result": snapshot}
+
+
+# The actions every Message answers by default. Thread handlers mostly wait,
+# so the pool is sized for their concurrency rather than for the CPU count:
+registry = libhandlers.HandlerRegistry(max_threads=16)
+registry.register("search", search, cacheable=True)
+registry.register("prefix", prefix, cacheable=True)
+# Fuzzy lookups scan many candidates, keep them off the selector loop:
+registry.register(
+    "fuzzy", fuzzy, libhandlers.THREAD, max_concurrency=4, cacheable=True
+)
+registry.register(
+    "slow-search", slow_search, libhandlers.THREAD, max_concurrency=8, cacheable=True
+)
+registry.register(
+    "count-primes", count_primes, libhandlers.PROCESS, max_concurrency=2, cacheable=True
+)
+registry.register("stats", stats)
+
+# Framed responses of cacheable actions, shared by the connections of this
+# process. Set to None to disable caching:
+response_cache = libcache.ResponseCache()
+
+
+# Binary handlers take the request body, bytes or a libspool.SpooledBody for
+# large bodies, and return the response body: bytes, or a file object that is
+# sent with sendfile():
+def echo_binary(content):
+    return b"First 10 bytes of request: " + content[:10]
+
+
+def echo_body(content):
+    # Sends the whole body back, a spooled body straight from its file:
+    return content
+
+
+binary_handler = echo_binary
+
+# Request bodies larger than this are written to a temporary file in 'SPOOL_DIR'
+# as they arrive, instead of being buffered in memory (per connection):
+BODY_MEMORY_LIMIT = 1024 * 1024
+SPOOL_DIR = None
+# Larger bodies are refused, None for no limit:
+MAX_BODY_SIZE = None
+# Request bodies held in memory by all the connections of this process. Once
+# it is used up, even small bodies are spooled to disk:
+memory_budget = libspool.MemoryBudget(64 * 1024 * 1024)
+
+# Compressions offered to clients, see 'libcompress.negotiate()'. Response
+# bodies smaller than 'COMPRESS_MIN_SIZE' are sent as they are, the savings
+# wouldn't be worth the CPU time. Bodies of at least 'COMPRESS_OFFLOAD_SIZE'
+# are compressed on the thread pool (zlib and lzma release the GIL), so that
+# they don't stall the other connections:
+COMPRESSION = ("deflate", "gzip")
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_OFFLOAD_SIZE = 64 * 1024
+
+# The 'batch' action carries a list of requests in 'requests' and is answered
+# with the list of their response contents, in the same order. It costs one
+# framed message each way instead of one per request:
+BATCH = "batch"
+MAX_BATCH_SIZE = 1000
+
+
 class Message:
-    def __init__(self, selector, sock, addr):
+    def __init__(
+        self,
+        selector,
+        sock,
+        addr,
+        idle_timeout=None,
+        max_requests=None,
+        registry=registry,
+        cache=None,
+    ):
         self.selector = selector
         self.sock = sock
         self.addr = addr
-        self._recv_buffer = b""
-        self._send_buffer = b""
+        self.registry = registry
+        self.cache = response_cache if cache is None else cache
+        # Keep-alive limits: close the connection after 'idle_timeout' seconds
+        # without any traffic, or once 'max_requests' responses were sent.
+        # 'None' disables the respective limit:
+        self.idle_timeout = idle_timeout
+        self.max_requests = max_requests
+        self.requests_served = 0
+        self.last_activity = time.monotonic()
+        self._recv_buffer = Buffer()
+        self._send_buffer = Buffer()
+        self._header_version = None
         self._jsonheader_len = None
         self.jsonheader = None
         self.request = None
+        self._handler_result = None
+        self._response_pending = False
+        self._cache_key = None
         self.response_created = False
+        # perf_counter() times at which the parse, handle and write stages of
+        # the current message started, for the latency histograms:
+        self._parse_started = None
+        self._handle_started = None
+        self._write_started = None
+        # Body of the current request while it is spooled to disk, or the
+        # number of bytes of the memory budget reserved for it otherwise:
+        self._body = None
+        self._body_reserved = 0
+        # File a binary response body is sent from after its header, and the
+        # part of it that is left to send:
+        self._send_file = None
+        self._send_offset = 0
+        self._send_remaining = 0
+        # Compression negotiated with the client, None for uncompressed
+        # responses:
+        self.compression = None
+        # Requests with a 'request-id' header, for registered actions, are
+        # multiplexed: parsing goes on with the next request while their
+        # handlers run, and each is answered as soon as its response is
+        # ready, in any order. The ones still unanswered by id, and their
+        # framed responses held back while a file body is being sent:
+        self._outstanding = {}
+        self._ready = collections.deque()
+        self._dispatched = False
+        # Set once 'max_requests' were accepted: no more requests are read,
+        # the connection closes when the last response is out:
+        self._draining = False
+        metrics.gauges["active_connections"] += 1
 
     def _set_selector_events_mask(self, mode):
         """Set selector to listen for events: mode is 'r', 'w', or 'rw'."""
@@ -37,61 +240,119 @@ class Message:
 
     def _read(self):
         try:
-            # Should be ready to read. Read data from the socket and store it in a receive buffer:
-            data = self.sock.recv(4096)
+            # Should be ready to read. Read data from the socket straight into
+            # the free space of the receive buffer, no intermediate bytes:
+            nread = self._recv_buffer.recv_into(self.sock)
         except BlockingIOError:
             # Resource temporarily unavailable (errno EWOULDBLOCK)
             pass
         else:
-            if data:
-                self._recv_buffer += data
+            if not nread:
+                # The peer may close a keep-alive connection between two
+                # messages, only an EOF in the middle of a message is an error:
+                if self._recv_buffer or self._jsonheader_len is not None:
+                    raise RuntimeError("Peer closed.")
+                self.close()
             else:
-                raise RuntimeError("Peer closed.")
+                self.last_activity = time.monotonic()
+                metrics.counters["bytes_in"] += nread
 
     def _write(self):
         if self._send_buffer:
-            print(f"Sending {self._send_buffer!r} to {self.addr}")
+            logger.debug("Sending %d bytes to %s", len(self._send_buffer), self.addr)
             try:
-                # Should be ready to write
-                sent = self.sock.send(self._send_buffer)
+                # Should be ready to write. Sent bytes are consumed by advancing
+                # the buffer's read cursor instead of re-slicing it:
+                sent = self._send_buffer.send(self.sock)
             except BlockingIOError:
                 # Resource temporarily unavailable (errno EWOULDBLOCK)
-                pass
-            else:
-                self._send_buffer = self._send_buffer[sent:]
-                # Close when the buffer is drained. The response has been sent.
-                if sent and not self._send_buffer:
-                    self.close()
+                sent = 0
+        elif self._send_file is not None:
+            # The header is out, the body follows straight from its file:
+            try:
+                sent = libspool.sendfile(
+                    self.sock, self._send_file, self._send_offset, self._send_remaining
+                )
+            except BlockingIOError:
+                sent = 0
+            self._send_offset += sent
+            self._send_remaining -= sent
+            if not self._send_remaining:
+                self._send_file = None
+                # Multiplexed responses that completed meanwhile go next:
+                while self._ready:
+                    self._send_buffer.extend(self._ready.popleft())
+        else:
+            return
+        if sent:
+            self.last_activity = time.monotonic()
+            metrics.counters["bytes_out"] += sent
 
     def _json_encode(self, obj, encoding):
-        return json.dumps(obj, ensure_ascii=False).encode(encoding)
+        return libheader.json_encode(obj, encoding)
 
     def _json_decode(self, json_bytes, encoding):
-        tiow = io.TextIOWrapper(io.BytesIO(json_bytes), encoding=encoding, newline="")
-        obj = json.load(tiow)
-        tiow.close()
-        return obj
-
-    def _create_message(self, *, content_bytes, content_type, content_encoding):
-        jsonheader = {
-            "byteorder": sys.byteorder,
-            "content-type": content_type,
-            "content-encoding": content_encoding,
-            "content-length": len(content_bytes),
-        }
-        jsonheader_bytes = self._json_encode(jsonheader, "utf-8")
-        message_hdr = struct.pack(">H", len(jsonheader_bytes))
-        message = message_hdr + jsonheader_bytes + content_bytes
-        return message
+        return libheader.json_decode(json_bytes, encoding)
+
+    def _create_message(
+        self,
+        *,
+        content_bytes,
+        content_type,
+        content_encoding,
+        content_length=None,
+        content_compression=None,
+        exchange=None,
+        last=None,
+    ):
+        # 'content_length' is only given for a body sent from a file, which
+        # follows the message:
+        if content_length is None:
+            content_length = len(content_bytes)
+        jsonheader = libheader.create_header(
+            content_length=content_length,
+            content_type=content_type,
+            content_encoding=content_encoding,
+            content_compression=content_compression,
+        )
+        # A multiplexed response answers the request of its 'exchange', not
+        # the one currently being parsed:
+        if exchange is None:
+            request_header, header_version = self.jsonheader, self._header_version
+            last = self._is_last_request()
+        else:
+            request_header, header_version = exchange.header, None
+        if "request-id" in request_header:
+            jsonheader["request-id"] = request_header["request-id"]
+        # Tell the client when this is the last response on the connection, so
+        # that it stops pipelining requests that would never be answered:
+        if last:
+            jsonheader["connection"] = "close"
+        # Answer in the header format of the request. A binary request proves
+        # that the client supports binary headers, a JSON request that
+        # advertises a 'header-version' is acknowledged with the version both
+        # sides support, and old clients keep getting plain JSON headers:
+        if header_version is not None and libheader.can_encode_binary(jsonheader):
+            message_hdr = libheader.encode_binary(jsonheader)
+        else:
+            if "header-version" in request_header:
+                jsonheader["header-version"] = min(
+                    request_header["header-version"], libheader.VERSION
+                )
+            message_hdr = libheader.encode_json(jsonheader)
+        return message_hdr + content_bytes
+
+    def _response_content(self, action, handler_result):
+        if handler_result is None:
+            return {"result": f"Error: invalid action '{action}'."}
+        try:
+            return handler_result.result()
+        except Exception as e:
+            return {"result": f"Error: action '{action}' failed: {e!r}"}
 
     def _create_response_json_content(self):
         action = self.request.get("action")
-        if action == "search":
-            query = self.request.get("value")
-            answer = request_search.get(query) or f"No match for '{query}'."
-            content = {"result": answer}
-        else:
-            content = {"result": f"Error: invalid action '{action}'."}
+        content = self._response_content(action, self._handler_result)
         content_encoding = "utf-8"
         response = {
             "content_bytes": self._json_encode(content, content_encoding),
@@ -101,13 +362,92 @@ class Message:
         return response
 
     def _create_response_binary_content(self):
+        content = binary_handler(self.request)
+        if hasattr(content, "fileno"):
+            # Only the header goes through the send buffer, '_write()' sends
+            # the body with sendfile() once it is out:
+            self._send_offset, self._send_remaining = libspool.file_range(content)
+            if self._send_remaining:
+                self._send_file = content
+            content_length = self._send_remaining
+            content = b""
+        else:
+            content_length = len(content)
         response = {
-            "content_bytes": b"First 10 bytes of request: " + self.request[:10],
+            "content_bytes": content,
+            "content_length": content_length,
             "content_type": "binary/custom-server-binary-type",
             "content_encoding": "binary",
         }
         return response
 
+    def _is_last_request(self):
+        # Multiplexed requests count as soon as they are accepted. A rejected
+        # request drains the connection too:
+        return self._draining or (
+            self.max_requests is not None
+            and self.requests_served + len(self._outstanding) + 1 >= self.max_requests
+        )
+
+    def _reset(self):
+        # Forget the state of the message that has just been answered, the
+        # receive buffer is kept since it may already hold the next request:
+        self._header_version = None
+        self._jsonheader_len = None
+        self.jsonheader = None
+        self.request = None
+        self._handler_result = None
+        self._response_pending = False
+        self._cache_key = None
+        self.response_created = False
+        self._parse_started = None
+        self._handle_started = None
+        self._write_started = None
+        self._release_body()
+        self._send_file = None
+
+    def _release_body(self):
+        if self._body is not None:
+            self._body.close()
+            self._body = None
+        if self._body_reserved:
+            memory_budget.release(self._body_reserved)
+            metrics.gauges["body_memory_bytes"] -= self._body_reserved
+            self._body_reserved = 0
+
+    def _finish_message(self):
+        metrics.histogram("write").record(time.perf_counter() - self._write_started)
+        self.requests_served += 1
+        if self._draining or (
+            self.max_requests is not None
+            and self.requests_served + len(self._outstanding) >= self.max_requests
+        ):
+            # The response just sent said 'connection: close'. Multiplexed
+            # requests still running are answered before closing:
+            self._draining = True
+            if not self._outstanding:
+                self.close()
+                return
+        self._reset()
+        if self._draining:
+            self._set_selector_events_mask("r")
+            return
+        # A pipelining client may have sent the next request(s) already, so
+        # parse whatever is buffered before waiting for more bytes. If a full
+        # request is there, 'process_request()' keeps the socket in write mode:
+        self._process_buffered()
+        if self.request is None or self._response_pending:
+            # Inline handlers of multiplexed requests may have answered already:
+            self._set_selector_events_mask("rw" if self._send_buffer else "r")
+
+    def is_idle(self, now):
+        """Whether the connection went quiet for longer than 'idle_timeout'."""
+        return (
+            self.idle_timeout is not None
+            and now - self.last_activity > self.idle_timeout
+            and not self._outstanding
+        )
+
     def process_events(self, mask):
         if mask & selectors.EVENT_READ:
             self.read()
@@ -116,74 +456,109 @@ class Message:
 
     def read(self):
         self._read()
+        if self.sock is None:
+            # Closed by the peer between two messages:
+            return
+        self._process_buffered()
 
+    def _process_buffered(self):
         # Before a method processes its part of the message, it checks to make
         # sure enough bytes have been read into the receive buffer. If so, it
         # processes its respective bytes, removes them from the buffer and writes
         # its output to a variable that’s used by the next processing stage.
         # Because there are 3 components to a message, there are 3 state checks and
-        # process method calls:
-        #   1. Fixed-length header - if not yet processed or still processing, call
-        # method 'process_protoheader()':
-        if self._jsonheader_len is None:
-            self.process_protoheader()
-
-        #   2. JSON header - if not yet processed or still processing, call
-        # method 'process_jsonheader()':
-        if self._jsonheader_len is not None:
-            if self.jsonheader is None:
-                self.process_jsonheader()
-
-        #   3. Content - if the JSON header has been processed already, process the
-        # request in case it hasn't been yet:
-        if self.jsonheader:
-            if self.request is None:
-                self.process_request()
+        # process method calls. A multiplexed request is done with once it is
+        # dispatched, so the loop goes on with the next one:
+        while not self._draining:
+            #   1. Fixed-length header - if not yet processed or still processing,
+            # call method 'process_protoheader()':
+            if self._jsonheader_len is None:
+                if self._parse_started is None and self._recv_buffer:
+                    self._parse_started = time.perf_counter()
+                self.process_protoheader()
+
+            #   2. JSON header - if not yet processed or still processing, call
+            # method 'process_jsonheader()':
+            if self._jsonheader_len is not None:
+                if self.jsonheader is None:
+                    self.process_jsonheader()
+
+            #   3. Content - if the JSON header has been processed already,
+            # process the request in case it hasn't been yet:
+            if self.jsonheader:
+                if self.request is None:
+                    self.process_request()
+
+            if not self._dispatched:
+                break
+            self._dispatched = False
 
     def write(self):
         # Check for a request. If one exists and a response hasn’t been created,
         # call '.create_response()', which sets the state variable
         # 'response_created' and writes the response to the send buffer:
-        if self.request:
-            if not self.response_created:
+        if self.request is not None:
+            if not self.response_created and not self._response_pending:
                 self.create_response()
 
         self._write()
+        if self._send_buffer or self._send_file is not None:
+            return
+
+        # The response has been sent. Instead of closing the connection, get
+        # ready for the next request on it (keep-alive):
+        if self.response_created:
+            self._finish_message()
+        elif self._draining and not self._outstanding:
+            self.close()
+        elif self.sock is not None:
+            # Only multiplexed responses were sent, wait for more requests:
+            self._set_selector_events_mask("r")
 
     def close(self):
-        print(f"Closing connection to {self.addr}")
+        logger.info("Closing connection to %s", self.addr)
+        metrics.gauges["active_connections"] -= 1
+        self._release_body()
         try:
             self.selector.unregister(self.sock)
         except Exception as e:
-            print(f"Error: selector.unregister() exception for " f"{self.addr}: {e!r}")
+            logger.error("selector.unregister() exception for %s: %r", self.addr, e)
 
         try:
             self.sock.close()
         except OSError as e:
-            print(f"Error: socket.close() exception for {self.addr}: {e!r}")
+            logger.error("socket.close() exception for %s: %r", self.addr, e)
         finally:
             # Delete reference to socket object for garbage collection
             self.sock = None
 
     def process_protoheader(self):
-        # 2 byte header indicating the size of the JSON header:
-        hdrlen = 2
+        # 2 byte header indicating the size of the JSON header, or the magic
+        # byte and version of a fixed-size binary header:
+        hdrlen = libheader.PROTOHEADER.size
         # Check if all the bytes needed for the current part of the process have
         # were already received in the buffer:
         if len(self._recv_buffer) >= hdrlen:
-            self._jsonheader_len = struct.unpack(">H", self._recv_buffer[:hdrlen])[0]
+            self._header_version, self._jsonheader_len = libheader.decode_protoheader(
+                self._recv_buffer.peek(hdrlen)
+            )
             # remove the processed bytes from the buffer:
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._recv_buffer.consume(hdrlen)
 
     def process_jsonheader(self):
         hdrlen = self._jsonheader_len
         # Check if all the bytes needed for the current part of the process have
         # were already received in the buffer:
         if len(self._recv_buffer) >= hdrlen:
-            # Decode and deserialize the JSON header into a dictionary:
-            self.jsonheader = self._json_decode(self._recv_buffer[:hdrlen], "utf-8")
+            # Decode and deserialize the JSON (or binary) header into a dictionary:
+            if self._header_version is None:
+                self.jsonheader = libheader.decode_json(self._recv_buffer.peek(hdrlen))
+            else:
+                self.jsonheader = libheader.decode_binary(
+                    self._recv_buffer.peek(hdrlen)
+                )
             # remove the processed bytes from the buffer:
-            self._recv_buffer = self._recv_buffer[hdrlen:]
+            self._recv_buffer.consume(hdrlen)
             # process the JSON header:
             for reqhdr in (
                 "byteorder",
@@ -193,38 +568,378 @@ class Message:
             ):
                 if reqhdr not in self.jsonheader:
                     raise ValueError(f"Missing required header '{reqhdr}'.")
+            # The compression holds for the rest of the connection, binary
+            # headers can't carry the client's offer:
+            if "accept-compression" in self.jsonheader:
+                self.compression = libcompress.negotiate(
+                    self.jsonheader["accept-compression"], COMPRESSION
+                )
 
     def process_request(self):
         content_len = self.jsonheader["content-length"]
-        # Check if all the bytes needed for the current part of the process have
-        # were already received in the buffer:
-        if not len(self._recv_buffer) >= content_len:
-            return
-        # Extract the message:
-        data = self._recv_buffer[:content_len]
-        # Remove the processed bytes from the buffer:
-        self._recv_buffer = self._recv_buffer[content_len:]
+        if self._body is None and not self._body_reserved:
+            error = self._check_body_length(content_len)
+            if error is not None:
+                self._reject_request(error)
+                return
+            self._start_body(content_len)
+        if self._body is not None:
+            # Move what has arrived of the body to its file, so that the
+            # receive buffer never holds more than one read's worth of it:
+            self._spool_buffered()
+            if not self._body.complete():
+                return
+            data = self._body
+        else:
+            # Check if all the bytes needed for the current part of the process
+            # have were already received in the buffer:
+            if not len(self._recv_buffer) >= content_len:
+                # Make room for the rest of the body up front, so that it is
+                # received with as few buffer reallocations as possible:
+                self._recv_buffer.reserve(content_len - len(self._recv_buffer))
+                return
+            # Extract the message. The view is copied exactly once, since the
+            # buffer's storage is reused for the next bytes received:
+            data = bytes(self._recv_buffer.peek(content_len))
+            # Remove the processed bytes from the buffer:
+            self._recv_buffer.consume(content_len)
         # If the content type is JSON, decode and deserialize it:
         if self.jsonheader["content-type"] == "text/json":
             encoding = self.jsonheader["content-encoding"]
+            if self._body is not None:
+                data = self._body.view()
             self.request = self._json_decode(data, encoding)
-            print(f"Received request {self.request!r} from {self.addr}")
+            now = self._parsed()
+            logger.debug("Received request %r from %s", self.request, self.addr)
+            action = self.request.get("action")
+            # Only registered actions get a counter of their own, clients
+            # must not be able to grow the metrics without bounds:
+            if self._is_action(action):
+                metrics.counters[f"requests.{action}"] += 1
+            else:
+                metrics.counters["requests.invalid"] += 1
+            if self._use_cache(action):
+                cached = self.cache.get(self._cache_key)
+                if cached is not None:
+                    # Cache hit: the framed response goes straight to the send
+                    # buffer, no handler and no JSON encoding involved. It
+                    # only needs the request id of this request, if any:
+                    self._write_started = now
+                    if "request-id" in self.jsonheader:
+                        cached = libheader.reframe(
+                            cached, {"request-id": self.jsonheader["request-id"]}
+                        )
+                    self._send_buffer.extend(cached)
+                    self.response_created = True
+                    self._set_selector_events_mask("w")
+                    return
+            if self._is_action(action) and "request-id" in self.jsonheader:
+                self._dispatch_multiplexed(action, now)
+                return
+            if self._is_action(action):
+                # Hand the request over to its handler. Inline handlers call
+                # back right away, offloaded ones once their result is ready,
+                # and only then does the connection switch to write mode:
+                self._response_pending = True
+                self._handle_started = now
+                self._dispatch(action, self.request, self._handler_done)
+                return
         else:
-            # Binary or unknown content-type
+            # Binary or unknown content-type. The handler gets the bytes of a
+            # body held in memory, or the spooled body:
             self.request = data
-            print(
-                f"Received {self.jsonheader['content-type']} "
-                f"request from {self.addr}"
+            self._parsed()
+            logger.debug(
+                "Received %s request from %s",
+                self.jsonheader["content-type"],
+                self.addr,
             )
+            metrics.counters["requests.binary"] += 1
         # Set selector to listen for write events, we're done reading.
         self._set_selector_events_mask("w")
 
+    def _check_body_length(self, content_len):
+        # Checked before any memory is reserved for the body:
+        if type(content_len) is not int or content_len < 0:
+            return f"Error: invalid content-length {content_len!r}."
+        if MAX_BODY_SIZE is not None and content_len > MAX_BODY_SIZE:
+            return f"Error: request body of {content_len} bytes is too large."
+        return None
+
+    def _reject_request(self, error):
+        # The body isn't read, so nothing on the connection after it can be
+        # parsed: the error is the last response, answered as JSON whatever
+        # the request's content-type:
+        metrics.counters["requests.invalid"] += 1
+        self._draining = True
+        self.jsonheader["content-type"] = "text/json"
+        self.request = {}
+        self._handler_result = concurrent.futures.Future()
+        self._handler_result.set_result({"result": error})
+        self._set_selector_events_mask("w")
+
+    def _start_body(self, content_len):
+        if content_len <= BODY_MEMORY_LIMIT and memory_budget.try_acquire(content_len):
+            self._body_reserved = content_len
+            metrics.gauges["body_memory_bytes"] += content_len
+            return
+        # JSON requests are spooled too, and decoded from the mapped file once
+        # complete. Only MAX_BODY_SIZE refuses a body:
+        self._body = libspool.SpooledBody(content_len, SPOOL_DIR)
+        metrics.counters["bodies_spooled"] += 1
+
+    def _spool_buffered(self):
+        nbytes = min(len(self._recv_buffer), self._body.length - self._body.received)
+        if nbytes:
+            self._body.write(self._recv_buffer.peek(nbytes))
+            self._recv_buffer.consume(nbytes)
+
+    def _parsed(self):
+        now = time.perf_counter()
+        metrics.histogram("parse").record(now - self._parse_started)
+        return now
+
+    def _is_action(self, action):
+        return action == BATCH or action in self.registry
+
+    def _dispatch(self, action, request, callback):
+        if action == BATCH:
+            self._dispatch_batch(request, callback)
+        else:
+            self.registry.dispatch(action, request, callback)
+
+    def _dispatch_batch(self, request, callback):
+        """Dispatch all the requests of a batch in one pass, inline handlers
+        run right away and offloaded ones within their concurrency limits.
+        'callback' gets a future of the whole response once the last of them
+        is done."""
+        requests = request.get("requests")
+        future = concurrent.futures.Future()
+        if not isinstance(requests, list) or len(requests) > MAX_BATCH_SIZE:
+            error = f"Error: 'requests' must be a list of at most {MAX_BATCH_SIZE}."
+            future.set_result({"result": error})
+            callback(future)
+            return
+        metrics.counters["batch.requests"] += len(requests)
+        results = [None] * len(requests)
+        # One more than the requests, released once all are dispatched, so
+        # that inline handlers can't complete the batch halfway through:
+        remaining = [len(requests) + 1]
+
+        def release():
+            remaining[0] -= 1
+            if not remaining[0]:
+                future.set_result({"result": results})
+                callback(future)
+
+        def done(index, action, result):
+            results[index] = self._response_content(action, result)
+            release()
+
+        for index, sub_request in enumerate(requests):
+            action = None
+            if isinstance(sub_request, dict):
+                action = sub_request.get("action")
+            # Batches don't nest:
+            if action in self.registry:
+                metrics.counters[f"requests.{action}"] += 1
+                self.registry.dispatch(
+                    action,
+                    sub_request,
+                    lambda result, i=index, a=action: done(i, a, result),
+                )
+            else:
+                metrics.counters["requests.invalid"] += 1
+                done(index, action, None)
+        release()
+
+    def _use_cache(self, action):
+        if (
+            self.cache is None
+            or not self.registry.is_cacheable(action)
+            or self.request.keys() != {"action", "value"}
+            or not isinstance(self.request["value"], str)
+            # The last response carries 'connection: close', don't share it:
+            or self._is_last_request()
+        ):
+            return False
+        # The same content is framed differently for binary header clients
+        # and for JSON header clients, depending on the version they advertise:
+        # Responses to multiplexed requests carry a request id, which is
+        # replaced on a hit:
+        if self._header_version is not None:
+            header_variant = ("binary", self._header_version)
+        else:
+            header_variant = (
+                "json",
+                self.jsonheader.get("header-version"),
+                "request-id" in self.jsonheader,
+            )
+        self._cache_key = (
+            action,
+            self.request["value"],
+            self.jsonheader["content-encoding"],
+            header_variant,
+            # Cached compressed, a hit costs no compression at all:
+            self.compression,
+        )
+        return True
+
+    def _handler_done(self, result):
+        if self.sock is None:
+            # The connection was closed while the handler was running:
+            return
+        metrics.histogram("handle").record(time.perf_counter() - self._handle_started)
+        self._handler_result = result
+        self._response_pending = False
+        # Set selector to listen for write events, the response is ready.
+        self._set_selector_events_mask("w")
+
     def create_response(self):
+        self._write_started = time.perf_counter()
         if self.jsonheader["content-type"] == "text/json":
             response = self._create_response_json_content()
         else:
             # Binary or unknown content-type
             response = self._create_response_binary_content()
+        # Bodies sent from a file with sendfile() are never compressed:
+        if self._send_file is None and self._compress_response(
+            response, self._send_compressed
+        ):
+            # Wait for the compressed body like for an offloaded handler,
+            # without write events meanwhile:
+            self._response_pending = True
+            self._set_selector_events_mask("r")
+            return
+        self._send_response(response)
+
+    def _send_compressed(self, response):
+        self._response_pending = False
+        self._send_response(response)
+        self._set_selector_events_mask("w")
+
+    def _compress_response(self, response, send):
+        """Compress the body of 'response' if it is worth it. Return True if
+        that happens on the thread pool, 'send(response)' is called once it
+        is done then."""
+        content = response["content_bytes"]
+        if self.compression is None or len(content) < COMPRESS_MIN_SIZE:
+            return False
+        if len(content) >= COMPRESS_OFFLOAD_SIZE:
+            codec = self.compression
+            self.registry.run_in_thread(
+                self._compress,
+                (content, codec),
+                lambda future: self._compressed(response, codec, future, send),
+            )
+            return True
+        started = time.perf_counter()
+        compressed = libcompress.compress(content, self.compression)
+        metrics.histogram("compress").record(time.perf_counter() - started)
+        self._use_compressed(response, self.compression, compressed)
+        return False
+
+    @staticmethod
+    def _compress(args):
+        # Runs on the thread pool, the time is recorded by '_compressed()':
+        content, codec = args
+        started = time.perf_counter()
+        return libcompress.compress(content, codec), time.perf_counter() - started
+
+    def _compressed(self, response, codec, future, send):
+        if self.sock is None:
+            # The connection was closed while the body was compressed:
+            return
+        try:
+            compressed, elapsed = future.result()
+        except Exception:
+            logger.exception("Compressing the response to %s failed", self.addr)
+        else:
+            metrics.histogram("compress").record(elapsed)
+            self._use_compressed(response, codec, compressed)
+        send(response)
+
+    def _use_compressed(self, response, codec, compressed):
+        content = response["content_bytes"]
+        metrics.counters["compression.bytes_in"] += len(content)
+        # Incompressible bodies are sent as they are:
+        if len(compressed) >= len(content):
+            metrics.counters["compression.bytes_out"] += len(content)
+            return
+        metrics.counters["compression.bytes_out"] += len(compressed)
+        response["content_bytes"] = compressed
+        response["content_compression"] = codec
+        response.pop("content_length", None)
+
+    def _send_response(self, response):
         message = self._create_message(**response)
         self.response_created = True
-        self._send_buffer += message
+        self._send_buffer.extend(message)
+        # Only successful results are worth caching, not exceptions:
+        if self._cache_key is not None and self._handler_result.exception() is None:
+            self.cache.put(self._cache_key, message)
+
+    def _dispatch_multiplexed(self, action, now):
+        request_id = self.jsonheader["request-id"]
+        if request_id in self._outstanding:
+            raise ValueError(f"Duplicate request-id {request_id!r}.")
+        # What the response needs to know about its request, the parsing
+        # state is reset for the next one right away:
+        exchange = types.SimpleNamespace(
+            request_id=request_id,
+            action=action,
+            header=self.jsonheader,
+            cache_key=self._cache_key,
+            started=now,
+        )
+        self._outstanding[request_id] = exchange
+        if self.max_requests is not None and (
+            self.requests_served + len(self._outstanding) >= self.max_requests
+        ):
+            self._draining = True
+        request = self.request
+        self._reset()
+        self._dispatched = True
+        # Inline handlers call back before 'dispatch()' returns:
+        self._dispatch(
+            action, request, lambda result: self._multiplexed_done(exchange, result)
+        )
+
+    def _multiplexed_done(self, exchange, result):
+        if self.sock is None:
+            # The connection was closed while the handler was running:
+            return
+        metrics.histogram("handle").record(time.perf_counter() - exchange.started)
+        exchange.cacheable = (
+            exchange.cache_key is not None and result.exception() is None
+        )
+        exchange.write_started = time.perf_counter()
+        content = self._response_content(exchange.action, result)
+        content_encoding = "utf-8"
+        response = {
+            "content_bytes": self._json_encode(content, content_encoding),
+            "content_type": "text/json",
+            "content_encoding": content_encoding,
+        }
+        send = lambda response: self._send_multiplexed(exchange, response)  # noqa
+        if not self._compress_response(response, send):
+            send(response)
+
+    def _send_multiplexed(self, exchange, response):
+        del self._outstanding[exchange.request_id]
+        self.requests_served += 1
+        # The last response before closing says so, whichever it is:
+        last = self._draining and not self._outstanding and self.request is None
+        message = self._create_message(**response, exchange=exchange, last=last)
+        # Cacheable as parsed, but it may turn out to be the last response,
+        # completed after the one to the last request: not to be shared then:
+        if exchange.cacheable and not last:
+            self.cache.put(exchange.cache_key, message)
+        metrics.histogram("write").record(time.perf_counter() - exchange.write_started)
+        # A file body being sent must not be interrupted:
+        if self._send_file is None:
+            self._send_buffer.extend(message)
+        else:
+            self._ready.append(message)
+        # Keep reading requests while the response goes out:
+        self._set_selector_events_mask("rw")
@@ -0,0 +1,102 @@
+import os
+import mmap
+import tempfile
+
+
+class MemoryBudget:
+    """Bytes of request bodies that the connections of a process may hold in
+    memory together. Bodies that don't fit are spooled to disk instead."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def try_acquire(self, nbytes):
+        if self.limit is not None and self.used + nbytes > self.limit:
+            return False
+        self.used += nbytes
+        return True
+
+    def release(self, nbytes):
+        self.used -= nbytes
+
+
+class SpooledBody:
+    """A message body written to an anonymous temporary file as it arrives,
+    so that its size is bounded by the disk rather than by memory.
+
+    Once complete, it is read through '.view()', a memoryview of the file
+    mapped into memory (pages are loaded on access and can be dropped again
+    by the kernel), or through '.file'. A handler returning it, or any other
+    file object, as a binary response has it sent with sendfile()."""
+
+    def __init__(self, length, dir=None):
+        self.length = length
+        self.received = 0
+        self.file = tempfile.TemporaryFile(dir=dir)
+        self._mmap = None
+        self._view = None
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        # Slicing works like on the bytes of a body held in memory:
+        return self.view()[index]
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def write(self, data):
+        """Append 'data' (any bytes-like object) to the body."""
+        self.received += self.file.write(data)
+
+    def complete(self):
+        return self.received >= self.length
+
+    def view(self):
+        if self._view is None:
+            self.file.flush()
+            if self.length:
+                self._mmap = mmap.mmap(
+                    self.fileno(), self.length, access=mmap.ACCESS_READ
+                )
+                self._view = memoryview(self._mmap)
+            else:
+                # Zero-length files can't be mapped:
+                self._view = memoryview(b"")
+        return self._view
+
+    def close(self):
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A handler still holds a slice of the view, the mapping goes
+                # away with the last reference to it:
+                pass
+            self._mmap = None
+        self.file.close()
+
+
+def file_range(file):
+    """Return (offset, byte count) of the part of 'file' a response sends: a
+    whole spooled body, or any other file from its current position on."""
+    if isinstance(file, SpooledBody):
+        return 0, file.length
+    offset = file.tell()
+    return offset, os.fstat(file.fileno()).st_size - offset
+
+
+def sendfile(sock, file, offset, count):
+    """Send up to 'count' bytes of 'file' from 'offset' without copying them
+    through user space where the platform allows it. Works on non-blocking
+    sockets, unlike socket.sendfile(): 'BlockingIOError' propagates to the
+    caller, who retries once the socket is writable."""
+    if hasattr(os, "sendfile"):
+        return os.sendfile(sock.fileno(), file.fileno(), offset, count)
+    data = os.pread(file.fileno(), min(count, 65536), offset)
+    return sock.send(data)
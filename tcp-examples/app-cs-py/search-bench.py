@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+# Microbenchmark of libsearch over a large synthetic key set: index build
+# times, and lookups per second for exact, prefix and fuzzy queries compared
+# with a linear scan over all keys.
+#
+# Usage: search-bench.py [--keys N] [--queries N] [--data FILE] [--write FILE]
+
+import time
+import random
+import string
+import argparse
+
+import libsearch
+
+
+def generate_keys(count, seed):
+    rng = random.Random(seed)
+    keys = set()
+    while len(keys) < count:
+        keys.add("".join(rng.choices(string.ascii_lowercase, k=rng.randint(5, 12))))
+    return {key: f"value of {key}" for key in keys}
+
+
+def typo(rng, key):
+    # One random substitution, deletion or insertion:
+    i = rng.randrange(len(key))
+    edit = rng.choice("sdi")
+    if edit == "s":
+        return key[:i] + rng.choice(string.ascii_lowercase) + key[i + 1 :]
+    if edit == "d":
+        return key[:i] + key[i + 1 :]
+    return key[:i] + rng.choice(string.ascii_lowercase) + key[i:]
+
+
+def timed(func, queries):
+    start = time.perf_counter()
+    for query in queries:
+        func(query)
+    elapsed = time.perf_counter() - start
+    return len(queries) / elapsed
+
+
+def report(name, rate, baseline=None):
+    line = f"{name:>18}: {rate:>12.1f} lookups/s"
+    if baseline:
+        line += f"  ({rate / baseline:.0f}x the linear scan)"
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="libsearch microbenchmark.")
+    parser.add_argument("--keys", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--data", help="benchmark a 'key<TAB>value' file instead")
+    parser.add_argument("--write", help="save the generated keys as such a file")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    if args.data:
+        start = time.perf_counter()
+        index = libsearch.SearchIndex.load(args.data)
+        print(f"Loaded {len(index)} keys in {time.perf_counter() - start:.2f}s")
+    else:
+        items = generate_keys(args.keys, args.seed)
+        if args.write:
+            with open(args.write, "w", encoding="utf-8") as f:
+                f.writelines(f"{key}\t{value}\n" for key, value in items.items())
+        start = time.perf_counter()
+        index = libsearch.SearchIndex(items)
+        print(f"Indexed {len(index)} keys in {time.perf_counter() - start:.2f}s")
+
+    keys = list(index.keys())
+    start = time.perf_counter()
+    libsearch.PrefixIndex(keys)
+    print(f"  prefix index build: {time.perf_counter() - start:.2f}s")
+    start = time.perf_counter()
+    libsearch.TrigramIndex(keys)
+    print(f"  trigram index build: {time.perf_counter() - start:.2f}s")
+
+    sample = rng.sample(keys, min(args.queries, len(keys)))
+    prefixes = [key[:3] for key in sample]
+    typos = [typo(rng, key) for key in sample]
+    # The linear scans are slow, time them on a handful of queries only:
+    few = max(1, len(sample) // 20)
+
+    report("exact", timed(index.get, sample))
+
+    def scan_prefix(prefix, limit=10):
+        return [key for key in keys if key.startswith(prefix)][:limit]
+
+    def scan_fuzzy(query, max_distance=2, limit=10):
+        matches = []
+        for key in keys:
+            distance = libsearch.levenshtein(query, key, max_distance)
+            if distance is not None:
+                matches.append((distance, key))
+        return sorted(matches)[:limit]
+
+    scan_rate = timed(scan_prefix, prefixes[:few])
+    report("prefix (scan)", scan_rate)
+    report("prefix (index)", timed(index.prefix, prefixes), scan_rate)
+    scan_rate = timed(scan_fuzzy, typos[:few])
+    report("fuzzy (scan)", scan_rate)
+    report("fuzzy (index)", timed(index.fuzzy, typos), scan_rate)
+
+    found = sum(
+        any(match["key"] == key for match in index.fuzzy(query))
+        for key, query in zip(sample, typos)
+    )
+    print(f"Fuzzy recall for one typo: {found}/{len(sample)}")
+
+
+if __name__ == "__main__":
+    main()
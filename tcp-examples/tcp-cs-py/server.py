@@ -1,8 +1,16 @@
 # The “server” waits for a client connection, generates a welcome notification
 # to the client, and then closes the connection.
+#
+# Usage: server.py [<port>] [--forever]
+# With '--forever' it keeps welcoming clients instead of exiting after the
+# first one.
 
+import sys
 import socket
 
+args = [arg for arg in sys.argv[1:] if arg != "--forever"]
+forever = len(args) < len(sys.argv) - 1
+
 # create new socket object:
 # -- AF_INET: Internet address family for IPv4.
 # -- SOCK_STREAM: socket type for the TCP protocol.
@@ -12,7 +20,7 @@ server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 host = "127.0.0.1"  # socket.gethostname()
 
 # define port number (non-privileged ports are > 1023):
-port = 8080
+port = int(args[0]) if args else 8080
 
 # bind address (hostname, port number) pair to socket:
 server_socket.bind((host, port))
@@ -26,14 +34,18 @@ server_socket.listen(1)
 
 print("... waiting for a client connection ...")
 
-# Wait for an incoming connection. Then, once established the connection,
-# return a new socket object representing the connection, and the address
-# of the client. For IP sockets, the address info is a pair (hostaddr, port).
-client_socket, addr = server_socket.accept()
+message = "[[ Heey, welcome to the server! ]]"
+
+while True:
+    # Wait for an incoming connection. Then, once established the connection,
+    # return a new socket object representing the connection, and the address
+    # of the client. For IP sockets, the address info is a pair (hostaddr, port).
+    client_socket, addr = server_socket.accept()
 
-print("... connection established with: ", addr)
+    print("... connection established with: ", addr)
 
-message = "[[ Heey, welcome to the server! ]]"
+    client_socket.send(message.encode())
+    client_socket.close()
 
-client_socket.send(message.encode())
-client_socket.close()
+    if not forever:
+        break
@@ -4,111 +4,596 @@
 
 #!/usr/bin/env python3
 
+# Load generator for the echo server (multiconn-server.py) and for the
+# app-cs-py message protocol (app-server.py). It keeps 'num_connections'
+# non-blocking connections busy from a single selector loop, either closed
+# loop (every connection sends its next request as soon as the previous
+# response arrived) or open loop (requests are sent at a fixed total rate,
+# whether or not the server keeps up). Latencies go into a histogram and are
+# reported as percentiles, as text and optionally as JSON.
+#
+# Usage: multiconn-client.py <host> <port> <num_connections> [options]
+
+import os
 import sys
+import json
+import math
+import time
+import random
 import socket
+import argparse
 import selectors
-import types
-
-sel = selectors.DefaultSelector()
-messages = [b"Message 1 from client.", b"Message 2 from client."]
-
-
-def start_connections(host, port, num_conns):
-    server_addr = (host, port)
-    for i in range(0, num_conns):
-        connid = i + 1
-        print(f"Starting connection {connid} to {server_addr}")
-        # Create new socket object:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # Put the socket in non-blocking mode:
-        sock.setblocking(False)
-        # Similar to .connect(address), but returns an error indicator instead of
-        # raising an exception for errors returned by the C-level connect() call.
-        # The error indicator is 0 if the operation succeeded, otherwise the value
-        # of the errno variable. This is useful to support, for example
-        # asynchronous connects. Once the connection is completed, the socket is
-        # ready for reading and writing and is returned by .select().
-        sock.connect_ex(server_addr)
-        # To indicate that the client connection is ready for reading and writing,
-        # set both events with the bitwise OR operator:
-        events = selectors.EVENT_READ | selectors.EVENT_WRITE
-        # Create the data you want to store with the socket using SimpleNamespace
-        data = types.SimpleNamespace(
-            # connection id:
-            connid=connid,
-            # total number of messages:
-            msg_total=sum(len(m) for m in messages),
-            # total number of received messages:
-            recv_total=0,
-            # Messages that the client will send to the server are copied using
-            # messages.copy() because each connection will call socket.send() and
-            # modify the list:
-            messages=messages.copy(),
-            outb=b"",
+import collections
+import multiprocessing
+
+# The buffer, header and metrics helpers are shared with the app-cs-py example:
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app-cs-py")
+)
+import libheader  # noqa: E402
+import libmetrics  # noqa: E402
+import libresolver  # noqa: E402
+from libbuffer import Buffer  # noqa: E402
+
+# Seconds before a connection that failed or was closed unexpectedly is
+# opened again:
+RECONNECT_DELAY = 0.1
+
+
+def parse_sizes(spec):
+    """Payload size distribution: 'N' bytes, uniformly 'MIN-MAX' bytes, or
+    one of 'A,B,C' bytes picked at random."""
+    if "," in spec:
+        choices = [int(size) for size in spec.split(",")]
+        return lambda rng: rng.choice(choices)
+    if "-" in spec:
+        low, high = (int(size) for size in spec.split("-", 1))
+        return lambda rng: rng.randint(low, high)
+    size = int(spec)
+    return lambda rng: size
+
+
+class Workload:
+    """Builds request messages. Messages are cached by payload size, so that a
+    request costs no encoding once every size has been seen."""
+
+    def __init__(self, protocol, sizes, seed, action="search", binary_headers=False):
+        self.protocol = protocol
+        self.sizes = sizes
+        self.rng = random.Random(seed)
+        self.action = action
+        self.binary_headers = binary_headers
+        self._messages = {}
+
+    def request(self):
+        """Return (message bytes, expected response bytes or None)."""
+        size = self.sizes(self.rng)
+        message = self._messages.get(size)
+        if message is None:
+            message = self._messages[size] = self._create_message(size)
+        # The echo server sends back exactly what it got, app-server responses
+        # are framed and delimited by their headers:
+        return message, len(message) if self.protocol == "echo" else None
+
+    def _create_message(self, size):
+        if self.protocol == "echo":
+            return b"x" * size
+        request = {"action": self.action, "value": "x" * size}
+        content = libheader.json_encode(request, "utf-8")
+        header = libheader.create_header(
+            content_length=len(content),
+            content_type="text/json",
+            content_encoding="utf-8",
         )
-        # Register a file object for selection, monitoring it for I/O events, by
-        # passing the events mask, socket and data objects to sel.register():
-        sel.register(sock, events, data=data)
-
-
-def service_connection(key, mask):
-    # key is the namedtuple returned from .select() that contains the socket object
-    # (fileobj) and data object. mask contains the events that are ready.
-    sock = key.fileobj
-    data = key.data
-    # If the socket is ready for reading, then mask & selectors.EVENT_READ will
-    # evaluate to True, so sock.recv() is called.
-    if mask & selectors.EVENT_READ:
-        recv_data = sock.recv(1024)  # Should be ready to read
-        # If data was received, it is printed out and its total number of bytes is
-        # added to data.recv_total to keep track of what has been received so far:
-        if recv_data:
-            print(f"Received {recv_data!r} from connection {data.connid}")
-            data.recv_total += len(recv_data)
-        # The client keeps track of the number of bytes it’s received from the
-        # server (data.recv_total) so that it can close its side of the connection.
-        # When the server detects this, it closes its side of the connection too.
-        if not recv_data or data.recv_total == data.msg_total:
-            print(f"Closing connection {data.connid}")
-            # Unregister a file object from selection, removing it from monitoring:
-            sel.unregister(sock)
-            # Close socket:
-            sock.close()
-    # If the socket is ready for writing, any data stored in data.outb is sent to
-    # the server using sock.send(). The bytes sent are then removed from the outb
-    # buffer:
-    if mask & selectors.EVENT_WRITE:
-        if not data.outb and data.messages:
-            data.outb = data.messages.pop(0)
-        if data.outb:
-            print(f"Sending {data.outb!r} to connection {data.connid}")
-            sent = sock.send(data.outb)  # Should be ready to write
-            data.outb = data.outb[sent:]
-
-
-if len(sys.argv) != 4:
-    print(f"Usage: {sys.argv[0]} <host> <port> <num_connections>")
-    sys.exit(1)
-
-# arguments read from the command-line:
-# - host: host IP address;
-# - port: host port number;
-# - num_conns: umber of connections to create to the server.
-host, port, num_conns = sys.argv[1:4]
-
-# initiate connections:
-start_connections(host, int(port), int(num_conns))
-
-try:
-    while True:
-        events = sel.select(timeout=1)
-        if events:
-            for key, mask in events:
-                service_connection(key, mask)
-        # Check for a socket being monitored to continue.
-        if not sel.get_map():
-            break
-except KeyboardInterrupt:
-    print("Caught keyboard interrupt, exiting")
-finally:
-    sel.close()
+        if self.binary_headers:
+            return libheader.encode_binary(header) + content
+        return libheader.encode_json(header) + content
+
+
+class Connection:
+    def __init__(self, generator, connid):
+        self.generator = generator
+        self.connid = connid
+        self.sock = None
+        self.connected = False
+        self.events = None
+        self.retry_at = 0.0
+        self._send_buffer = Buffer()
+        self._recv_buffer = Buffer()
+        # Scheduled send time and expected response size of the requests
+        # waiting for their response, oldest first:
+        self.inflight = collections.deque()
+        # Echo: bytes of the oldest request still to be echoed back. App
+        # protocol: content length of the response being received, and
+        # whether the server closes the connection after it:
+        self._remaining = None
+        self._body_len = None
+        self._close_after = False
+
+    def open(self):
+        self.sock = socket.socket(self.generator.family, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(False)
+        # Returns an error indicator instead of raising, the connection is
+        # complete once the socket turns writable:
+        self.sock.connect_ex(self.generator.server_addr)
+        self.events = selectors.EVENT_WRITE
+        self.generator.sel.register(self.sock, self.events, data=self)
+
+    def close(self, error=None):
+        if self.sock is None:
+            return
+        generator = self.generator
+        if error is not None:
+            generator.errors[error] += 1
+        if self.inflight:
+            # Requests the server will never answer on this connection:
+            generator.errors["dropped"] += len(self.inflight)
+        generator.sel.unregister(self.sock)
+        self.sock.close()
+        self.sock = None
+        if self.connected:
+            self.connected = False
+            generator.ready.remove(self)
+        self.inflight.clear()
+        self._send_buffer.clear()
+        self._recv_buffer.clear()
+        self._remaining = self._body_len = None
+        self._close_after = False
+        self.retry_at = time.perf_counter() + RECONNECT_DELAY
+
+    def _update_events(self):
+        events = selectors.EVENT_READ
+        if self._send_buffer:
+            events |= selectors.EVENT_WRITE
+        # Most sends complete right away, skip the system call when nothing
+        # changes:
+        if events != self.events:
+            self.events = events
+            self.generator.sel.modify(self.sock, events, data=self)
+
+    def send(self, scheduled):
+        message, expected = self.generator.workload.request()
+        was_idle = not self._send_buffer
+        self._send_buffer.extend(message)
+        self.inflight.append((scheduled, expected))
+        self.generator.bytes_out += len(message)
+        if was_idle:
+            # Try right away, most sends complete without waiting for the
+            # selector:
+            self._write()
+
+    def process_events(self, mask):
+        if not self.connected:
+            error = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error:
+                self.close(f"connect: {os.strerror(error)}")
+                return
+            self.connected = True
+            self.generator.connected(self)
+            if self.sock is None:
+                return
+            self._update_events()
+            return
+        try:
+            if mask & selectors.EVENT_READ:
+                self._read()
+            if self.connected and mask & selectors.EVENT_WRITE:
+                self._write()
+        except OSError as e:
+            self.close(type(e).__name__)
+
+    def _write(self):
+        try:
+            self._send_buffer.send(self.sock)
+        except BlockingIOError:
+            pass
+        except OSError as e:
+            self.close(type(e).__name__)
+            return
+        self._update_events()
+
+    def _read(self):
+        try:
+            nread = self._recv_buffer.recv_into(self.sock)
+        except BlockingIOError:
+            return
+        if not nread:
+            self.close("closed by server" if self.inflight else None)
+            return
+        self.generator.bytes_in += nread
+        if self.generator.workload.protocol == "echo":
+            self._process_echo()
+        else:
+            self._process_app()
+
+    def _process_echo(self):
+        # Only the byte count matters, the echoed data is dropped right away:
+        available = len(self._recv_buffer)
+        self._recv_buffer.clear()
+        while available and self.inflight:
+            if self._remaining is None:
+                self._remaining = self.inflight[0][1]
+            used = min(available, self._remaining)
+            available -= used
+            self._remaining -= used
+            if not self._remaining:
+                self._remaining = None
+                self.generator.completed(self, self.inflight.popleft()[0])
+
+    def _process_app(self):
+        buf = self._recv_buffer
+        while self.sock is not None:
+            if self._body_len is None:
+                hdrlen = libheader.PROTOHEADER.size
+                if len(buf) < hdrlen:
+                    return
+                version, header_len = libheader.decode_protoheader(buf.peek(hdrlen))
+                if len(buf) < hdrlen + header_len:
+                    return
+                header_bytes = buf.peek(hdrlen + header_len)[hdrlen:]
+                if version is None:
+                    header = libheader.decode_json(header_bytes)
+                else:
+                    header = libheader.decode_binary(header_bytes)
+                buf.consume(hdrlen + header_len)
+                self._body_len = header["content-length"]
+                self._close_after = header.get("connection") == "close"
+            if len(buf) < self._body_len:
+                buf.reserve(self._body_len - len(buf))
+                return
+            # The response content isn't looked at, only timed:
+            buf.consume(self._body_len)
+            self._body_len = None
+            if not self.inflight:
+                self.close("unexpected response")
+                return
+            scheduled = self.inflight.popleft()[0]
+            if self._close_after:
+                # app-server's --max-requests was reached, reconnect right away.
+                # A closed-loop connection sends its next request once the
+                # new connection is established:
+                self.close()
+                self.open()
+            self.generator.completed(self, scheduled)
+
+
+class LoadGenerator:
+    def __init__(
+        self,
+        server_addr,
+        num_conns,
+        workload,
+        duration,
+        rate=0.0,
+        ramp_up=0.0,
+        family=socket.AF_INET,
+    ):
+        self.server_addr = server_addr
+        self.family = family
+        self.num_conns = num_conns
+        self.workload = workload
+        self.duration = duration
+        # Requests per second over all connections, 0 for closed loop:
+        self.rate = rate
+        self.ramp_up = ramp_up
+        self.sel = selectors.DefaultSelector()
+        self.connections = []
+        # Connections that completed their connect(), for open-loop sends:
+        self.ready = []
+        self._next_ready = 0
+        self.histogram = libmetrics.Histogram()
+        self.requests = 0
+        self.warmup_requests = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.errors = collections.Counter()
+        self._next_send = None
+        # Open-loop requests scheduled so far, counted from the start:
+        self._scheduled = 0
+        self.start = self.measure_start = self.end = None
+
+    def _send_closed_loop(self, connection, now):
+        # A connection that is being reopened sends once it is connected:
+        if now < self.end and connection.connected:
+            connection.send(now)
+
+    def connected(self, connection):
+        self.ready.append(connection)
+        now = time.perf_counter()
+        if self.rate:
+            # The schedule starts with the first connection, not before:
+            if self._next_send is None:
+                self._scheduled = math.ceil(self._due(now))
+                self._next_send = self._send_time(self._scheduled)
+        else:
+            self._send_closed_loop(connection, now)
+
+    def completed(self, connection, scheduled):
+        now = time.perf_counter()
+        # Open-loop latency counts from when the request was due, not from
+        # when it was sent, so that a server falling behind can't hide its
+        # queueing delay (coordinated omission):
+        if scheduled >= self.measure_start:
+            self.histogram.record(now - scheduled)
+            self.requests += 1
+        else:
+            self.warmup_requests += 1
+        if not self.rate:
+            self._send_closed_loop(connection, now)
+
+    def _ramp(self, now):
+        if self.ramp_up <= 0:
+            return 1.0
+        return min(1.0, (now - self.start) / self.ramp_up)
+
+    def _due(self, now):
+        # How many requests are due by 'now' since the start: the target rate
+        # rises along with the connections during ramp-up, so the integral of
+        # 'rate' times the ramp:
+        elapsed = now - self.start
+        if elapsed < self.ramp_up:
+            return self.rate * elapsed * elapsed / (2 * self.ramp_up)
+        return self.rate * (elapsed - self.ramp_up / 2)
+
+    def _send_time(self, count):
+        # When the 'count'th request is due, the inverse of '._due()'. Any
+        # rate works, however low the ramp or a process's share of --rate:
+        ramp_count = self.rate * self.ramp_up / 2
+        if count < ramp_count:
+            return self.start + math.sqrt(2 * count * self.ramp_up / self.rate)
+        return self.start + self.ramp_up / 2 + count / self.rate
+
+    def _open_connections(self, now):
+        # Connections are opened gradually during the ramp-up:
+        wanted = math.ceil(self.num_conns * self._ramp(now))
+        while len(self.connections) < wanted:
+            connection = Connection(self, len(self.connections) + 1)
+            self.connections.append(connection)
+            connection.open()
+        for connection in self.connections:
+            if connection.sock is None and now >= connection.retry_at:
+                connection.open()
+
+    def _send_open_loop(self, now):
+        next_send = self._next_send
+        while next_send <= now and next_send < self.end:
+            if self.ready:
+                self._next_ready = (self._next_ready + 1) % len(self.ready)
+                self.ready[self._next_ready].send(next_send)
+            else:
+                self.errors["no connection"] += 1
+            self._scheduled += 1
+            next_send = self._send_time(self._scheduled)
+        self._next_send = next_send
+
+    def run(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.measure_start = self.start + self.ramp_up
+        self.end = self.measure_start + self.duration
+        next_housekeeping = self.start
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= self.end:
+                    break
+                if now >= next_housekeeping:
+                    self._open_connections(now)
+                    next_housekeeping = now + 0.01
+                if self._next_send is not None:
+                    self._send_open_loop(now)
+                timeout = min(next_housekeeping, self.end) - now
+                if self._next_send is not None:
+                    timeout = min(timeout, self._next_send - now)
+                for key, mask in self.sel.select(timeout=max(timeout, 0)):
+                    connection = key.data
+                    if connection.sock is not None:
+                        connection.process_events(mask)
+        finally:
+            inflight = sum(len(c.inflight) for c in self.connections)
+            for connection in self.connections:
+                connection.inflight.clear()
+                connection.close()
+            self.sel.close()
+        return {
+            "requests": self.requests,
+            "warmup_requests": self.warmup_requests,
+            "inflight_at_end": inflight,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "errors": dict(self.errors),
+            "histogram": self.histogram.to_dict(),
+        }
+
+
+def run_process(options):
+    # Entry point of every process of a --processes fan-out:
+    workload = Workload(
+        options["protocol"],
+        parse_sizes(options["size"]),
+        options["seed"],
+        options["action"],
+        options["binary_headers"],
+    )
+    # Resolved once, before the run: connections reopened during it don't
+    # wait for lookups. IPv6 servers work too. The addresses are tried in
+    # order, the first one isn't always where the server listens:
+    with libresolver.create_connection(options["server_addr"]) as sock:
+        family, server_addr = sock.family, sock.getpeername()
+    generator = LoadGenerator(
+        server_addr,
+        options["connections"],
+        workload,
+        options["duration"],
+        options["rate"],
+        options["ramp_up"],
+        family,
+    )
+    # Wait for the common start time, so that the processes overlap:
+    delay = options["start_at"] - time.time()
+    if delay > 0:
+        time.sleep(delay)
+    return generator.run()
+
+
+def split(total, parts):
+    return [total // parts + (i < total % parts) for i in range(parts)]
+
+
+def merge_results(results, args):
+    histogram = libmetrics.Histogram()
+    errors = collections.Counter()
+    merged = collections.Counter()
+    for result in results:
+        histogram.merge(libmetrics.Histogram.from_dict(result["histogram"]))
+        errors.update(result["errors"])
+        for name in ("requests", "warmup_requests", "inflight_at_end"):
+            merged[name] += result[name]
+        merged["bytes_in"] += result["bytes_in"]
+        merged["bytes_out"] += result["bytes_out"]
+    total_time = args.ramp_up + args.duration
+    return {
+        "server": f"{args.host}:{args.port}",
+        "protocol": args.protocol,
+        "connections": args.num_connections,
+        "processes": args.processes,
+        "mode": "open loop" if args.rate else "closed loop",
+        "target_rate": args.rate,
+        "duration": args.duration,
+        "ramp_up": args.ramp_up,
+        "payload_size": args.size,
+        "requests": merged["requests"],
+        "warmup_requests": merged["warmup_requests"],
+        "inflight_at_end": merged["inflight_at_end"],
+        "throughput": merged["requests"] / args.duration,
+        # The byte counts include the ramp-up:
+        "mb_in_per_s": merged["bytes_in"] / total_time / 1e6,
+        "mb_out_per_s": merged["bytes_out"] / total_time / 1e6,
+        "errors": dict(errors),
+        # Seconds:
+        "latency": histogram.snapshot(),
+    }
+
+
+def report(summary):
+    print(
+        f"{summary['connections']} connections, {summary['processes']} "
+        f"process(es), {summary['mode']}, {summary['duration']:g}s "
+        f"after {summary['ramp_up']:g}s ramp-up against {summary['server']} "
+        f"({summary['protocol']})"
+    )
+    target = f" (target {summary['target_rate']:g})" if summary["target_rate"] else ""
+    print(f"  throughput: {summary['throughput']:.1f} requests/s{target}")
+    print(
+        f"  transfer:   {summary['mb_out_per_s']:.2f} MB/s out, "
+        f"{summary['mb_in_per_s']:.2f} MB/s in"
+    )
+    latency = summary["latency"]
+    percentiles = "  ".join(
+        f"{name} {latency[name] * 1e3:.3f}"
+        for name in ("p50", "p90", "p99", "p99.9", "max")
+    )
+    print(f"  latency ms: {percentiles}")
+    errors = ", ".join(f"{name}: {count}" for name, count in summary["errors"].items())
+    print(f"  requests:   {summary['requests']}, errors: {errors or 'none'}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage=f"{sys.argv[0]} <host> <port> <num_connections> [options]",
+        description="Load generator for the echo and app-cs-py servers.",
+    )
+    parser.add_argument("host")
+    parser.add_argument("port", type=int)
+    parser.add_argument("num_connections", type=int)
+    parser.add_argument(
+        "--protocol",
+        choices=["echo", "app"],
+        default="echo",
+        help="echo: raw bytes for multiconn-server.py, app: app-cs-py messages "
+        "(default: echo)",
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="seconds to measure (default: 10)"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0.0,
+        help="open loop: send this many requests per second in total, "
+        "0 for closed loop (default: 0)",
+    )
+    parser.add_argument(
+        "--ramp-up",
+        type=float,
+        default=0.0,
+        help="seconds over which connections are opened and the rate rises, "
+        "not measured (default: 0)",
+    )
+    parser.add_argument(
+        "--size",
+        default="64",
+        help="payload bytes: N, MIN-MAX (uniform) or A,B,C (default: 64)",
+    )
+    parser.add_argument(
+        "--action", default="search", help="app protocol action (default: search)"
+    )
+    parser.add_argument(
+        "--binary-headers",
+        action="store_true",
+        help="app protocol: send binary instead of JSON headers",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        default=1,
+        help="split connections and rate across this many processes (default: 1)",
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--json", metavar="FILE", help="also write the results as JSON, '-' for stdout"
+    )
+    args = parser.parse_args()
+
+    processes = max(1, min(args.processes, args.num_connections))
+    args.processes = processes
+    start_at = time.time() + (0.2 if processes > 1 else 0)
+    options = []
+    for index, connections in enumerate(split(args.num_connections, processes)):
+        options.append(
+            {
+                "server_addr": (args.host, args.port),
+                "protocol": args.protocol,
+                "connections": connections,
+                "duration": args.duration,
+                "rate": args.rate * connections / args.num_connections,
+                "ramp_up": args.ramp_up,
+                "size": args.size,
+                "action": args.action,
+                "binary_headers": args.binary_headers,
+                "seed": args.seed + index,
+                "start_at": start_at,
+            }
+        )
+    try:
+        if processes == 1:
+            results = [run_process(options[0])]
+        else:
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(run_process, options)
+    except KeyboardInterrupt:
+        print("Caught keyboard interrupt, exiting")
+        sys.exit(1)
+
+    summary = merge_results(results, args)
+    report(summary)
+    if args.json == "-":
+        json.dump(summary, sys.stdout, indent=2)
+        print()
+    elif args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
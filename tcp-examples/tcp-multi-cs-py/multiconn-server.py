@@ -4,34 +4,98 @@
 
 #!/usr/bin/env python3
 
+import os
 import sys
+import json
+import time
 import socket
+import logging
+import argparse
 import selectors
 import types
 
+# The metrics and logging helpers are shared with the app-cs-py example:
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "app-cs-py")
+)
+import libmetrics  # noqa: E402
+from libbuffer import Buffer  # noqa: E402
+
+logger = logging.getLogger("multiconn-server")
+metrics = libmetrics.Metrics()
+
 # The default selector class uses the most efficient implementation available
 # on the current platform:
 sel = selectors.DefaultSelector()
 
+# Bytes read with one recv_into() call, and at most per read event, so that a
+# fast sender can't starve the other connections of one loop iteration:
+READ_CHUNK = 65536
+READ_BUDGET = 4 * READ_CHUNK
+
 
 def accept_wrapper(sock):
     # Establishes the connection and returns a new socket object representing the
     # connection, and the address of the client. For IP sockets, the address info
     # is a pair (hostaddr, port):
     conn, addr = sock.accept()  # Should be ready to read
-    print(f"Accepted connection from {addr}")
+    logger.info("Accepted connection from %s", addr)
+    metrics.counters["accepts"] += 1
+    metrics.gauges["active_connections"] += 1
     # Put the socket in non-blocking mode. If it blocks, then the entire server
     # is stalled until it returns. That means other sockets are left waiting even
     # though the server isn’t actively working:
     conn.setblocking(False)
-    # Create an object to hold the data that you want packed along with the socket:
-    data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-    # To know when the client connection is ready for reading and writing, set both
-    # events with the bitwise OR operator:
-    events = selectors.EVENT_READ | selectors.EVENT_WRITE
-    # Register a file object for selection, monitoring it for I/O events, by passing
-    # the events mask, socket and data objects to sel.register():
-    sel.register(conn, events, data=data)
+    # Echo every chunk right away instead of holding it back until the
+    # previous one was acknowledged (Nagle's algorithm):
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    # Create an object to hold the data that you want packed along with the socket.
+    # Received bytes are read straight into 'outb', the buffer they are echoed
+    # from. 'received' is when the oldest byte still waiting in 'outb' arrived,
+    # for the echo latency histogram. 'reading' is False while the connection
+    # is paused because too much output is pending, 'eof' once the client has
+    # stopped sending:
+    data = types.SimpleNamespace(
+        addr=addr,
+        outb=Buffer(READ_CHUNK),
+        received=None,
+        reading=True,
+        eof=False,
+        events=selectors.EVENT_READ,
+    )
+    # Only wait for the connection to become readable. An idle socket is always
+    # writable, so write events are only asked for while there is output
+    # pending, otherwise sel.select() would return right away, every time:
+    sel.register(conn, data.events, data=data)
+
+
+def close_connection(sock, data):
+    logger.info("Closing connection to %s", data.addr)
+    metrics.gauges["active_connections"] -= 1
+    # Unregister a file object from selection, removing it from monitoring:
+    sel.unregister(sock)
+    sock.close()
+
+
+def update_events(sock, data):
+    # Backpressure: stop reading above the high watermark of pending output,
+    # and resume only once it is drained below the low watermark, so that the
+    # connection doesn't flip between the two states on every event:
+    pending = len(data.outb)
+    if data.reading and pending >= args.high_watermark:
+        data.reading = False
+        metrics.counters["read_pauses"] += 1
+    elif not data.reading and pending <= args.low_watermark:
+        data.reading = True
+    events = 0
+    if data.reading and not data.eof:
+        events |= selectors.EVENT_READ
+    if pending:
+        events |= selectors.EVENT_WRITE
+    # Changing the mask is a system call, only make it when it does change:
+    if events != data.events:
+        data.events = events
+        sel.modify(sock, events, data=data)
 
 
 def service_connection(key, mask):
@@ -39,42 +103,117 @@ def service_connection(key, mask):
     # (fileobj) and data object. mask contains the events that are ready.
     sock = key.fileobj
     data = key.data
-    # If the socket is ready for reading, then mask & selectors.EVENT_READ will
-    # evaluate to True, so sock.recv() is called. Any data that’s read is appended
-    # to data.outb so that it can be sent later:
-    if mask & selectors.EVENT_READ:
-        recv_data = sock.recv(1024)  # Should be ready to read
-        # Data was received, append it to data.outb:
-        if recv_data:
-            data.outb += recv_data
-        # No data received, the client has closed their socket, so the server
-        # should close it too:
-        else:
-            print(f"Closing connection to {data.addr}")
-            # Unregister a file object from selection, removing it from monitoring:
-            sel.unregister(sock)
-            sock.close()
-    # If the socket is ready for writing, which should always be the case for a
-    # healthy socket, any received data stored in data.outb is echoed to the client
-    # using sock.send(). The bytes sent are then removed from the send buffer:
-    if mask & selectors.EVENT_WRITE:
+    try:
+        # If the socket is ready for reading, then mask & selectors.EVENT_READ
+        # will evaluate to True, so the data is read into data.outb to be echoed.
+        # Whatever was read is sent right away as well: most of the time the
+        # socket is writable and no write event has to be waited for:
+        if mask & selectors.EVENT_READ:
+            read(sock, data)
         if data.outb:
-            print(f"Echoing {data.outb!r} to {data.addr}")
-            # .send() returns the number of bytes sent, which can then be used with
-            # slice notation on the .outb buffer to discard the bytes sent:
-            sent = sock.send(data.outb)  # Should be ready to write
-            data.outb = data.outb[sent:]
-
-
-# Usage: multiconn-server.py <host> <port>
-# sys.argv[0]:  multiconn-server.py
-# sys.argv[1]:  <host>
-# sys.argv[2]:  <port>
-if len(sys.argv) != 3:
-    print(f"Usage: {sys.argv[0]} <host> <port>")
-    sys.exit(1)
-
-host, port = sys.argv[1], int(sys.argv[2])
+            write(sock, data)
+    except OSError as e:
+        # Connection reset by the client, for instance:
+        logger.info("Error on connection to %s: %r", data.addr, e)
+        close_connection(sock, data)
+        return
+    # The client has closed its side and everything it sent was echoed, so the
+    # server should close the connection too:
+    if data.eof and not data.outb:
+        close_connection(sock, data)
+        return
+    update_events(sock, data)
+
+
+def read(sock, data):
+    nread = 0
+    while nread < READ_BUDGET and len(data.outb) < args.high_watermark:
+        try:
+            chunk = data.outb.recv_into(sock, READ_CHUNK)  # Should be ready to read
+        except BlockingIOError:
+            # Resource temporarily unavailable (errno EWOULDBLOCK), drained:
+            break
+        if not chunk:
+            # No data received, the client has closed its socket. What it sent
+            # before is still echoed:
+            data.eof = True
+            break
+        if not nread and len(data.outb) == chunk:
+            data.received = time.perf_counter()
+        nread += chunk
+        if chunk < READ_CHUNK:
+            # A short read means the socket's receive queue is empty, save the
+            # recv_into() call that would only fail with EWOULDBLOCK:
+            break
+    metrics.counters["bytes_in"] += nread
+
+
+def write(sock, data):
+    logger.debug("Echoing %d bytes to %s", len(data.outb), data.addr)
+    try:
+        # The bytes sent are consumed from the buffer by advancing its read
+        # cursor, instead of copying what is left into a new bytes object:
+        sent = data.outb.send(sock)
+    except BlockingIOError:
+        return
+    metrics.counters["bytes_out"] += sent
+    if not data.outb:
+        metrics.histogram("echo").record(time.perf_counter() - data.received)
+
+
+def send_stats(sock):
+    # A connection to the stats port gets a JSON snapshot of the metrics, one
+    # line, and is closed right away: 'nc <host> <stats port>' is all it takes.
+    # The reply is small, a blocking send doesn't stall the loop noticeably:
+    conn, addr = sock.accept()
+    try:
+        conn.sendall(json.dumps(metrics.snapshot(), sort_keys=True).encode() + b"\n")
+    except OSError as e:
+        logger.warning("Could not send stats to %s: %r", addr, e)
+    finally:
+        conn.close()
+
+
+# Usage: multiconn-server.py <host> <port> [--stats-port PORT] [options]
+parser = argparse.ArgumentParser(usage=f"{sys.argv[0]} <host> <port> [options]")
+parser.add_argument("host")
+parser.add_argument("port", type=int)
+parser.add_argument(
+    "--stats-port",
+    type=int,
+    help="serve a JSON snapshot of the metrics to every connection on this port",
+)
+parser.add_argument(
+    "--stats-interval",
+    type=float,
+    default=60.0,
+    help="seconds between dumps of the metrics to the log, 0 disables them "
+    "(default: 60)",
+)
+parser.add_argument(
+    "--log-level",
+    default="INFO",
+    choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+    help="DEBUG logs every echo (default: INFO)",
+)
+parser.add_argument(
+    "--high-watermark",
+    type=int,
+    default=1024 * 1024,
+    help="stop reading from a connection with this many bytes waiting to be "
+    "echoed (default: 1 MiB)",
+)
+parser.add_argument(
+    "--low-watermark",
+    type=int,
+    default=256 * 1024,
+    help="resume reading once no more than this many bytes are waiting "
+    "(default: 256 KiB)",
+)
+args = parser.parse_args()
+libmetrics.setup_logging(args.log_level)
+
+host, port = args.host, args.port
 # Create new socket object:
 lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 # Bind address pair (hostname, port number) to socket:
@@ -82,7 +221,7 @@ lsock.bind((host, port))
 # Set up and start TCP listener. It listens for connections from clients. When a
 # client connects, it calls .accept() to accept, or complete, the connection:
 lsock.listen()
-print(f"Listening on {(host, port)}")
+logger.info("Listening on %s", (host, port))
 # Configure the socket in non-blocking mode. When used alongside sel.select(),
 # you can wait for events on one or more sockets and then read and write data
 # when it's ready:
@@ -92,25 +231,47 @@ lsock.setblocking(False)
 # selectors.EVENT_READ:
 sel.register(lsock, selectors.EVENT_READ, data=None)
 
+if args.stats_port is not None:
+    stats_sock = socket.create_server((host, args.stats_port))
+    stats_sock.setblocking(False)
+    sel.register(stats_sock, selectors.EVENT_READ, data="stats")
+    logger.info("Serving metrics on %s", (host, args.stats_port))
+
+
+def dump_metrics(title):
+    logger.info("%s: %s", title, json.dumps(metrics.snapshot(), sort_keys=True))
+
+
+next_dump = time.monotonic() + args.stats_interval
 try:
     while True:
         # Check for I/O completion on more than one socket. Call .select() to see
         # which sockets have I/O ready for reading/writing. It blocks until there
         # are sockets ready for I/O. It returns a list of tuples, one for each
         # socket. Each tuple contains a key and an event mask:
-        events = sel.select(timeout=None)
+        # Wake up for the periodic metrics dump even without any traffic:
+        timeout = None
+        if args.stats_interval > 0:
+            timeout = max(next_dump - time.monotonic(), 0)
+        events = sel.select(timeout=timeout)
         for key, mask in events:
             # It's a listening socket and you need to accept the connection by
             # calling the accept_wrapper() function to get the new socket object
             # and register it with the selector:
             if key.data is None:
                 accept_wrapper(key.fileobj)
+            elif key.data == "stats":
+                send_stats(key.fileobj)
             # It's a client socket that's already been accepted and you need to
             # service it by calling service_connection() with key and mask as
             # arguments:
             else:
                 service_connection(key, mask)
+        if args.stats_interval > 0 and time.monotonic() >= next_dump:
+            dump_metrics("Metrics")
+            next_dump = time.monotonic() + args.stats_interval
 except KeyboardInterrupt:
-    print("Caught keyboard interrupt, exiting")
+    logger.info("Caught keyboard interrupt, exiting")
 finally:
+    dump_metrics("Final metrics")
     sel.close()